@@ -2,17 +2,13 @@
 from godcomplex import World
 from godcomplex import PrintUtil
 from godcomplex import Navigate
-import numpy
-from PIL import Image
+from godcomplex.renderer import TerminalRenderer
+from godcomplex.raster import Raster, GREYSCALE_PALETTE
 import sqlite3
 from colors import color
 
 MAX_HISTORY_SHOWN = 30
 
-def print_at_cell(coord, text):
-    x, y = coord
-    print('\033[{};{}H{}'.format(y + 2, x + 1, text))
-
 if __name__ == '__main__':
     db = sqlite3.connect('file:worldgen.db?mode=ro', uri=True)
     world = World(db=db)
@@ -39,11 +35,14 @@ if __name__ == '__main__':
     print('The world has started. Input newline to run a single simulation step.')
 
     current_view = 'activity'
+    renderer = TerminalRenderer(world, view=current_view)
     while True:
         cmd = input()
+        renderer.clear_overlay()
         if cmd.startswith('ag'):
             print('\n'.join([str(a) for a in world.agents.values()]))
             input()
+            renderer.invalidate()
         elif cmd.startswith('p'):
             try:
                 args = [int(v) for v in cmd.split()[1:]]
@@ -53,43 +52,41 @@ if __name__ == '__main__':
                 x1, y1, x2, y2 = [int(v) for v in args]
                 c1 = (x1, y1)
                 c2 = (x2, y2)
-                path = Navigate.path(world, c1, lambda _, coord: coord == c2)
+                path = Navigate.astar(world, c1, c2)
                 if path:
                     print(path)
-                    for c in path:
-                        print_at_cell(c, color('>', fg='red'))
+                    renderer.set_overlay(path, color('>', fg='red'))
                 else:
                     print('No path found from', c1, 'to', c2)
             except ValueError as e:
                 print(e)
                 print('USAGE: p <x1> <x2> <y1> <y2>')
-            input()
         elif cmd.startswith('se'):
             print('\n'.join([str(a) for a in world.agents.values() if a.agent_type == 'SETTLEMENT']))
             input()
+            renderer.invalidate()
         elif cmd.startswith('h'):
-            print('\n'.join([str(e) for e in world.history.events[-MAX_HISTORY_SHOWN:]]))
+            print('\n'.join([str(e) for e in world.history.recent(MAX_HISTORY_SHOWN)]))
             input()
+            renderer.invalidate()
         elif cmd.startswith('f'):
             print('\n'.join([str(a) for a in world.factions.values()]))
             input()
+            renderer.invalidate()
         elif cmd.startswith('a'):
             current_view = 'activity'
         elif cmd.startswith('t'):
             current_view = 'terrain'
         elif cmd.startswith('g'):
-            Image.fromarray(numpy.asarray(world.elevation) * 255) \
-                .convert('RGB') \
-                .save('test.bmp')
+            Raster.export(world, 'test.bmp', layer='elevation',
+                palette=GREYSCALE_PALETTE)
         else:
             world.step()
 
         print('\033[;HYear {}, First Age of the World\033[0K'.format(
             world.history.current_timestamp))
-        if current_view == 'activity':
-            PrintUtil.print_activity(world)
-        elif current_view == 'terrain':
-            PrintUtil.print_terrain(world)
+        renderer.set_view(current_view)
+        renderer.render()
 
         print('Currently in {} view. '.format(current_view) +
             'Commands:' + '  '.join(['[ag]ent list',
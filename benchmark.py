@@ -0,0 +1,202 @@
+
+# Benchmarks for world generation and simulation.
+#
+#   python benchmark.py --output results.json
+#   python benchmark.py --compare results.json
+#
+# Each case is timed on a freshly set up world (best of --repeat runs), then
+# run once more under tracemalloc to record its peak memory. --compare reruns
+# the suite and flags every case that got slower or hungrier than the stored
+# baseline by more than --threshold, exiting with status 1 if any did.
+
+import argparse
+import json
+import platform
+import sqlite3
+import sys
+import time
+import tracemalloc
+import numpy
+from godcomplex import World, Navigate
+from godcomplex.agent import Agent, AgentType, AgentActions
+
+DEFAULT_SIZES = '150x30,300x60,600x120'
+DEFAULT_AGENTS = '0,200'
+DEFAULT_TICKS = 50
+DEFAULT_REPEAT = 3
+DEFAULT_THRESHOLD = 0.25
+DB_PATH = 'file:worldgen.db?mode=ro'
+SEED = 1234
+# rough path cost of the short Navigate queries.
+SHORT_QUERY_COST = 20
+
+def make_world(width, height, stage=None):
+    world = World(width=width, height=height, seed=SEED,
+        db=sqlite3.connect(DB_PATH, uri=True))
+    stages = ['terrain', 'moisture', 'biomes', 'peoples']
+    for name in stages[:stages.index(stage) + 1 if stage else 0]:
+        getattr(world, 'init_{}'.format(name))()
+    return world
+
+def add_settlers(world, count):
+    factions = list(world.factions.values())
+    for i in range(count):
+        agent = Agent(world=world,
+            faction=factions[i % len(factions)],
+            agent_type=AgentType.SETTLER,
+            goals=[AgentActions.settle])
+        world.add_agent(agent)
+        world.place_agent(agent)
+
+def find_queries(world):
+    # picks short, long and unreachable queries deterministically.
+    costs = Navigate.cost_grid(world)
+    passable = costs < float('inf')
+    rng = numpy.random.RandomState(SEED)
+    cells = numpy.argwhere(passable)
+    src = cell(cells[rng.randint(len(cells))])
+    distance = Navigate.flow_field(world, dests=[src]).distance
+    reachable = numpy.argwhere(passable & (distance < float('inf')))
+    steps = distance[reachable[:, 0], reachable[:, 1]]
+    unreachable = numpy.argwhere(passable & (distance == float('inf')))
+    if not len(unreachable):
+        unreachable = numpy.argwhere(~passable)
+    return src, {
+        'short': cell(reachable[numpy.argmin(numpy.abs(steps - SHORT_QUERY_COST))]),
+        'long': cell(reachable[numpy.argmax(steps)]),
+        'unreachable': cell(unreachable[0]),
+    }
+
+def cell(row_col):
+    return (int(row_col[1]), int(row_col[0]))
+
+def cases(width, height, agent_counts, ticks):
+    # yields (name, setup, run). setup builds whatever run needs, and its
+    # return value is passed to run.
+    yield 'init_terrain', lambda: make_world(width, height), \
+        lambda world: world.init_terrain()
+
+    def rivers_setup():
+        world = make_world(width, height, 'terrain')
+        world._add_layer('moisture', defaultval=0, dtype=numpy.uint8)
+        return world
+    yield 'init_rivers', rivers_setup, lambda world: world.init_rivers()
+    # note that init_moisture includes init_rivers.
+    yield 'init_moisture', lambda: make_world(width, height, 'terrain'), \
+        lambda world: world.init_moisture()
+    yield 'init_biomes', lambda: make_world(width, height, 'moisture'), \
+        lambda world: world.init_biomes()
+    yield 'init_peoples', lambda: make_world(width, height, 'biomes'), \
+        lambda world: world.init_peoples()
+
+    world = make_world(width, height, 'biomes')
+    src, queries = find_queries(world)
+    for kind, dest in sorted(queries.items()):
+        yield 'path_{}'.format(kind), lambda: world, \
+            lambda world, dest=dest: Navigate.path(world, src,
+                lambda _, coord: coord == dest)
+        yield 'astar_{}'.format(kind), lambda: world, \
+            lambda world, dest=dest: Navigate.astar(world, src, dest)
+
+    for count in agent_counts:
+        def step_setup(count=count):
+            world = make_world(width, height, 'peoples')
+            add_settlers(world, count)
+            return world
+
+        def step_run(world):
+            for _ in range(ticks):
+                world.step()
+        yield 'step_{}x{}agents'.format(ticks, count), step_setup, step_run
+
+def measure(setup, run, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        state = setup()
+        start = time.perf_counter()
+        run(state)
+        best = min(best, time.perf_counter() - start)
+
+    state = setup()
+    tracemalloc.start()
+    try:
+        run(state)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'time': best, 'peak_memory': peak}
+
+def run_suite(sizes, agent_counts, ticks, repeat, only=None):
+    results = {}
+    for width, height in sizes:
+        for name, setup, run in cases(width, height, agent_counts, ticks):
+            key = '{}x{}/{}'.format(width, height, name)
+            if only and not any(pattern in key for pattern in only):
+                continue
+            results[key] = measure(setup, run, repeat)
+            print('{:<40} {:>10.4f}s {:>12,d}B'.format(key,
+                results[key]['time'], results[key]['peak_memory']))
+            sys.stdout.flush()
+    return results
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for key, result in sorted(results.items()):
+        previous = baseline.get(key)
+        if previous is None:
+            continue
+        for metric in ('time', 'peak_memory'):
+            if previous[metric] and \
+                result[metric] > previous[metric] * (1 + threshold):
+                regressions.append((key, metric, previous[metric],
+                    result[metric]))
+    return regressions
+
+def parse_sizes(value):
+    return [tuple(int(v) for v in size.split('x'))
+        for size in value.split(',') if size]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='World generation and simulation benchmarks.')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+        help='comma separated WIDTHxHEIGHT world sizes')
+    parser.add_argument('--agents', default=DEFAULT_AGENTS,
+        help='comma separated numbers of extra settlers for the step cases')
+    parser.add_argument('--ticks', type=int, default=DEFAULT_TICKS)
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+    parser.add_argument('--only', action='append',
+        help='only run cases whose name contains this (repeatable)')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='baseline JSON file to compare to')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+        help='allowed slowdown before flagging a regression (0.25 = 25%%)')
+    args = parser.parse_args()
+
+    results = run_suite(parse_sizes(args.sizes),
+        [int(v) for v in args.agents.split(',') if v],
+        args.ticks, args.repeat, args.only)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'meta': {
+                    'python': platform.python_version(),
+                    'numpy': numpy.__version__,
+                    'platform': platform.platform(),
+                    'timestamp': time.time(),
+                    'ticks': args.ticks,
+                    'repeat': args.repeat,
+                },
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        for key, metric, before, after in regressions:
+            print('REGRESSION {} {}: {:.4g} -> {:.4g} ({:+.0%})'.format(
+                key, metric, before, after, after / before - 1))
+        if regressions:
+            sys.exit(1)
+        print('No regressions against {}'.format(args.compare))
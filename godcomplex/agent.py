@@ -1,6 +1,7 @@
 
 import uuid
 import random
+import numpy
 from .biome import Biome
 
 class AgentActionFailed(Exception): pass
@@ -15,12 +16,13 @@ class AgentType:
     SETTLEMENT = 'SETTLEMENT'
 
 SETTLE_RADIUS = 5
+NEW_SETTLER_COST = 1000
 
 class AgentActions:
     def spawn(agent, **kwargs):
         pass
 
-    def wander(agent, **kwargs):
+    def wander(agent, rng=random, **kwargs):
         if agent.agent_type == AgentType.SETTLEMENT:
             return
 
@@ -28,7 +30,7 @@ class AgentActions:
             in agent.world.get_neighbors(*agent.position)
             if Biome.is_passable(agent.world.get_biome(*neighbor))]
         if neighbors:
-            agent.world.move_agent(agent, *random.choice(neighbors))
+            agent.world.move_agent(agent, *rng.choice(neighbors))
         return
 
     def navigate(agent, **kwargs):
@@ -37,26 +39,18 @@ class AgentActions:
     def wait(agent, **kwargs):
         return None
 
-    def settle(agent, **kwargs):
-        if random.random() < 0.9:
+    def settle(agent, rng=random, **kwargs):
+        if rng.random() < 0.9:
             raise PrerequisiteActionsNeeded(AgentActions.wander)
 
-        for dx in range(-SETTLE_RADIUS, SETTLE_RADIUS):
-            for dy in range(-SETTLE_RADIUS, SETTLE_RADIUS):
-                pos = agent.world.get_neighbor(*agent.position,
-                    direction=(dx, dy))
-                if pos and agent.world.get_settlement(*pos):
-                    raise PrerequisiteActionsNeeded(AgentActions.wander)
+        x, y = agent.position
+        if agent.world.spatial_index.query_rect(
+            x - SETTLE_RADIUS, y - SETTLE_RADIUS,
+            2 * SETTLE_RADIUS, 2 * SETTLE_RADIUS,
+            agent_type=AgentType.SETTLEMENT):
+            raise PrerequisiteActionsNeeded(AgentActions.wander)
 
-        settlement = Settlement.copy(agent)
-        settlement.agent_type = AgentType.SETTLEMENT
-        settlement.id = agent.id  # reuse ID -- effectively GCs current agent.
-        settlement.origin = agent.origin
-        settlement.position = agent.position
-        agent.faction.add_settlement(settlement)
-        agent.world.add_pending_agent(settlement)
-        agent.world.set_settlement(*agent.position, val=settlement)
-        agent.world.move_agent(agent, *agent.position)
+        Settlement.found(agent, rng=rng)
         return None
 
     def attack(agent, **kwargs):
@@ -65,16 +59,30 @@ class AgentActions:
     def combine(agent, **kwargs):
         pass
 
+# Agents are plain __slots__ objects identified by small integer ids handed
+# out by their world. Ids are only unique within one world; anything that
+# needs an identifier that is stable outside of it (e.g. persistence) should
+# use Agent.uid, which is only generated on demand.
 class Agent:
+    __slots__ = ('id', 'world', 'queue', 'position', 'origin', 'agent_type',
+        'faction', '_uid')
+
     def __init__(self, world, agent_type, origin=None, faction=None,
-            goals=[]):
-        self.id = uuid.uuid4()
+            goals=None):
+        self.id = world.new_agent_id()
         self.world = world
-        self.queue = goals
+        self.queue = list(goals) if goals else []
         self.position = None
         self.origin = origin
         self.agent_type = agent_type
         self.faction = faction
+        self._uid = None
+
+    @property
+    def uid(self):
+        if self._uid is None:
+            self._uid = uuid.uuid4()
+        return self._uid
 
     @classmethod
     def copy(cls, agent):
@@ -84,6 +92,21 @@ class Agent:
             origin=agent.origin,
             faction=agent.faction)
 
+    def fork(self, world, faction):
+        '''
+        Returns a copy of this agent belonging to `world` and `faction`,
+            with the same id. `origin` still points at the original's origin;
+            it's up to the caller to remap it.
+        '''
+        agent = object.__new__(type(self))
+        for cls in type(self).__mro__:
+            for slot in getattr(cls, '__slots__', ()):
+                setattr(agent, slot, getattr(self, slot))
+        agent.world = world
+        agent.faction = faction
+        agent.queue = list(self.queue)
+        return agent
+
     def __repr__(self, extra=''):
         return '<{} id={} faction={} type={} position={} queue={} {}>' \
             .format(self.__class__.__name__, self.id, self.faction,
@@ -97,8 +120,11 @@ class Agent:
 
     def step(self):
         action = self.queue.pop(0) if len(self.queue) else AgentActions.wander
+        # every action gets its own stream, unique to this agent and tick.
+        rng = self.world.rng.for_agent(self.id,
+            self.world.history.current_timestamp)
         try:
-            result = action(self)
+            result = action(self, rng=rng)
         except PrerequisiteActionsNeeded as e:
             self.queue = list(e.dependencies) + [action] + self.queue
             return (action, e)
@@ -108,38 +134,110 @@ class Agent:
         return (action, None)
 
 class Settlement(Agent):
+    __slots__ = ('population', 'stored_resources')
+
     def __init__(self, world, agent_type, origin=None, faction=None,
-            goals=[]):
+            goals=None, population=None, rng=random):
         super().__init__(world, agent_type, origin, faction, goals)
 
-        self.population = random.randint(100, 500)
+        self.population = (population if population is not None
+            else rng.randint(100, 500))
         self.stored_resources = 0
 
+    # turns the settler `agent` into a settlement on its current cell. the
+    # settlement joins the world at the end of the step.
+    @staticmethod
+    def found(agent, population=None, rng=random):
+        settlement = Settlement(
+            world=agent.world,
+            agent_type=AgentType.SETTLEMENT,
+            origin=agent.origin,
+            faction=agent.faction,
+            population=population,
+            rng=rng)
+        settlement.id = agent.id  # reuse ID -- effectively GCs current agent.
+        settlement._uid = agent._uid
+        settlement.position = agent.position
+        agent.faction.add_settlement(settlement)
+        agent.world.add_pending_agent(settlement)
+        agent.world.move_agent(agent, *agent.position)
+        agent.world.add_settlement(settlement)
+        return settlement
+
     # super hacky initial proof-of-concept population growth simulation
-    def grow(self):
+    def grow(self, rng=random):
         new_resources = (self.population // 8)
 
         # calculate needed resources for growth/stagnation/starvation
-        needed_food = self.population // 10
+        needed_food = max(self.population // 10, 1)
         excess_food = self.stored_resources + new_resources - needed_food
 
-        new_settler_cost = 1000
-        if excess_food > new_settler_cost and random.random() > 0.7:
-            new_agent = Agent.copy(self)
-            new_agent.agent_type = AgentType.SETTLER
-            new_agent.queue = [AgentActions.settle]
-            new_agent.origin = self
-            self.world.add_pending_agent(new_agent)
-            self.world.move_agent(new_agent, *self.position)
-            self.population -= random.randint(100, 500)
-            excess_food -= new_settler_cost
+        if excess_food > NEW_SETTLER_COST and rng.random() > 0.7:
+            self.spawn_settler()
+            self.population -= rng.randint(100, 500)
+            excess_food -= NEW_SETTLER_COST
 
         growth_rate = min(1.03, 1.0 + ((excess_food / needed_food) / 10))
         self.population = int(self.population * growth_rate)
         self.stored_resources = excess_food
 
+    # batch version of grow, applying the same rules to many settlements at
+    # once with array math. returns the settlements that produced a settler;
+    # creating the settler agents is left to the caller (see spawn_settler).
+    # `rng` is a numpy RandomState (or the numpy.random module).
+    @staticmethod
+    def grow_all(settlements, rng=numpy.random):
+        count = len(settlements)
+        if not count:
+            return []
+        population = numpy.fromiter((s.population for s in settlements),
+            dtype=numpy.int64, count=count)
+        stored_resources = numpy.fromiter(
+            (s.stored_resources for s in settlements),
+            dtype=numpy.int64, count=count)
+
+        new_resources = population // 8
+        needed_food = numpy.maximum(population // 10, 1)
+        excess_food = stored_resources + new_resources - needed_food
+
+        spawns = ((excess_food > NEW_SETTLER_COST) &
+            (rng.random_sample(count) > 0.7))
+        population -= numpy.where(spawns,
+            rng.randint(100, 501, size=count), 0)
+        excess_food -= numpy.where(spawns, NEW_SETTLER_COST, 0)
+
+        growth_rate = numpy.minimum(1.03,
+            1.0 + ((excess_food / needed_food) / 10))
+        population = (population * growth_rate).astype(numpy.int64)
+
+        for settlement, pop, resources in zip(settlements,
+            population.tolist(), excess_food.tolist()):
+            settlement.population = pop
+            settlement.stored_resources = resources
+        return [settlements[i] for i in numpy.flatnonzero(spawns).tolist()]
+
+    # returns a copy of the (object) settlement layer `layer`, with every
+    # settlement swapped for its copy in `copies` (keyed by id() of the
+    # original), for forked worlds.
+    @staticmethod
+    def remap_layer(layer, copies):
+        remapped = numpy.full(layer.shape, None, dtype=object)
+        cells = numpy.flatnonzero(layer.astype(bool))
+        remapped.flat[cells] = [copies.get(id(settlement), settlement)
+            for settlement in layer.flat[cells]]
+        return remapped
+
+    def spawn_settler(self):
+        new_agent = Agent.copy(self)
+        new_agent.agent_type = AgentType.SETTLER
+        new_agent.queue = [AgentActions.settle]
+        new_agent.origin = self
+        self.world.add_pending_agent(new_agent)
+        self.world.move_agent(new_agent, *self.position)
+        return new_agent
+
     def step(self):
-        self.grow()
+        self.grow(self.world.rng.get('economy'))
         return super().step()
 
     def __repr__(self):
@@ -1,6 +1,7 @@
 
 import math
 import random
+import numpy
 from .terraform import Terraform
 
 class Biome:
@@ -67,6 +68,52 @@ class Biome:
             else:
                 return Biome.RAINFOREST
 
+    # batch version of determine_biome. latitude, elevation and moisture are
+    # arrays that broadcast against each other (e.g. latitude can be one value
+    # per row). agrees cell-for-cell with determine_biome.
+    @staticmethod
+    def determine_biomes(latitude, elevation, moisture):
+        latitude = numpy.asarray(latitude, dtype=numpy.float64)
+        elevation = numpy.asarray(elevation, dtype=numpy.float64)
+        moisture = numpy.asarray(moisture)
+
+        # the latitude term is computed with math.sin once per distinct
+        # latitude (i.e. once per row), exactly as the scalar version does.
+        latitudes, inverse = numpy.unique(latitude, return_inverse=True)
+        latitude_temp = numpy.array([
+            30 - (40 * (math.sin(math.radians(lat)) ** 2))
+            for lat in latitudes.tolist()]).reshape(-1)[inverse.ravel()]
+        latitude_temp = latitude_temp.reshape(latitude.shape)
+        temp = latitude_temp + (elevation - Terraform.WATER_THRESHOLD - 0.1) * -80
+
+        temp_bin = ((temp > -5).astype(numpy.intp) + (temp > 3) +
+            (temp >= 12) + (temp >= 20))
+        moisture_bin = ((moisture > 1).astype(numpy.intp) + (moisture > 2) +
+            (moisture > 4) + (moisture > 5))
+        biomes = BIOME_TABLE[temp_bin, moisture_bin]
+
+        height_class = numpy.ceil((elevation - Terraform.WATER_THRESHOLD) / 0.15)
+        biomes = numpy.where(
+            (elevation > Terraform.WATER_THRESHOLD) & (height_class >= 3),
+            Biome.MOUNTAIN, biomes)
+        return numpy.where(elevation < Terraform.WATER_THRESHOLD,
+            Biome.OCEAN, biomes)
+
     @staticmethod
     def is_passable(biome):
         return biome != Biome.OCEAN and biome != Biome.MOUNTAIN
+
+# determine_biome's Whittaker diagram as a lookup table, indexed by
+# [temperature bin, moisture bin].
+# temperature bins: <= -5, <= 3, < 12, < 20, >= 20
+# moisture bins: <= 1, <= 2, <= 4, <= 5, > 5
+BIOME_TABLE = numpy.array([
+    [Biome.TUNDRA] * 5,
+    [Biome.GRASSLAND] + [Biome.TAIGA] * 4,
+    [Biome.GRASSLAND, Biome.WOODLAND, Biome.TEMPERATE_FOREST,
+        Biome.TEMPERATE_FOREST, Biome.TEMPERATE_RAINFOREST],
+    [Biome.DESERT, Biome.WOODLAND, Biome.TEMPERATE_FOREST,
+        Biome.TEMPERATE_FOREST, Biome.TEMPERATE_RAINFOREST],
+    [Biome.DESERT, Biome.DESERT, Biome.SAVANNAH,
+        Biome.RAINFOREST, Biome.RAINFOREST],
+])
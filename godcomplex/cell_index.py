@@ -0,0 +1,230 @@
+
+import numpy
+from .biome import Biome
+from .terraform import Terraform
+
+# regions covering at least this fraction of the map rebuild an index rather
+# than update it cell by cell.
+REBUILD_FRACTION = 0.125
+
+# Candidate cell indices for World.random_cell.
+# A CellPredicate is a common condition on cells, evaluated over whole layers
+# (or a region of them) at once. A CellIndex keeps the flat indices of the
+# cells matching one predicate packed at the front of an array, along with
+# each cell's position in it, so that a uniformly random match is one draw
+# away and cells can be added or removed in O(1) (removal swaps the last
+# match into the hole).
+# Indices are kept up to date through a layer listener: a write to a region of
+# a layer the predicate depends on re-tests just that region; a change to the
+# whole layer (or enough region writes to add up to REBUILD_FRACTION of it)
+# marks the index to be rebuilt the next time it's used.
+# Forked indices share their arrays copy-on-write, like layers: neither side
+# copies them until it changes.
+# Conditions that aren't predicates -- arbitrary lambdas -- are still handled
+# by rejection sampling, and so are predicates on chunked layers (indexing
+# them would mean generating the whole map).
+
+class CellPredicate:
+    '''
+    Base class for predicates. `layers` names the layers the predicate reads,
+        and `key` identifies it (predicates with equal keys share an index).
+    '''
+    layers = ()
+
+    @property
+    def key(self):
+        return (type(self).__name__,)
+
+    def evaluate(self, layer):
+        '''
+        Returns the predicate for a block of cells as a bool array. `layer`
+            maps a layer name to that block of the layer (or None if the world
+            doesn't have it).
+        '''
+        raise NotImplementedError
+
+    def test(self, world, x, y):
+        '''
+        Evaluates the predicate for the single cell (x, y).
+        '''
+        return bool(self.evaluate(
+            lambda name: world.get_region(name, x, y, 1, 1)
+                if name in world.layers else None)[0, 0])
+
+    def __repr__(self):
+        return '<{}>'.format(' '.join(str(part) for part in self.key))
+
+class Passable(CellPredicate):
+    '''
+    Cells agents can move through (see Biome.is_passable).
+    '''
+    layers = ('biome',)
+
+    def evaluate(self, layer):
+        biome = layer('biome')
+        return (biome != Biome.OCEAN) & (biome != Biome.MOUNTAIN)
+
+class ElevationBand(CellPredicate):
+    '''
+    Cells with low <= elevation < high. Either bound may be None.
+    '''
+    layers = ('elevation',)
+
+    def __init__(self, low=None, high=None):
+        self.low = low
+        self.high = high
+
+    @property
+    def key(self):
+        return (type(self).__name__, self.low, self.high)
+
+    def evaluate(self, layer):
+        elevation = layer('elevation').astype(numpy.float64)
+        matches = numpy.ones(elevation.shape, dtype=bool)
+        if self.low is not None:
+            matches &= elevation >= self.low
+        if self.high is not None:
+            matches &= elevation < self.high
+        return matches
+
+class BiomeIn(CellPredicate):
+    '''
+    Cells whose biome is one of `biomes`.
+    '''
+    layers = ('biome',)
+
+    def __init__(self, biomes):
+        self.biomes = frozenset(biomes)
+
+    @property
+    def key(self):
+        return (type(self).__name__, tuple(sorted(self.biomes)))
+
+    def evaluate(self, layer):
+        return numpy.isin(layer('biome'), list(self.biomes))
+
+class UnsettledLand(CellPredicate):
+    '''
+    Land cells without a settlement.
+    '''
+    layers = ('elevation', 'settlement')
+
+    def evaluate(self, layer):
+        land = (layer('elevation').astype(numpy.float64) >
+            Terraform.WATER_THRESHOLD)
+        settlement = layer('settlement')
+        if settlement is None:
+            return land
+        return land & ~settlement.astype(bool)
+
+PASSABLE = Passable()
+UNSETTLED_LAND = UnsettledLand()
+
+class CellIndex:
+    def __init__(self, predicate, width, height):
+        self.predicate = predicate
+        self.width = width
+        self.height = height
+        self.cells = numpy.empty(width * height, dtype=numpy.intp)
+        # flat index => position in cells, or -1.
+        self.positions = numpy.full(width * height, -1, dtype=numpy.intp)
+        self.count = 0
+        self.stale = True
+        # regions changed since the last refresh, and their total area.
+        self.regions = []
+        self.pending_area = 0
+        # whether cells and positions are shared with a fork.
+        self.shared = False
+
+    def fork(self):
+        index = object.__new__(CellIndex)
+        index.__dict__.update(self.__dict__)
+        index.regions = list(self.regions)
+        index.shared = self.shared = True
+        return index
+
+    def on_layer_change(self, name, region):
+        if name not in self.predicate.layers or self.stale:
+            return
+        if region is not None:
+            self.pending_area += region[2] * region[3]
+        if region is None or self.pending_area >= \
+            REBUILD_FRACTION * self.width * self.height:
+            self.stale = True
+            self.regions = []
+            self.pending_area = 0
+        else:
+            self.regions.append(region)
+
+    def sample(self, world, rng):
+        '''
+        Returns a uniformly random matching cell as (x, y), or None if there
+            are none. `rng` is a random.Random.
+        '''
+        self.refresh(world)
+        if not self.count:
+            return None
+        y, x = divmod(int(self.cells[rng.randrange(self.count)]), self.width)
+        return (x, y)
+
+    def __len__(self):
+        return self.count
+
+    def refresh(self, world):
+        if self.stale:
+            self._rebuild(world)
+        for region in self.regions:
+            self._update(world, *region)
+        self.regions = []
+        self.pending_area = 0
+
+    def _rebuild(self, world):
+        matches = numpy.flatnonzero(self.predicate.evaluate(
+            lambda name: world.get_layer(name) if name in world.layers
+                else None))
+        if self.shared:
+            # no need to copy arrays that are about to be overwritten.
+            self.cells = numpy.empty_like(self.cells)
+            self.positions = numpy.empty_like(self.positions)
+            self.shared = False
+        self.count = len(matches)
+        self.cells[:self.count] = matches
+        self.positions.fill(-1)
+        self.positions[matches] = numpy.arange(self.count)
+        self.stale = False
+
+    def _update(self, world, x, y, width, height):
+        ys = numpy.arange(y, y + height)
+        xs = numpy.arange(x, x + width) % self.width
+
+        def layer(name):
+            if name not in world.layers:
+                return None
+            return world.get_layer(name)[numpy.ix_(ys, xs)]
+
+        cells = (ys[:, None] * self.width + xs).ravel()
+        matches = self.predicate.evaluate(layer).ravel()
+        indexed = self.positions[cells] >= 0
+        removed = cells[indexed & ~matches]
+        added = cells[matches & ~indexed]
+        if (removed.size or added.size) and self.shared:
+            self.cells = self.cells.copy()
+            self.positions = self.positions.copy()
+            self.shared = False
+        for cell in removed.tolist():
+            self._remove(cell)
+        for cell in added.tolist():
+            self._add(cell)
+
+    def _add(self, cell):
+        self.cells[self.count] = cell
+        self.positions[cell] = self.count
+        self.count += 1
+
+    def _remove(self, cell):
+        position = self.positions[cell]
+        self.count -= 1
+        last = self.cells[self.count]
+        self.cells[position] = last
+        self.positions[last] = position
+        self.positions[cell] = -1
@@ -0,0 +1,213 @@
+
+import collections
+import os
+import tempfile
+import threading
+import numpy
+
+DEFAULT_CHUNK_SIZE = 64
+DEFAULT_MEMORY_BUDGET = 256 << 20
+
+# Chunked layer storage, for worlds too large to hold (or generate) in full.
+# A ChunkedLayer splits a layer into square chunks, each generated by a
+# function of its rectangle the first time it's used. All the chunks of a
+# collection's chunked layers live in one ChunkStore, which keeps them in
+# memory up to a budget of bytes and evicts the least recently used ones past
+# it:
+#   - chunks that haven't been written to since they were generated are just
+#     dropped, and regenerated if they're needed again;
+#   - written-to chunks of plain dtypes are saved to a file, and read back;
+#   - written-to chunks of object layers stay in memory for good (their values
+#     can't be saved without everything they reference), so they don't count
+#     against the budget.
+# Chunks at the right and bottom edges are cut short when the chunk size
+# doesn't divide the map. Rectangles wrap around horizontally, like the rest
+# of the world grid, so neighbouring cells across a chunk edge (including the
+# x = 0 seam) are found the same way as any others.
+
+class ChunkStore:
+    def __init__(self, memory_budget=DEFAULT_MEMORY_BUDGET, directory=None):
+        self.memory_budget = memory_budget
+        # evicted chunks go here; a temporary directory by default.
+        self.directory = directory
+        self._tempdir = None
+        # (layer name, chunk row, chunk column) => chunk, least recently used
+        # first.
+        self.chunks = collections.OrderedDict()
+        self.dirty = set()
+        self.pinned = set()
+        self.saved = set()
+        self.memory = 0
+        self.lock = threading.RLock()
+
+    def get(self, key, generate):
+        '''
+        Returns the chunk for `key`, loading it back or calling `generate()`
+            if it isn't in memory.
+        '''
+        with self.lock:
+            chunk = self.chunks.get(key)
+            if chunk is not None:
+                self.chunks.move_to_end(key)
+                return chunk
+            if key in self.saved:
+                chunk = numpy.load(self._path(key))
+            else:
+                chunk = generate()
+            self.chunks[key] = chunk
+            self.memory += chunk.nbytes
+            self._evict()
+            return chunk
+
+    def discard_layer(self, name):
+        '''
+        Forgets every chunk of layer `name`.
+        '''
+        with self.lock:
+            for key in [key for key in self.chunks if key[0] == name]:
+                chunk = self.chunks.pop(key)
+                if key not in self.pinned:
+                    self.memory -= chunk.nbytes
+            for keys in (self.dirty, self.pinned, self.saved):
+                keys.difference_update(
+                    [key for key in keys if key[0] == name])
+
+    def mark_dirty(self, key, pin=False):
+        with self.lock:
+            if key not in self.chunks:
+                return
+            self.dirty.add(key)
+            if pin and key not in self.pinned:
+                self.pinned.add(key)
+                self.memory -= self.chunks[key].nbytes
+
+    def _evict(self):
+        # the most recently used chunk is the one being asked for.
+        for key in list(self.chunks)[:-1]:
+            if self.memory <= self.memory_budget:
+                break
+            if key in self.pinned:
+                continue
+            chunk = self.chunks.pop(key)
+            self.memory -= chunk.nbytes
+            if key in self.dirty:
+                numpy.save(self._path(key), chunk)
+                self.dirty.discard(key)
+                self.saved.add(key)
+
+    def _path(self, key):
+        if self.directory is None:
+            self._tempdir = tempfile.TemporaryDirectory(prefix='godcomplex-')
+            self.directory = self._tempdir.name
+        return os.path.join(self.directory, '{}_{}_{}.npy'.format(*key))
+
+class ChunkedLayer:
+    '''
+    A (height, width) layer stored in chunks of `chunk_size` x `chunk_size`
+        cells. `generate(x, y, width, height)` returns the array for a
+        rectangle of the layer.
+    '''
+    def __init__(self, store, name, width, height, dtype, generate,
+            chunk_size=DEFAULT_CHUNK_SIZE):
+        self.store = store
+        self.name = name
+        self.width = width
+        self.height = height
+        self.dtype = numpy.dtype(dtype)
+        self.generate = generate
+        self.chunk_size = chunk_size
+
+    @property
+    def shape(self):
+        return (self.height, self.width)
+
+    @property
+    def ndim(self):
+        return 2
+
+    def chunk(self, cy, cx):
+        size = self.chunk_size
+
+        def generate():
+            x, y = cx * size, cy * size
+            width = min(size, self.width - x)
+            height = min(size, self.height - y)
+            chunk = numpy.empty((height, width), dtype=self.dtype)
+            chunk[...] = self.generate(x, y, width, height)
+            return chunk
+
+        return self.store.get((self.name, cy, cx), generate)
+
+    def item(self, y, x):
+        size = self.chunk_size
+        return self.chunk(y // size, x // size).item(y % size, x % size)
+
+    def __getitem__(self, key):
+        y, x = key
+        size = self.chunk_size
+        return self.chunk(y // size, x // size)[y % size, x % size]
+
+    def __setitem__(self, key, value):
+        if key is Ellipsis:
+            self.write(0, 0, numpy.broadcast_to(
+                numpy.asarray(value, dtype=self.dtype), self.shape))
+            return
+        y, x = key
+        size = self.chunk_size
+        self.chunk(y // size, x // size)[y % size, x % size] = value
+        self.mark_dirty(x, y)
+
+    def mark_dirty(self, x, y):
+        '''
+        Marks the chunk containing (x, y) as written to, e.g. after one of its
+            object values was mutated in place.
+        '''
+        size = self.chunk_size
+        self.store.mark_dirty((self.name, y // size, x // size),
+            pin=self.dtype == object)
+
+    def read(self, x, y, width, height):
+        '''
+        Returns a copy of the rectangle with top-left corner (x, y), which
+            must lie within the top and bottom edges. It wraps around
+            horizontally.
+        '''
+        values = numpy.empty((height, width), dtype=self.dtype)
+        for (cy, cx), chunk_rows, chunk_cols, rows, cols in \
+            self._blocks(x, y, width, height):
+            values[rows, cols] = self.chunk(cy, cx)[chunk_rows, chunk_cols]
+        return values
+
+    def write(self, x, y, values):
+        height, width = values.shape
+        for (cy, cx), chunk_rows, chunk_cols, rows, cols in \
+            self._blocks(x, y, width, height):
+            self.chunk(cy, cx)[chunk_rows, chunk_cols] = values[rows, cols]
+            self.store.mark_dirty((self.name, cy, cx),
+                pin=self.dtype == object)
+
+    def __array__(self, dtype=None, copy=None):
+        values = self.read(0, 0, self.width, self.height)
+        return values if dtype is None else values.astype(dtype)
+
+    def _blocks(self, x, y, width, height):
+        # yields, for every chunk the rectangle overlaps, the chunk's
+        # coordinates, the slices of the chunk that overlap and the matching
+        # slices of the rectangle.
+        size = self.chunk_size
+        row = 0
+        while row < height:
+            gy = y + row
+            cy = gy // size
+            rows = min(size - gy % size, height - row)
+            col = 0
+            while col < width:
+                gx = (x + col) % self.width
+                cx = gx // size
+                cols = min(size - gx % size, self.width - gx, width - col)
+                yield ((cy, cx),
+                    slice(gy % size, gy % size + rows),
+                    slice(gx % size, gx % size + cols),
+                    slice(row, row + rows), slice(col, col + cols))
+                col += cols
+            row += rows
@@ -0,0 +1,284 @@
+
+import contextlib
+import os
+import queue
+import sqlite3
+import threading
+
+DEFAULT_POOL_SIZE = 4
+# prepared statements kept per connection.
+STATEMENT_CACHE_SIZE = 128
+DEFAULT_BATCH_SIZE = 1 << 12
+
+# Data access over the SQLite store (worldgen.db).
+# Reference tables -- data the simulation only reads, like the peoples -- are
+# bulk-loaded into memory with a single query the first time they're needed,
+# and looked up there from then on, so nothing on the step path goes to the
+# database.
+# Other reads go through a pool of read-only connections that any thread can
+# borrow one from; every connection keeps a cache of its prepared statements,
+# so repeated queries aren't parsed again. A Database can instead wrap a
+# single connection opened by the caller (which is what World has always
+# taken); queries on it are serialized through a lock.
+# Simulation state is written through a BatchWriter: rows are buffered and
+# written a batch at a time, each batch in one transaction, on a connection in
+# WAL mode, so that readers of the file aren't blocked by the writer.
+# Connections don't survive a fork() (see parallel.py): a pool used in a forked
+# child opens its own instead of the ones it inherited.
+
+class ConnectionPool:
+    '''
+    Up to `size` connections to the database file at `path`, read-only
+        unless `readonly` is False. Connections are opened as they're needed.
+    '''
+    def __init__(self, path, size=DEFAULT_POOL_SIZE, readonly=True):
+        self.path = path
+        self.size = size
+        self.readonly = readonly
+        self._idle = queue.LifoQueue()
+        self._num_open = 0
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        # connections inherited from the parent process, kept out of the way
+        # rather than closed under it.
+        self._inherited = []
+
+    @contextlib.contextmanager
+    def connection(self):
+        '''
+        Borrows a connection for the duration of a with block, waiting for one
+            to be returned if all `size` are in use.
+        '''
+        db = self._acquire()
+        try:
+            yield db
+        finally:
+            self._release(db)
+
+    def close(self):
+        with self._lock:
+            while True:
+                try:
+                    db = self._idle.get_nowait()
+                except queue.Empty:
+                    break
+                db.close()
+                self._num_open -= 1
+
+    def _acquire(self):
+        self._check_process()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            opens = self._num_open < self.size
+            if opens:
+                self._num_open += 1
+        if not opens:
+            return self._idle.get()
+        try:
+            return self._open()
+        except Exception:
+            with self._lock:
+                self._num_open -= 1
+            raise
+
+    def _release(self, db):
+        if self._pid == os.getpid():
+            self._idle.put(db)
+
+    def _check_process(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._inherited.append(self._idle)
+                self._idle = queue.LifoQueue()
+                self._num_open = 0
+
+    def _open(self):
+        if self.readonly:
+            return sqlite3.connect('file:{}?mode=ro'.format(self.path),
+                uri=True, check_same_thread=False,
+                cached_statements=STATEMENT_CACHE_SIZE)
+        return sqlite3.connect(self.path, check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE)
+
+class ReferenceTable:
+    '''
+    A table held in memory in full, keyed by the first column of the rows
+        its QUERY selects (which keep the order they were selected in).
+    '''
+    QUERY = None
+
+    def __init__(self, rows):
+        self.rows = {row[0]: tuple(row) for row in rows}
+
+    def keys(self):
+        return list(self.rows)
+
+    def __getitem__(self, key):
+        return self.rows[key]
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+class PeoplesTable(ReferenceTable):
+    QUERY = 'SELECT name, warlike_factor FROM peoples'
+
+    def warlike_factor(self, name):
+        return self.rows[name][1]
+
+class Database:
+    '''
+    The SQLite store: either the database file at `path`, read through a
+        ConnectionPool of `pool_size` read-only connections, or an already
+        open `connection`.
+    '''
+    def __init__(self, path=None, connection=None,
+            pool_size=DEFAULT_POOL_SIZE):
+        if (path is None) == (connection is None):
+            raise ValueError('Database takes either a path or a connection')
+        self.path = path
+        self.pool = (ConnectionPool(path, pool_size) if path is not None
+            else None)
+        self._connection = connection
+        self._connection_lock = threading.RLock()
+        # ReferenceTable subclass => loaded table.
+        self._tables = {}
+        self._tables_lock = threading.Lock()
+
+    @staticmethod
+    def of(db):
+        '''
+        Returns `db` as a Database: a Database as is, a path to the database
+            file or an sqlite3 connection wrapped in one. None stays None.
+        '''
+        if db is None or isinstance(db, Database):
+            return db
+        if isinstance(db, sqlite3.Connection):
+            return Database(connection=db)
+        return Database(path=db)
+
+    @contextlib.contextmanager
+    def connection(self):
+        '''
+        A connection to query for the duration of a with block.
+        '''
+        if self.pool is not None:
+            with self.pool.connection() as db:
+                yield db
+        else:
+            with self._connection_lock:
+                yield self._connection
+
+    def query(self, sql, parameters=()):
+        '''
+        Returns every row `sql` selects, as a list of tuples.
+        '''
+        with self.connection() as db:
+            return db.execute(sql, parameters).fetchall()
+
+    def table(self, table_class):
+        '''
+        Returns the ReferenceTable of class `table_class`, loading it on
+            first use.
+        '''
+        with self._tables_lock:
+            table = self._tables.get(table_class)
+            if table is None:
+                table = table_class(self.query(table_class.QUERY))
+                self._tables[table_class] = table
+            return table
+
+    @property
+    def peoples(self):
+        return self.table(PeoplesTable)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+
+class BatchWriter:
+    '''
+    Writes to the database file at `path` in batches: rows added for a
+        statement are buffered, and every `batch_size` rows the buffer is
+        written out in one transaction. Statements run in the order their
+        rows were added. Can be used as a context manager, which flushes and
+        closes it on the way out.
+    '''
+    def __init__(self, path, batch_size=DEFAULT_BATCH_SIZE):
+        self.db = BatchWriter.connect(path)
+        self.batch_size = batch_size
+        # [sql, rows] runs, in order.
+        self.pending = []
+        self.num_pending = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def connect(path):
+        '''
+        Opens a connection to write to `path`, in WAL mode. (Temporary and
+            in-memory databases can't use WAL, and stay in their own mode.)
+        '''
+        db = sqlite3.connect(path, check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE)
+        db.execute('PRAGMA journal_mode=WAL')
+        # in WAL mode, only a checkpoint needs to wait for the disk.
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    def execute(self, sql, parameters=()):
+        '''
+        Runs `sql` right away (e.g. to create a table), after the pending
+            rows.
+        '''
+        with self.lock:
+            self._flush()
+            with self.db:
+                self.db.execute(sql, parameters)
+
+    def add(self, sql, row):
+        self.add_many(sql, [row])
+
+    def add_many(self, sql, rows):
+        rows = list(rows)
+        with self.lock:
+            if self.pending and self.pending[-1][0] == sql:
+                self.pending[-1][1].extend(rows)
+            else:
+                self.pending.append([sql, rows])
+            self.num_pending += len(rows)
+            if self.num_pending >= self.batch_size:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _flush(self):
+        if not self.pending:
+            return
+        with self.db:
+            for sql, rows in self.pending:
+                self.db.executemany(sql, rows)
+        self.pending = []
+        self.num_pending = 0
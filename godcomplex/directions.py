@@ -12,5 +12,5 @@ class Directions:
         return [Directions.NORTH, Directions.SOUTH, Directions.EAST, Directions.WEST]
 
     @staticmethod
-    def random():
-        return random.choice(Directions.all())
+    def random(rng=random):
+        return rng.choice(Directions.all())
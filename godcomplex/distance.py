@@ -0,0 +1,66 @@
+
+import numpy
+from .topology import Topology
+
+# Distance fields over the world grid.
+# Cells are addressed by flat index (y * width + x), matching the row-major
+# layout of the layer arrays. The grid wraps around horizontally but not
+# vertically, the same as World.get_neighbors.
+
+class DistanceField:
+    @staticmethod
+    def nearest_source(width, height, sources, passable=None, wrap=True):
+        '''
+        Multi-source breadth-first search over the 4-connected grid.
+        `sources` is a sequence of flat cell indices. Ties between sources are
+            broken the same way as a FIFO queue seeded with `sources` in the
+            given order would break them.
+        `passable` is an optional boolean (height, width) array. Impassable
+            cells (including impassable sources) are never visited.
+        Without `wrap`, the grid doesn't wrap around horizontally.
+        Returns a pair of (height, width) int arrays: the number of steps to
+            the nearest source, and the flat index of that source. Both are -1
+            for cells that no source can reach.
+        The search is run one BFS level at a time over numpy arrays, so every
+            cell is touched a constant number of times.
+        '''
+        size = width * height
+        distance = numpy.full(size, -1, dtype=numpy.int64)
+        nearest = numpy.full(size, -1, dtype=numpy.int64)
+        if passable is None:
+            passable = numpy.ones(size, dtype=bool)
+        else:
+            passable = numpy.asarray(passable, dtype=bool).ravel()
+
+        frontier = numpy.asarray(sources, dtype=numpy.int64).ravel()
+        frontier = DistanceField._first_occurrences(frontier)
+        frontier = frontier[passable[frontier]]
+        distance[frontier] = 0
+        nearest[frontier] = frontier
+
+        topology = Topology.of(width, height, wrap=wrap)
+        level = 0
+        while frontier.size:
+            level += 1
+            candidates, owners = topology.neighbors_of(frontier)
+            fresh = (distance[candidates] < 0) & passable[candidates]
+            candidates = candidates[fresh]
+            owners = owners[fresh]
+
+            keep = DistanceField._first_occurrence_index(candidates)
+            frontier = candidates[keep]
+            distance[frontier] = level
+            nearest[frontier] = nearest[owners[keep]]
+
+        return (distance.reshape(height, width),
+            nearest.reshape(height, width))
+
+    @staticmethod
+    def _first_occurrence_index(values):
+        _, first = numpy.unique(values, return_index=True)
+        first.sort()
+        return first
+
+    @staticmethod
+    def _first_occurrences(values):
+        return values[DistanceField._first_occurrence_index(values)]
@@ -8,14 +8,26 @@ colors = list(COLORS)
 random.shuffle(colors)
 
 class Faction:
-    def __init__(self, people, name=None):
+    def __init__(self, people, name=None, color=None):
         self.people = people
-        self.color = colors.pop(0)
+        self.color = color if color is not None else colors.pop(0)
         self.settlements = set()
 
         # TODO: better random name generation, obviously
         self.name = 'The First Tribe of {}'.format(string.capwords(people.name))
 
+    def fork(self):
+        '''
+        Returns a copy of this faction with no settlements, for a forked
+            world to fill in with its own.
+        '''
+        faction = Faction.__new__(Faction)
+        faction.people = self.people
+        faction.color = self.color
+        faction.name = self.name
+        faction.settlements = set()
+        return faction
+
     def add_settlement(self, settlement):
         self.settlements.add(settlement)
 
@@ -0,0 +1,117 @@
+
+import heapq
+import numpy
+from .navigate import Path
+from .topology import Topology
+
+# Flow fields: one search from a set of destinations, shared by every agent
+# heading there. The field stores, for each cell, the cost of the cheapest
+# route to the nearest destination and the next cell along that route, so
+# reading an agent's next step is a single lookup.
+# Cells are flat indices (y * width + x), as in Navigate._grid_search.
+
+class FlowField:
+    def __init__(self, width, height, distance, next_cell):
+        self.width = width
+        self.height = height
+        # (height, width) arrays. distance is inf and next_cell is -1 for
+        # cells that can't reach a destination; destinations point at
+        # themselves.
+        self.distance = distance
+        self.next_cell = next_cell
+        self._next = next_cell.ravel().tolist()
+
+    @classmethod
+    def build(cls, width, height, dests, costs):
+        '''
+        Runs a reverse Dijkstra from the flat cell indices `dests` over
+            `costs`, a flat list of per-cell move costs (the cost of moving
+            into that cell).
+        '''
+        inf = float('inf')
+        size = width * height
+        neighbors = Topology.of(width, height).neighbors
+        distance = [inf] * size
+        next_cell = [-1] * size
+        q = []
+        for dest in dests:
+            if distance[dest] > 0:
+                distance[dest] = 0
+                next_cell[dest] = dest
+                q.append((0, dest))
+        heapq.heapify(q)
+
+        done = [False] * size
+        while q:
+            d, index = heapq.heappop(q)
+            if done[index]:
+                continue
+            done[index] = True
+            step_cost = costs[index]
+            if step_cost == inf:
+                # nobody can move into this cell, so nothing routes via it.
+                continue
+            new_dist = d + step_cost
+
+            for neighbor in neighbors(index):
+                if new_dist < distance[neighbor]:
+                    distance[neighbor] = new_dist
+                    next_cell[neighbor] = index
+                    heapq.heappush(q, (new_dist, neighbor))
+
+        return cls(width, height,
+            numpy.array(distance).reshape(height, width),
+            numpy.array(next_cell, dtype=numpy.int64).reshape(height, width))
+
+    def next_step(self, x, y):
+        '''
+        Returns the cell to move to from (x, y), (x, y) itself if it is a
+            destination, or None if no destination can be reached.
+        '''
+        index = self._next[y * self.width + x]
+        if index < 0:
+            return None
+        return (index % self.width, index // self.width)
+
+    def distance_to(self, x, y):
+        return self.distance.item(y, x)
+
+    def path(self, x, y):
+        '''
+        Follows the field from (x, y) to its destination, as a Path.
+        '''
+        if self._next[y * self.width + x] < 0:
+            return None
+        index = y * self.width + x
+        waypoints = [(x, y)]
+        while self._next[index] != index:
+            index = self._next[index]
+            waypoints.append((index % self.width, index // self.width))
+        return Path(tuple(waypoints), self.distance_to(x, y))
+
+class FlowFieldCache:
+    '''
+    A bounded LRU cache of flow fields for one world, keyed by destination
+        and cost model. Each entry remembers the versions of the layers it was
+        built from and is rebuilt once any of them changes. The world is
+        passed to get rather than kept, so that the cache (held in a
+        WeakKeyDictionary keyed by the world) doesn't keep it alive.
+    '''
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.fields = {}
+
+    def get(self, world, key, depends_on, build):
+        versions = tuple(world.get_layer_version(name)
+            for name in depends_on)
+        entry = self.fields.pop(key, None)
+        if entry is None or entry[0] != versions:
+            entry = (versions, build())
+        # dicts keep insertion order, so re-inserting marks it most recent.
+        self.fields[key] = entry
+        while len(self.fields) > self.max_size:
+            del self.fields[next(iter(self.fields))]
+        return entry[1]
+
+    def clear(self):
+        self.fields.clear()
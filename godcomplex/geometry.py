@@ -7,3 +7,11 @@ class Geometry:
         x1, y1 = cell1
         x2, y2 = cell2
         return math.sqrt((abs(x2 - x1) ** 2) + (abs(y2 - y1) ** 2))
+
+    # distance on the world's cylinder, which wraps around at x = width.
+    @staticmethod
+    def wrapped_distance_2d(cell1, cell2, width):
+        x1, y1 = cell1
+        x2, y2 = cell2
+        dx = abs(x2 - x1) % width
+        return math.sqrt((min(dx, width - dx) ** 2) + (abs(y2 - y1) ** 2))
@@ -1,27 +1,282 @@
 
+import numpy
+from .database import BatchWriter
+from .subscription import Subscription, EventFilter, DROP_OLDEST, \
+    DEFAULT_MAX_QUEUE
+
+# Columnar event log.
+# Events are stored as four integer columns (timestamp, agent id, action code,
+# result code) rather than as objects, so recording an event doesn't keep its
+# agent alive. The most recent events live in fixed-size numpy ring buffers;
+# once those fill up, the oldest SPILL_BATCH_SIZE events are written to SQLite
+# in one executemany, so memory use stays constant however long the
+# simulation runs. Queries read the spilled rows through the table's indexes
+# and the buffered ones with array masks. A spill database that's a file is
+# written in WAL mode (see BatchWriter.connect), so it can be read while the
+# simulation runs.
+# Actions and results are interned into small integer codes on first sight:
+# an action is the AgentActions function that was run, and a result is the
+# name of the exception it failed with (RESULT_OK when it didn't).
+
+DEFAULT_BUFFER_SIZE = 1 << 16
+SPILL_BATCH_SIZE = 1 << 14
+RESULT_OK = 0
+
+COLUMNS = ('timestamp', 'agent_id', 'action', 'result')
+DTYPES = (numpy.int64, numpy.int64, numpy.uint16, numpy.uint16)
 
 class History:
-    def __init__(self, timestamp=1):
-        self.events = []
+    def __init__(self, timestamp=1, buffer_size=DEFAULT_BUFFER_SIZE,
+            spill_db=''):
         self.current_timestamp = timestamp
+        self.buffer_size = buffer_size
+        self.columns = {name: numpy.zeros(buffer_size, dtype=dtype)
+            for name, dtype in zip(COLUMNS, DTYPES)}
+        self._head = 0  # buffer index of the oldest buffered event
+        self._count = 0  # number of buffered events
+        self.num_spilled = 0
+
+        self.actions = []  # action code -> action
+        self._action_codes = {}
+        self.results = [None]  # result code -> exception name
+        self._result_codes = {None: RESULT_OK}
+
+        # the default, an empty filename, is a private on-disk database that
+        # sqlite deletes when it's closed.
+        self.spill_db = spill_db
+        self._db = None
+        # for forks, the (history, number of events) whose spilled events are
+        # copied over the first time the database is needed.
+        self._spilled_from = None
+        self.subscriptions = []
 
     def advance(self, incr=1):
         self.current_timestamp += incr
 
     def record(self, agent, action, result=None):
-        evt = HistoricalEvent(self.current_timestamp, agent, action, result)
-        self.events.append(evt)
+        if self._count == self.buffer_size:
+            self._spill(min(SPILL_BATCH_SIZE, self._count))
+
+        index = (self._head + self._count) % self.buffer_size
+        self.columns['timestamp'][index] = self.current_timestamp
+        self.columns['agent_id'][index] = agent.id
+        self.columns['action'][index] = self.action_code(action)
+        self.columns['result'][index] = self.result_code(result)
+        self._count += 1
+
+        if self.subscriptions:
+            event = None
+            for subscription in self.subscriptions:
+                if subscription.matches(agent, action):
+                    event = event or HistoricalEvent(self.current_timestamp,
+                        agent.id, action,
+                        self.results[self.result_code(result)])
+                    subscription.push(event)
+
+    def subscribe(self, callback=None, actions=None, factions=None,
+            agent_types=None, region=None, max_queue=DEFAULT_MAX_QUEUE,
+            overflow=DROP_OLDEST):
+        '''
+        Subscribes to the events recorded from now on, optionally only those
+            of the given actions, factions, agent types and/or (x, y, width,
+            height) region. Events are passed to `callback` as they're
+            recorded if it's given, and otherwise queued on the returned
+            Subscription (see subscription.py), which can be drained or
+            iterated with `async for`.
+        '''
+        subscription = Subscription(self,
+            EventFilter(actions, factions, agent_types, region),
+            callback=callback, max_queue=max_queue, overflow=overflow)
+        self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        if subscription in self.subscriptions:
+            self.subscriptions.remove(subscription)
+
+    def action_code(self, action):
+        code = self._action_codes.get(action)
+        if code is None:
+            code = self._action_codes[action] = len(self.actions)
+            self.actions.append(action)
+        return code
+
+    def result_code(self, result):
+        name = type(result).__name__ if result is not None else None
+        code = self._result_codes.get(name)
+        if code is None:
+            code = self._result_codes[name] = len(self.results)
+            self.results.append(name)
+        return code
+
+    def __len__(self):
+        return self.num_spilled + self._count
+
+    @property
+    def events(self):
+        '''
+        Every recorded event, oldest first. This reads back everything that
+            was spilled, so prefer recent() or query() on long histories.
+        '''
+        return self.query()
+
+    def recent(self, n):
+        '''
+        Returns the last `n` events, oldest first.
+        '''
+        if n <= 0:
+            return []
+        rows = self._buffered(numpy.ones(self._count, dtype=bool))[-n:]
+        if len(rows) < n and self.num_spilled:
+            spilled = self._select('ORDER BY seq DESC LIMIT ?',
+                (n - len(rows),))
+            rows = spilled[::-1] + rows
+        return [self._event(row) for row in rows]
+
+    def query(self, start=None, end=None, agent_id=None, action=None):
+        '''
+        Returns the events with `start` <= timestamp < `end` (either bound
+            may be omitted), optionally only those of agent `agent_id` and/or
+            of the given action, oldest first.
+        '''
+        action_code = None
+        if action is not None:
+            action_code = self._action_codes.get(action)
+            if action_code is None:
+                return []
+
+        clauses, params = [], []
+        mask = numpy.ones(self._count, dtype=bool)
+        buffered = self._ordered()
+        for column, op, value in (('timestamp', '>=', start),
+                ('timestamp', '<', end),
+                ('agent_id', '=', agent_id),
+                ('action', '=', action_code)):
+            if value is None:
+                continue
+            clauses.append('{} {} ?'.format(column, op))
+            params.append(value)
+            values = buffered[column]
+            mask &= {'>=': values >= value, '<': values < value,
+                '=': values == value}[op]
+
+        rows = []
+        if self.num_spilled:
+            rows = self._select(('WHERE ' + ' AND '.join(clauses)
+                if clauses else '') + ' ORDER BY seq', params)
+        return [self._event(row) for row in rows + self._buffered(mask)]
+
+    def fork(self):
+        '''
+        Returns an independent copy of this history, without its
+            subscriptions. Spilled events are only copied over once the copy
+            needs its database.
+        '''
+        history = History(self.current_timestamp, self.buffer_size)
+        history.columns = {name: column.copy()
+            for name, column in self.columns.items()}
+        history._head = self._head
+        history._count = self._count
+        history.num_spilled = self.num_spilled
+        history.actions = list(self.actions)
+        history._action_codes = dict(self._action_codes)
+        history.results = list(self.results)
+        history._result_codes = dict(self._result_codes)
+        if self.num_spilled:
+            history._spilled_from = (self, self.num_spilled)
+        return history
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _ordered(self):
+        # the buffered columns, oldest first.
+        indices = (self._head + numpy.arange(self._count)) % self.buffer_size
+        return {name: column[indices]
+            for name, column in self.columns.items()}
+
+    def _buffered(self, mask):
+        buffered = self._ordered()
+        return list(zip(*(buffered[name][mask].tolist()
+            for name in COLUMNS)))
+
+    def _select(self, where, params):
+        return [tuple(row) for row in self._connect().execute(
+            'SELECT timestamp, agent_id, action, result FROM events ' + where,
+            params)]
+
+    def _event(self, row):
+        timestamp, agent_id, action, result = row
+        return HistoricalEvent(timestamp, agent_id, self.actions[action],
+            self.results[result])
+
+    def _connect(self):
+        if self._db is None and self._spilled_from is not None:
+            source, num_spilled = self._spilled_from
+            self._spilled_from = None
+            self._db = BatchWriter.connect(self.spill_db)
+            source._connect().backup(self._db)
+            with self._db:
+                # drop whatever the source spilled after the fork.
+                self._db.execute('DELETE FROM events WHERE seq >= ?',
+                    (num_spilled,))
+        if self._db is None:
+            self._db = BatchWriter.connect(self.spill_db)
+            self._db.executescript('''
+                CREATE TABLE IF NOT EXISTS events (
+                    seq INTEGER PRIMARY KEY,
+                    timestamp INTEGER NOT NULL,
+                    agent_id INTEGER NOT NULL,
+                    action INTEGER NOT NULL,
+                    result INTEGER NOT NULL);
+                CREATE INDEX IF NOT EXISTS events_timestamp
+                    ON events (timestamp);
+                CREATE INDEX IF NOT EXISTS events_agent
+                    ON events (agent_id, timestamp);
+                CREATE INDEX IF NOT EXISTS events_action
+                    ON events (action, timestamp);
+                CREATE TABLE IF NOT EXISTS codes (
+                    kind TEXT NOT NULL,
+                    code INTEGER NOT NULL,
+                    name TEXT,
+                    PRIMARY KEY (kind, code));
+            ''')
+        return self._db
+
+    def _spill(self, n):
+        # writes the `n` oldest buffered events to the database.
+        indices = (self._head + numpy.arange(n)) % self.buffer_size
+        rows = zip(range(self.num_spilled, self.num_spilled + n),
+            *(self.columns[name][indices].tolist() for name in COLUMNS))
+
+        db = self._connect()
+        with db:
+            db.executemany('INSERT INTO events VALUES (?, ?, ?, ?, ?)', rows)
+            # keep the code tables alongside, for anyone reading the file.
+            db.executemany('INSERT OR REPLACE INTO codes VALUES (?, ?, ?)',
+                [('action', code, getattr(action, '__name__', str(action)))
+                    for code, action in enumerate(self.actions)] +
+                [('result', code, name)
+                    for code, name in enumerate(self.results)])
+
+        self._head = (self._head + n) % self.buffer_size
+        self._count -= n
+        self.num_spilled += n
 
 class HistoricalEvent:
-    def __init__(self, timestamp, agent, action, result=None):
+    __slots__ = ('timestamp', 'agent_id', 'action', 'result')
+
+    def __init__(self, timestamp, agent_id, action, result=None):
         self.timestamp = timestamp
-        self.agent = agent
+        self.agent_id = agent_id
         self.action = action
         self.result = result
 
     def __repr__(self):
         return '<HistoricalEvent ts={} agent={} action={} result={}>'.format(
             self.timestamp,
-            self.agent,
-            self.action,
+            self.agent_id,
+            getattr(self.action, '__name__', self.action),
             self.result)
@@ -0,0 +1,311 @@
+
+import heapq
+import math
+import numpy
+from .navigate import Navigate, MIN_MOVE_COST
+from .topology import Topology
+
+# Hierarchical pathfinding (HPA*).
+# The world is divided into square clusters. Wherever two neighbouring
+# clusters share a run of passable cells along their border, one or two
+# "entrance" cell pairs are placed on that run. The abstract graph has the
+# entrance cells as its nodes, with an edge across each entrance pair and an
+# edge between every pair of entrances of the same cluster that can reach
+# each other inside it. Long queries are answered on this much smaller graph,
+# and the cell-level path is only worked out (one cluster at a time) once
+# somebody asks for the waypoints.
+# Cells are flat indices (y * width + x), as in Navigate._grid_search.
+
+DEFAULT_CLUSTER_SIZE = 16
+# runs of passable border cells at least this long get an entrance at each
+# end instead of one in the middle.
+LONG_ENTRANCE = 6
+
+class AbstractGraph:
+    # the graph doesn't keep a reference to its world, which would keep the
+    # world alive through Navigate's cache of graphs.
+    def __init__(self, world, cluster_size=DEFAULT_CLUSTER_SIZE):
+        self.width = world.width
+        self.height = world.height
+        self.cluster_size = cluster_size
+        self.topology = Topology.of(self.width, self.height)
+        self.clusters_x = int(math.ceil(self.width / cluster_size))
+        self.clusters_y = int(math.ceil(self.height / cluster_size))
+
+        x = numpy.arange(self.width) // cluster_size
+        y = numpy.arange(self.height) // cluster_size
+        self.cluster_of = (y[:, None] * self.clusters_x + x[None, :]).ravel() \
+            .tolist()
+
+        self.version = None
+        self.grid = None
+        self.costs = None
+        # (cluster, cluster) => [(cell, cell)], one per entrance.
+        self.borders = {}
+        # cluster => {entrance: [(entrance, cost)]}
+        self.intra = {}
+        # entrance => [(entrance, cost)], crossing into another cluster.
+        self.inter = {}
+        self.update(world)
+
+    def update(self, world):
+        '''
+        Brings the graph in line with `world`'s current movement costs.
+            Only clusters whose costs changed, plus the clusters bordering
+            them, are rebuilt.
+        '''
+        version = world.get_layer_version('biome')
+        if self.grid is not None and version == self.version:
+            return self
+
+        grid, costs = Navigate._cost_grid(world)
+        if self.grid is None:
+            dirty = set(range(self.clusters_x * self.clusters_y))
+        else:
+            changed = numpy.flatnonzero((grid != self.grid).ravel())
+            dirty = set(self.cluster_of[i] for i in changed.tolist())
+        self.version = version
+        self.grid = grid.copy()
+        self.costs = costs
+
+        if dirty:
+            self._rebuild(dirty)
+        return self
+
+    def _cluster_coords(self, cluster):
+        return cluster % self.clusters_x, cluster // self.clusters_x
+
+    def _cluster_id(self, cx, cy):
+        return cy * self.clusters_x + (cx % self.clusters_x)
+
+    def _adjacent_clusters(self, cluster):
+        cx, cy = self._cluster_coords(cluster)
+        adjacent = set()
+        if self.clusters_x > 1:
+            adjacent.add(self._cluster_id(cx - 1, cy))
+            adjacent.add(self._cluster_id(cx + 1, cy))
+        if cy > 0:
+            adjacent.add(self._cluster_id(cx, cy - 1))
+        if cy < self.clusters_y - 1:
+            adjacent.add(self._cluster_id(cx, cy + 1))
+        adjacent.discard(cluster)
+        return adjacent
+
+    def _rebuild(self, dirty):
+        affected = set(dirty)
+        for cluster in dirty:
+            affected |= self._adjacent_clusters(cluster)
+
+        for cluster in dirty:
+            cx, cy = self._cluster_coords(cluster)
+            if self.clusters_x > 1:
+                self._find_entrances(cluster, self._cluster_id(cx + 1, cy))
+                self._find_entrances(self._cluster_id(cx - 1, cy), cluster)
+            if cy < self.clusters_y - 1:
+                self._find_entrances(cluster, self._cluster_id(cx, cy + 1))
+            if cy > 0:
+                self._find_entrances(self._cluster_id(cx, cy - 1), cluster)
+
+        self.inter = {}
+        for pairs in self.borders.values():
+            for a, b in pairs:
+                self.inter.setdefault(a, []).append((b, self.costs[b]))
+                self.inter.setdefault(b, []).append((a, self.costs[a]))
+
+        for cluster in affected:
+            entrances = self.entrances(cluster)
+            edges = {}
+            for entrance in entrances:
+                dist, _ = self.local_search(entrance, cluster)
+                edges[entrance] = [(other, dist[other]) for other in entrances
+                    if other != entrance and other in dist]
+            self.intra[cluster] = edges
+
+    def _find_entrances(self, first, second):
+        # `second` is the cluster right of or below `first`.
+        width = self.width
+        fx, fy = self._cluster_coords(first)
+        sx, sy = self._cluster_coords(second)
+        size = self.cluster_size
+        if fy == sy:
+            x = min((fx + 1) * size, width) - 1
+            next_x = (x + 1) % width
+            pairs = [(y * width + x, y * width + next_x)
+                for y in range(fy * size, min((fy + 1) * size, self.height))]
+        else:
+            y = min((fy + 1) * size, self.height) - 1
+            pairs = [(y * width + x, (y + 1) * width + x)
+                for x in range(fx * size, min((fx + 1) * size, width))]
+
+        inf = float('inf')
+        entrances = []
+        run = []
+        for a, b in pairs + [(None, None)]:
+            if a is not None and self.costs[a] < inf and self.costs[b] < inf:
+                run.append((a, b))
+                continue
+            if len(run) >= LONG_ENTRANCE:
+                entrances += [run[0], run[-1]]
+            elif run:
+                entrances.append(run[len(run) // 2])
+            run = []
+        self.borders[(first, second)] = entrances
+
+    def entrances(self, cluster):
+        nodes = set()
+        for other in self._adjacent_clusters(cluster):
+            nodes.update(a for a, _ in self.borders.get((cluster, other), []))
+            nodes.update(b for _, b in self.borders.get((other, cluster), []))
+        return sorted(nodes)
+
+    def local_search(self, start, cluster, target=None, reverse=False):
+        '''
+        Dijkstra from `start` that never leaves `cluster`. Returns the
+            distance and parent dicts. With `reverse`, distances are measured
+            from each cell *to* `start` instead.
+        '''
+        costs = self.costs
+        cluster_of = self.cluster_of
+        inf = float('inf')
+        dist = {start: 0}
+        parents = {start: None}
+        done = set()
+        q = [(0, start)]
+        while q:
+            d, index = heapq.heappop(q)
+            if index in done:
+                continue
+            done.add(index)
+            if index == target:
+                break
+            for neighbor in self.topology.neighbors(index):
+                if cluster_of[neighbor] != cluster or costs[neighbor] == inf:
+                    continue
+                new_dist = d + (costs[index] if reverse else costs[neighbor])
+                if new_dist < dist.get(neighbor, inf):
+                    dist[neighbor] = new_dist
+                    parents[neighbor] = index
+                    heapq.heappush(q, (new_dist, neighbor))
+        return {i: dist[i] for i in done}, parents
+
+    def local_path(self, start, end, cluster):
+        _, parents = self.local_search(start, cluster, target=end)
+        path = []
+        node = end
+        while node is not None:
+            path.append(node)
+            node = parents[node]
+        path.reverse()
+        return path
+
+    def search(self, src, dest):
+        '''
+        Finds the cheapest route from cell `src` to cell `dest` on the abstract
+            graph. Returns (cost, nodes), where nodes runs from src to dest
+            through the entrances used, or None if there is no route.
+        '''
+        inf = float('inf')
+        if src == dest:
+            return (0, [src, dest])
+        if self.costs[dest] == inf:
+            return None
+        if self.costs[src] == inf:
+            # agents can start on cells nobody can move into, e.g. taiga.
+            # such cells aren't part of any entrance, so route from each of
+            # their neighbours instead.
+            best = None
+            for neighbor in self.topology.neighbors(src):
+                if self.costs[neighbor] == inf:
+                    continue
+                result = self.search(neighbor, dest)
+                if result is not None:
+                    cost = result[0] + self.costs[neighbor]
+                    if best is None or cost < best[0]:
+                        best = (cost, [src] + result[1])
+            return best
+
+        src_cluster = self.cluster_of[src]
+        dest_cluster = self.cluster_of[dest]
+        best = None
+        if src_cluster == dest_cluster:
+            dist, _ = self.local_search(src, src_cluster, target=dest)
+            if dest in dist:
+                best = (dist[dest], [src, dest])
+
+        exits, _ = self.local_search(src, src_cluster)
+        entries, _ = self.local_search(dest, dest_cluster, reverse=True)
+        starts = [(exits[e], e) for e in self.entrances(src_cluster)
+            if e in exits]
+        ends = {e: entries[e] for e in self.entrances(dest_cluster)
+            if e in entries}
+
+        width = self.width
+        dest_y, dest_x = divmod(dest, width)
+
+        def heuristic(index):
+            y, x = divmod(index, width)
+            dx = abs(x - dest_x)
+            return MIN_MOVE_COST * (min(dx, width - dx) + abs(y - dest_y))
+
+        # abstract A*. the source and destination cells are the start and end
+        # of the search, but only the entrances are expanded.
+        dist = {}
+        parents = {}
+        q = []
+        for cost, entrance in starts:
+            if cost < dist.get(entrance, inf):
+                dist[entrance] = cost
+                parents[entrance] = None
+                heapq.heappush(q, (cost + heuristic(entrance), cost, entrance))
+        done = set()
+        found = None
+        while q:
+            priority, cost, node = heapq.heappop(q)
+            if best is not None and priority >= best[0]:
+                break
+            if node in done:
+                continue
+            done.add(node)
+            if node in ends:
+                total = cost + ends[node]
+                if best is None or total < best[0]:
+                    best = (total, None)
+                    found = node
+            edges = self.intra.get(self.cluster_of[node], {}).get(node, []) + \
+                self.inter.get(node, [])
+            for neighbor, edge_cost in edges:
+                new_cost = cost + edge_cost
+                if new_cost < dist.get(neighbor, inf):
+                    dist[neighbor] = new_cost
+                    parents[neighbor] = node
+                    heapq.heappush(q,
+                        (new_cost + heuristic(neighbor), new_cost, neighbor))
+
+        if best is None:
+            return None
+        if found is None or best[1] is not None:
+            return best
+
+        nodes = []
+        node = found
+        while node is not None:
+            nodes.append(node)
+            node = parents[node]
+        nodes.reverse()
+        return (best[0], [src] + nodes + [dest])
+
+    def refine(self, nodes):
+        '''
+        Expands the abstract route returned by search into a list of cells.
+        '''
+        cells = [nodes[0]]
+        for a, b in zip(nodes, nodes[1:]):
+            if a == b:
+                continue
+            cluster = self.cluster_of[a]
+            if cluster != self.cluster_of[b]:
+                # an entrance pair, which are always adjacent cells.
+                cells.append(b)
+            else:
+                cells += self.local_path(a, b, cluster)[1:]
+        return cells
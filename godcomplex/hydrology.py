@@ -0,0 +1,206 @@
+
+import collections
+import heapq
+import math
+import numpy
+
+NO_DIRECTION = 255
+# D8 neighbour offsets (dx, dy), indexed by flow direction code.
+D8_OFFSETS = ((-1, -1), (0, -1), (1, -1), (-1, 0), (1, 0), (-1, 1), (0, 1),
+    (1, 1))
+D8_DISTANCES = numpy.array([math.hypot(dx, dy) for dx, dy in D8_OFFSETS])
+
+# Surface water drainage over the world grid.
+# Water flows from every land cell to one of its 8 neighbours (D8), and
+# drains into the sea (cells at or below the water threshold). The pipeline:
+#   1. depression filling: a priority flood raises every closed basin to the
+#      level of its spill point, so that every land cell has a way down to the
+#      sea. Cells that already have one are found by following steepest
+#      descent; only the rest go through the flood.
+#   2. flow directions: each cell drains to its steepest downhill neighbour on
+#      the filled surface; on the flats left by filling, towards the cell it
+#      was flooded from, which always leads back out.
+#   3. flow accumulation: the number of cells draining through each cell,
+#      computed in topological order, one wave of cells at a time (a cell is
+#      ready once everything upstream of it is).
+#   4. watersheds: every cell is labelled with the sea cell it drains into.
+# Like the rest of the world grid, everything wraps around in x but not in y.
+# The priority flood is the only per-cell loop; it's O(n log n) in the number
+# of cells that go through its heap, and linear in the ones in depressions.
+# Everything else is vectorized.
+
+class Drainage:
+    '''
+    The result of Hydrology.drain. All arrays are (height, width):
+        filled          the depression-filled surface
+        direction       the D8 flow direction code (see D8_OFFSETS), or
+                        NO_DIRECTION for sea and other outlet cells (and
+                        the lowest cell of a world without sea)
+        receiver        the flat index of the cell drained into, or -1
+        accumulation    the number of land cells draining through each
+                        cell, itself included
+        watershed       a compact watershed id per land cell, -1 for sea
+    '''
+    def __init__(self, filled, direction, receiver, accumulation, watershed):
+        self.filled = filled
+        self.direction = direction
+        self.receiver = receiver
+        self.accumulation = accumulation
+        self.watershed = watershed
+
+class Hydrology:
+    @staticmethod
+    def d8_neighbors(width, height, wrap=True):
+        '''
+        Returns a (height * width, 8) array of the flat indices of every
+            cell's neighbours in D8_OFFSETS order, -1 past the top and bottom
+            edges (and the left and right ones, without `wrap`).
+        '''
+        ys, xs = numpy.divmod(numpy.arange(width * height), width)
+        neighbors = numpy.empty((width * height, 8), dtype=numpy.int64)
+        for i, (dx, dy) in enumerate(D8_OFFSETS):
+            ny = ys + dy
+            nx = xs + dx
+            inside = (ny >= 0) & (ny < height)
+            if not wrap:
+                inside &= (nx >= 0) & (nx < width)
+            neighbors[:, i] = numpy.where(inside, ny * width + nx % width, -1)
+        return neighbors
+
+    @staticmethod
+    def drain(elevation, sea_level, wrap=True, outlets=None):
+        '''
+        Runs the drainage pipeline over a (height, width) elevation array.
+            Cells at or below `sea_level` are sea. Without `wrap`, the array
+            doesn't wrap around horizontally. `outlets` is an optional bool
+            array of more cells that water drains out through, like sea (e.g.
+            the edges of a part of the map). Returns a Drainage.
+        '''
+        height, width = elevation.shape
+        size = width * height
+        elevation = numpy.asarray(elevation, dtype=numpy.float64).ravel()
+        neighbors = Hydrology.d8_neighbors(width, height, wrap)
+        land = elevation > sea_level
+        sea = ~land
+        if outlets is not None:
+            sea |= numpy.asarray(outlets, dtype=bool).ravel()
+        if not sea.any():
+            # without sea, everything drains to the lowest cell.
+            sea[numpy.argmin(elevation)] = True
+
+        # cells with a downhill path to the sea need no filling: only the ones
+        # draining into pits go through the flood.
+        receiver = Hydrology._flow_directions(elevation, neighbors, sea)
+        _, waves = Hydrology._accumulate(receiver, None)
+        outlet = Hydrology._outlets(receiver, waves)
+        undrained = ~sea[outlet]
+        filled = elevation
+        if undrained.any():
+            filled, parent = Hydrology._fill(elevation, neighbors, undrained)
+            receiver = Hydrology._flow_directions(filled, neighbors, sea,
+                fallback=parent)
+        accumulation, waves = Hydrology._accumulate(receiver,
+            land.astype(numpy.int64))
+        outlet = Hydrology._outlets(receiver, waves)
+
+        watershed = numpy.full(size, -1, dtype=numpy.int32)
+        _, watershed[land] = numpy.unique(outlet[land], return_inverse=True)
+        # direction codes, from the receiver's offset.
+        direction = numpy.full(size, NO_DIRECTION, dtype=numpy.uint8)
+        drains = receiver >= 0
+        direction[drains] = numpy.argmax(
+            neighbors[drains] == receiver[drains, None], axis=1)
+
+        shape = (height, width)
+        return Drainage(filled.reshape(shape), direction.reshape(shape),
+            receiver.reshape(shape), accumulation.reshape(shape),
+            watershed.reshape(shape))
+
+    @staticmethod
+    def _fill(elevation, neighbors, undrained):
+        # priority flood of the undrained cells, from the drained ones around
+        # them. cells reached at or below the level they were reached from are
+        # in a depression: they're raised to that level, and go through a
+        # plain FIFO queue instead of the heap. returns the filled surface and
+        # the cell each undrained cell was reached from.
+        shore = numpy.flatnonzero(~undrained & (undrained[neighbors] &
+            (neighbors >= 0)).any(axis=1))
+        cells = numpy.concatenate([shore, numpy.flatnonzero(undrained)])
+        neighbor_lists = dict(zip(cells.tolist(), neighbors[cells].tolist()))
+        levels = elevation.tolist()
+        closed = (~undrained).tolist()
+        parents = {}
+
+        heap = list(zip(elevation[shore].tolist(), shore.tolist()))
+        heapq.heapify(heap)
+        pit = collections.deque()
+        while heap or pit:
+            if pit:
+                cell = pit.popleft()
+            else:
+                _, cell = heapq.heappop(heap)
+            level = levels[cell]
+            for neighbor in neighbor_lists[cell]:
+                if neighbor < 0 or closed[neighbor]:
+                    continue
+                closed[neighbor] = True
+                parents[neighbor] = cell
+                if levels[neighbor] <= level:
+                    levels[neighbor] = level
+                    pit.append(neighbor)
+                else:
+                    heapq.heappush(heap, (levels[neighbor], neighbor))
+
+        parent = numpy.full(len(elevation), -1, dtype=numpy.int64)
+        parent[list(parents)] = list(parents.values())
+        return numpy.array(levels), parent
+
+    @staticmethod
+    def _flow_directions(surface, neighbors, sea, fallback=None):
+        # each cell's steepest downhill neighbour, or `fallback` (by default,
+        # -1) where there's none. sea cells drain nowhere.
+        size = len(surface)
+        valid = neighbors >= 0
+        drop = numpy.where(valid,
+            surface[:, None] - surface[numpy.where(valid, neighbors, 0)],
+            -numpy.inf)
+        drop /= D8_DISTANCES
+        steepest = numpy.argmax(drop, axis=1)
+        rows = numpy.arange(size)
+        receiver = numpy.where(drop[rows, steepest] > 0,
+            neighbors[rows, steepest], -1 if fallback is None else fallback)
+        receiver[sea] = -1
+        return receiver
+
+    @staticmethod
+    def _accumulate(receiver, weights):
+        # Kahn's algorithm, a wave of ready cells at a time: every cell comes
+        # in a later wave than everything upstream of it. returns the
+        # accumulated weights (if any) and the waves, in order.
+        size = len(receiver)
+        accumulation = None if weights is None else weights.copy()
+        drains = receiver >= 0
+        pending = numpy.bincount(receiver[drains], minlength=size)
+        wave = numpy.flatnonzero(pending == 0)
+        waves = []
+        while wave.size:
+            waves.append(wave)
+            wave = wave[drains[wave]]
+            downstream = receiver[wave]
+            if accumulation is not None:
+                numpy.add.at(accumulation, downstream, accumulation[wave])
+            numpy.subtract.at(pending, downstream, 1)
+            downstream = numpy.unique(downstream)
+            wave = downstream[pending[downstream] == 0]
+        return accumulation, waves
+
+    @staticmethod
+    def _outlets(receiver, waves):
+        # the cell every cell ends up draining into, labelled downstream
+        # first.
+        outlet = numpy.arange(len(receiver))
+        for wave in reversed(waves):
+            downstream = receiver[wave]
+            drains = downstream >= 0
+            outlet[wave[drains]] = outlet[downstream[drains]]
+        return outlet
@@ -1,5 +1,8 @@
 
+import copy
 import itertools
+import numpy
+from .chunks import ChunkStore, ChunkedLayer, DEFAULT_CHUNK_SIZE
 
 # An abstract object consisting of a collection of "layers", which in aggregate
 # represent all the known information about some two-dimensional object (e.g.
@@ -10,18 +13,128 @@ import itertools
 # _add_layer, _get_layer_value, _set_layer_value API.
 # For convenience, _add_layer also adds the helper getter/setter methods to the
 # object itself.
+#
+# Each layer is stored as a contiguous (height, width) numpy array with its own
+# dtype, so that whole-layer passes can be vectorized. Layers holding arbitrary
+# Python values (sets of agent ids, settlement objects) use dtype=object.
+# The bulk accessors (get_layer, get_region) return views wherever numpy can
+# express one, for reading. Writes must go through _own_layer, set_layer or
+# set_region instead: after _share_layers, the views are read-only (in both
+# collections), and a chunked layer's are copies.
+# Every write made through this API bumps the layer's entry in layer_versions,
+# which lets derived data (e.g. movement cost grids) know when to rebuild.
+# Code that writes into the array _own_layer returns should call _touch_layer
+# afterwards.
+# Listeners added with add_layer_listener are told about every such write,
+# along with the (x, y, width, height) rectangle that changed, or None when
+# the whole layer may have.
+#
+# Layers can be shared copy-on-write with another collection (see
+# _share_layers, used by World.fork). A shared layer is exposed as a read-only
+# view, and the first write made through this API copies it. Since that copy
+# is shallow for object layers, their cells are also copied individually the
+# first time they're mutated in place.
+# Layers can also be deferred (see _defer_layer): they're only built when
+# first looked up.
+# Or chunked (see _add_chunked_layer and chunks.py): generated a chunk at a
+# time as cells are accessed, and kept in memory only up to the chunk store's
+# budget. Cell and region accessors work on them unchanged; get_layer has to
+# assemble the whole map, so it returns a copy. Chunked layers can't be shared.
+
+class LayerDict(dict):
+    '''
+    A dict of layers that builds deferred layers on first access.
+    '''
+    def __init__(self):
+        super().__init__()
+        self.deferred = {}
+
+    def __missing__(self, name):
+        build = self.deferred.pop(name, None)
+        if build is None:
+            raise KeyError(name)
+        layer = self[name] = build()
+        return layer
+
+    def __contains__(self, name):
+        return super().__contains__(name) or name in self.deferred
 
 class LayerCollection:
     def __init__(self, width, height):
         self.width = width
         self.height = height
-        self.layers = {}
+        self.layers = LayerDict()
+        self.layer_versions = {}
+        # names of the layers whose storage is shared with another collection.
+        self._shared_layers = set()
+        # for shared object layers, the cells whose value this collection has
+        # its own copy of.
+        self._owned_cells = {}
+        self._layer_listeners = []
+        # holds the chunks of chunked layers, created with the first one.
+        self.chunk_store = None
+
+    def _add_layer(self, name, full_layer=None, defaultval=0.0, dtype=None):
+        if dtype is None:
+            dtype = object if defaultval is None else numpy.float64
+        dtype = numpy.dtype(dtype)
+
+        if full_layer is None:
+            layer = numpy.full((self.height, self.width), defaultval,
+                dtype=dtype)
+        elif dtype == object:
+            # numpy.asarray would try to unpack nested containers, so object
+            # layers are filled row by row instead.
+            layer = numpy.empty((self.height, self.width), dtype=object)
+            for y, row in enumerate(full_layer):
+                for x, val in enumerate(row):
+                    layer[y, x] = val
+        else:
+            layer = numpy.ascontiguousarray(full_layer, dtype=dtype)
 
-    def _add_layer(self, name, full_layer=None, defaultval=0.0):
-        layer = full_layer or [[defaultval for x in range(self.width)]
-            for y in range(self.height)]
+        if layer.shape != (self.height, self.width):
+            raise ValueError('Layer {} has shape {}, expected {}'.format(
+                name, layer.shape, (self.height, self.width)))
         self.layers[name] = layer
+        self._shared_layers.discard(name)
+        self._owned_cells.pop(name, None)
+        self._touch_layer(name)
+        self._add_layer_accessors(name)
 
+    def _defer_layer(self, name, build):
+        '''
+        Adds layer `name` without building it yet: `build` is called to
+            produce the (height, width) array the first time it's used.
+        '''
+        self.layers.pop(name, None)
+        self.layers.deferred[name] = build
+        self._shared_layers.discard(name)
+        self._owned_cells.pop(name, None)
+        self._touch_layer(name)
+        self._add_layer_accessors(name)
+
+    def _add_chunked_layer(self, name, generate, dtype,
+            chunk_size=DEFAULT_CHUNK_SIZE):
+        '''
+        Adds layer `name`, stored in chunks that are only generated when one
+            of their cells is first accessed: `generate(x, y, width, height)`
+            returns the array for a rectangle of the layer.
+        '''
+        if self.chunk_store is None:
+            self.chunk_store = ChunkStore()
+        self.chunk_store.discard_layer(name)
+        self.layers.deferred.pop(name, None)
+        self.layers[name] = ChunkedLayer(self.chunk_store, name, self.width,
+            self.height, dtype, generate, chunk_size)
+        self._shared_layers.discard(name)
+        self._owned_cells.pop(name, None)
+        self._touch_layer(name)
+        self._add_layer_accessors(name)
+
+    def is_chunked(self, name):
+        return isinstance(self.layers.get(name), ChunkedLayer)
+
+    def _add_layer_accessors(self, name):
         # HACK: adding helper methods to make code cleaner.
         # It's a bit unfortunate that the set of layers will be a bit implicit,
         # but I think it's fine for now.
@@ -34,15 +147,134 @@ class LayerCollection:
 
     def _get_layer_value(self, name, x, y):
         try:
-            return self.layers[name][y][x]
+            # item() hands back a plain Python scalar rather than a numpy one.
+            return self.layers[name].item(y, x)
         except KeyError:
             return None
 
     def _set_layer_value(self, name, x, y, val):
-        self.layers[name][y][x] = val
+        self._own_layer(name)[y, x] = val
+        self._touch_layer(name, (x, y, 1, 1))
 
     def _mutate_layer_value(self, name, x, y, fn):
-        fn(self.layers[name][y][x])
+        layer = self._own_layer(name)
+        owned = self._owned_cells.get(name)
+        if owned is not None and (x, y) not in owned:
+            layer[y, x] = copy.copy(layer[y, x])
+            owned.add((x, y))
+        fn(layer[y, x])
+        if isinstance(layer, ChunkedLayer):
+            layer.mark_dirty(x, y)
+        self._touch_layer(name, (x, y, 1, 1))
+
+    def _own_layer(self, name):
+        # returns the layer's storage, first copying it if it's shared.
+        layer = self.layers[name]
+        if name in self._shared_layers:
+            layer = self.layers[name] = layer.copy()
+            self._shared_layers.discard(name)
+        return layer
+
+    def _share_layers(self, other):
+        '''
+        Gives `other` every (built) layer of this collection, shared
+            copy-on-write: both keep reading the same storage until one of
+            them writes to a layer, which then gets its own copy.
+        '''
+        for name in list(dict.keys(self.layers)):
+            if isinstance(self.layers[name], ChunkedLayer):
+                raise ValueError(
+                    'Chunked layer {} can\'t be shared'.format(name))
+        for name in list(dict.keys(self.layers)):
+            layer = self.layers[name].view()
+            layer.flags.writeable = False
+            self.layers[name] = layer
+            other.layers[name] = layer.view()
+            for collection in (self, other):
+                collection._shared_layers.add(name)
+                if layer.dtype == object:
+                    collection._owned_cells[name] = set()
+                else:
+                    collection._owned_cells.pop(name, None)
+            other._add_layer_accessors(name)
+        other.layer_versions.update(self.layer_versions)
+
+    def _touch_layer(self, name, region=None):
+        self.layer_versions[name] = self.layer_versions.get(name, 0) + 1
+        for listener in self._layer_listeners:
+            listener(name, region)
+
+    def add_layer_listener(self, listener):
+        '''
+        Calls `listener(name, region)` after every write to a layer, where
+            `region` is the (x, y, width, height) rectangle that changed (it
+            may extend past the right edge, wrapping around), or None if the
+            whole layer may have.
+        '''
+        self._layer_listeners.append(listener)
+
+    def remove_layer_listener(self, listener):
+        self._layer_listeners.remove(listener)
+
+    def get_layer_version(self, name):
+        return self.layer_versions.get(name)
 
     def _all_cells(self):
         return itertools.product(range(self.width), range(self.height))
+
+    def get_layer(self, name):
+        '''
+        Returns the whole layer as a (height, width) array, for reading.
+            This is the layer's own storage, not a copy (read-only while it's
+            shared), but for chunked layers, which are assembled into a copy;
+            write with set_layer, set_region or _own_layer instead.
+        '''
+        layer = self.layers[name]
+        if isinstance(layer, ChunkedLayer):
+            return numpy.asarray(layer)
+        return layer
+
+    def set_layer(self, name, values):
+        '''
+        Overwrites every cell of an existing layer. `values` is anything
+            broadcastable to (height, width).
+        '''
+        self._own_layer(name)[...] = values
+        self._touch_layer(name)
+
+    def get_region(self, name, x, y, width, height):
+        '''
+        Returns the `width` x `height` rectangle with top-left corner (x, y).
+            Rectangles are clipped to the top/bottom edges and wrap around
+            horizontally. A rectangle that doesn't cross the x = 0 seam is
+            returned as a view; one that does can't be expressed as a view and
+            is returned as a copy.
+        '''
+        layer = self.layers[name]
+        rows = slice(max(y, 0), min(y + height, self.height))
+        x = x % self.width
+        if isinstance(layer, ChunkedLayer):
+            return layer.read(x, rows.start, width,
+                max(rows.stop - rows.start, 0))
+        if x + width <= self.width:
+            return layer[rows, x:x + width]
+        cols = numpy.arange(x, x + width) % self.width
+        return layer[rows][:, cols]
+
+    def set_region(self, name, x, y, values):
+        '''
+        Writes a rectangle of values with top-left corner (x, y), using the
+            same clipping and wrapping rules as get_region.
+        '''
+        layer = self._own_layer(name)
+        values = numpy.asarray(values, dtype=layer.dtype)
+        height, width = values.shape
+        top = max(y, 0)
+        bottom = min(y + height, self.height)
+        values = values[top - y:bottom - y]
+        if isinstance(layer, ChunkedLayer):
+            layer.write(x % self.width, top, values)
+        else:
+            cols = numpy.arange(x, x + width) % self.width
+            layer[top:bottom, cols] = values
+        self._touch_layer(name, (x % self.width, top, width, bottom - top))
@@ -1,6 +1,9 @@
 
 import heapq
+import weakref
+import numpy
 from .biome import Biome
+from .topology import Topology
 
 BIOME_COSTS = {
     frozenset([Biome.GRASSLAND, Biome.WOODLAND, Biome.SHRUBLAND]): 1,
@@ -10,11 +13,36 @@ BIOME_COSTS = {
     frozenset([Biome.DESERT, Biome.TUNDRA]): 4
 }
 
+# BIOME_COSTS flattened to biome => cost, and as an array indexed by biome.
+# biomes that don't appear in BIOME_COSTS are impassable.
+MOVE_COSTS = {biome: cost for biomes, cost in BIOME_COSTS.items()
+    for biome in biomes}
+MOVE_COST_TABLE = numpy.full(Biome.OCEAN + 1, numpy.inf)
+for _biome, _cost in MOVE_COSTS.items():
+    MOVE_COST_TABLE[_biome] = _cost
+MIN_MOVE_COST = min(MOVE_COSTS.values())
+
+# world => (biome layer version, cost grid, cost grid as a flat list)
+_cost_grids = weakref.WeakKeyDictionary()
+# world => {cluster size => hpa.AbstractGraph}
+_abstract_graphs = weakref.WeakKeyDictionary()
+# world => flow.FlowFieldCache
+_flow_fields = weakref.WeakKeyDictionary()
+FLOW_FIELD_CACHE_SIZE = 32
+
+# `waypoints` can also be a zero-argument callable, in which case the waypoints
+# are only worked out the first time they're needed.
 class Path:
     def __init__(self, waypoints, cost):
-        self.waypoints = waypoints
+        self._waypoints = waypoints
         self.cost = cost
 
+    @property
+    def waypoints(self):
+        if callable(self._waypoints):
+            self._waypoints = tuple(self._waypoints())
+        return self._waypoints
+
     def __repr__(self):
         return '<Path cost={} waypoints={}>'.format(
             self.cost, self.waypoints)
@@ -25,11 +53,30 @@ class Path:
 class Navigate:
     @staticmethod
     def get_move_cost(world, coord):
-        biome = world.get_biome(*coord)
-        for biomes, cost in BIOME_COSTS.items():
-            if biome in biomes:
-                return cost
-        return float('inf')
+        return MOVE_COSTS.get(world.get_biome(*coord), float('inf'))
+
+    @staticmethod
+    def cost_grid(world):
+        '''
+        Returns a (height, width) float array with the cost of moving into
+            each cell (inf for impassable cells). The grid is built from the
+            biome layer once and reused until that layer changes.
+        '''
+        return Navigate._cost_grid(world)[0]
+
+    @staticmethod
+    def _cost_grid(world):
+        version = world.get_layer_version('biome')
+        cached = _cost_grids.get(world)
+        if cached is None or cached[0] != version:
+            grid = MOVE_COST_TABLE[world.get_layer('biome')]
+            # plain ints keep Path.cost an int, and list indexing is much
+            # cheaper than numpy scalar indexing in the search loop.
+            costs = [int(c) if c < float('inf') else c
+                for c in grid.ravel().tolist()]
+            cached = (version, grid, costs)
+            _cost_grids[world] = cached
+        return cached[1], cached[2]
 
     @staticmethod
     def path(world, src, is_dest, get_neighbors=None,
@@ -47,25 +94,180 @@ class Navigate:
         `get_cost` is an optional closure with signature of
             world, tuple<int, int> => number, which lets callers define custom
             cost functions for movement. It defaults to Navigate.get_move_cost.
+        When neither `get_neighbors` nor `get_cost` is given, the search runs
+            over the world's cached cost grid instead of calling back per
+            cell. Use Navigate.astar when the destination is a single cell.
         '''
 
+        if get_neighbors is None and get_cost is None:
+            return Navigate._grid_search(world, src,
+                lambda index: is_dest(world, divmod(index, world.width)[::-1]))
+
         get_neighbors = (get_neighbors or
             (lambda world, coord: world.get_neighbors(*coord)))
         get_cost = (get_cost or Navigate.get_move_cost)
 
-        q = [(0, tuple([src]))]
-        prev_costs = {}
+        q = [(0, src)]
+        best = {src: 0}
+        parents = {src: None}
+        done = set()
         while q:
-            path_cost, path = heapq.heappop(q)
-            coord = path[-1]
-            if prev_costs.get(coord, float('inf')) <= path_cost:
+            path_cost, coord = heapq.heappop(q)
+            if coord in done:
                 continue
-            prev_costs[coord] = path_cost
+            done.add(coord)
             if is_dest(world, coord):
-                return Path(path, path_cost)
+                return Path(Navigate._walk_back(parents, coord), path_cost)
             for neighbor in get_neighbors(world, coord):
                 move_cost = get_cost(world, neighbor)
-                if move_cost < float('inf'):
-                    heapq.heappush(q,
-                        (path_cost + move_cost, path + tuple([neighbor])))
+                new_cost = path_cost + move_cost
+                if (move_cost < float('inf') and
+                    new_cost < best.get(neighbor, float('inf'))):
+                    best[neighbor] = new_cost
+                    parents[neighbor] = coord
+                    heapq.heappush(q, (new_cost, neighbor))
+        return None
+
+    @staticmethod
+    def astar(world, src, dest):
+        '''
+        A* search from `src` to the single cell `dest` over the world's cost
+            grid. The heuristic is the x-wrapping Manhattan distance times the
+            cheapest move cost, which never overestimates on the cylinder.
+        Returns a Path, or None if `dest` can't be reached.
+        '''
+        width = world.width
+        dest_x, dest_y = dest
+        dest_index = dest_y * width + dest_x
+
+        def heuristic(index):
+            y, x = divmod(index, width)
+            dx = abs(x - dest_x)
+            return MIN_MOVE_COST * (min(dx, width - dx) + abs(y - dest_y))
+
+        return Navigate._grid_search(world, src,
+            lambda index: index == dest_index, heuristic, dest_index)
+
+    @staticmethod
+    def hierarchical_path(world, src, dest, cluster_size=None):
+        '''
+        HPA* search from `src` to the single cell `dest`. The route is found on
+            a cached abstract graph of cluster entrances (see hpa.py), which is
+            patched cluster by cluster when the biome layer changes.
+            The returned Path's cost is known up front, but its waypoints are
+            only refined into cells when first read.
+        Routes can be slightly costlier than Navigate.astar's, since they are
+            forced through entrance cells.
+        Returns a Path, or None if `dest` can't be reached.
+        '''
+        from .hpa import AbstractGraph, DEFAULT_CLUSTER_SIZE
+        cluster_size = cluster_size or DEFAULT_CLUSTER_SIZE
+        graphs = _abstract_graphs.setdefault(world, {})
+        graph = graphs.get(cluster_size)
+        if graph is None:
+            graph = graphs[cluster_size] = AbstractGraph(world, cluster_size)
+        graph.update(world)
+
+        width = world.width
+        result = graph.search(src[1] * width + src[0],
+            dest[1] * width + dest[0])
+        if result is None:
+            return None
+        cost, nodes = result
+        return Path(lambda: [divmod(i, width)[::-1]
+            for i in graph.refine(nodes)], cost)
+
+    @staticmethod
+    def flow_field(world, dests=None, is_dest=None, get_cost=None,
+        depends_on=('biome',)):
+        '''
+        Returns a flow.FlowField towards the nearest of a set of destinations,
+            from which any number of agents can read their next step.
+        The destinations are either `dests`, an iterable of cells, or every
+            cell for which `is_dest` (same signature as in Navigate.path) is
+            true.
+        `get_cost` is an optional closure with the same signature as in
+            Navigate.path. It defaults to the world's cached cost grid.
+        Fields are cached per world, keyed by the destinations (or the
+            `is_dest` closure itself, so pass the same closure to share a
+            field) and `get_cost`. A cached field is rebuilt once any of the
+            layers named in `depends_on` changes.
+        '''
+        from .flow import FlowField, FlowFieldCache
+        cache = _flow_fields.get(world)
+        if cache is None:
+            cache = _flow_fields[world] = FlowFieldCache(FLOW_FIELD_CACHE_SIZE)
+
+        if dests is not None:
+            dests = frozenset(dests)
+            key = (dests, get_cost)
+        else:
+            key = (is_dest, get_cost)
+
+        def build():
+            width = world.width
+            if dests is not None:
+                targets = [y * width + x for x, y in dests]
+            else:
+                targets = [y * width + x for x, y in world._all_cells()
+                    if is_dest(world, (x, y))]
+            if get_cost is None:
+                _, costs = Navigate._cost_grid(world)
+            else:
+                costs = [get_cost(world, divmod(i, width)[::-1])
+                    for i in range(width * world.height)]
+            return FlowField.build(width, world.height, sorted(targets), costs)
+
+        return cache.get(world, key, depends_on, build)
+
+    @staticmethod
+    def _grid_search(world, src, is_dest, heuristic=None, dest=None):
+        # best-first search over flat cell indices with parent pointers.
+        # is_dest and heuristic both take a flat index.
+        _, costs = Navigate._cost_grid(world)
+        width, height = world.width, world.height
+        neighbors = Topology.of(width, height).neighbors
+        inf = float('inf')
+
+        if dest is not None and costs[dest] == inf and \
+            dest != src[1] * width + src[0]:
+            return None
+
+        start = src[1] * width + src[0]
+        best = {start: 0}
+        parents = {start: None}
+        done = set()
+        q = [(heuristic(start) if heuristic else 0, 0, start)]
+        while q:
+            _, neg_cost, index = heapq.heappop(q)
+            if index in done:
+                continue
+            done.add(index)
+            path_cost = -neg_cost
+            if is_dest(index):
+                waypoints = [divmod(i, width)[::-1]
+                    for i in Navigate._walk_back(parents, index)]
+                return Path(tuple(waypoints), path_cost)
+
+            for neighbor in neighbors(index):
+                move_cost = costs[neighbor]
+                if move_cost == inf:
+                    continue
+                new_cost = path_cost + move_cost
+                if new_cost < best.get(neighbor, inf):
+                    best[neighbor] = new_cost
+                    parents[neighbor] = index
+                    priority = new_cost + (heuristic(neighbor)
+                        if heuristic else 0)
+                    # ties go to the deeper node.
+                    heapq.heappush(q, (priority, -new_cost, neighbor))
         return None
+
+    @staticmethod
+    def _walk_back(parents, node):
+        path = []
+        while node is not None:
+            path.append(node)
+            node = parents[node]
+        path.reverse()
+        return tuple(path)
@@ -1,5 +1,6 @@
 
 from noise import pnoise2, snoise2, snoise4
+import numpy
 import random
 
 class NoiseUtil:
@@ -18,3 +19,26 @@ class NoiseUtil:
             z / (freq * scalex),
             w / (freq * scaley),
             octaves=octs))
+
+    @staticmethod
+    def make_noise4_band(xs, zs, ys, octs=8, scalex=1.5, scaley=1):
+        '''
+        Evaluates make_noise4(x, y, z, y) over a band of rows in one go, and
+            returns it as a (len(ys), len(xs)) array.
+        `xs` and `zs` are the per-column x and z coordinates.
+        `ys` are the per-row y coordinates (used for both y and w).
+        The coordinate scaling is done once per column and once per row rather
+            than once per cell, but produces the same values as make_noise4.
+        '''
+        freq = 4 * octs
+        xs = [x / (freq * scalex) for x in xs]
+        zs = [z / (freq * scalex) for z in zs]
+        columns = list(zip(xs, zs))
+
+        band = numpy.empty((len(ys), len(columns)))
+        for row, y in enumerate(ys):
+            y = y / (freq * scaley)
+            band[row] = [snoise4(x, y, z, y, octaves=octs)
+                for x, z in columns]
+        band += 0.5
+        return band
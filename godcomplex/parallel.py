@@ -0,0 +1,104 @@
+
+import multiprocessing
+from .agent import Agent, Settlement
+
+# Spatially partitioned, multi-process stepping.
+# The map is cut into `workers` longitudinal strips (the last strip borders
+# the first one across the x seam). Each tick, every strip's agents are
+# stepped in a forked worker process against a copy-on-write snapshot of the
+# world as it was at the start of the tick. Workers send back what happened to
+# their agents: the action and its result, the agent's new position and queue,
+# and any settlements founded. The parent then applies those in strip order.
+# Agents draw from per-agent, per-tick random streams (see rng.py), so the
+# outcome only depends on the world seed and the number of workers.
+# Agents that walk out of their strip are simply picked up by their new strip
+# on the next tick.
+# Since strips can't see each other's changes within a tick, two settlers on
+# either side of a strip boundary may both settle where only one would have
+# sequentially.
+# Forking a pool of processes every tick only pays off when the strips have
+# enough agents to keep them busy: below MIN_STRIP_AGENTS agents per strip on
+# average (or with a single strip, or without fork) the tick is just run by
+# World.step. Which way a tick runs only depends on the number of agents and
+# workers, so the outcome is still deterministic -- except on platforms
+# without fork, where large worlds are stepped sequentially too.
+
+# stepping one agent takes on the order of 10us, and forking a pool tens of
+# milliseconds.
+MIN_STRIP_AGENTS = 2000
+
+# the world being stepped, inherited by forked workers.
+_world = None
+
+def _step_strip(agent_ids):
+    world = _world
+    num_pending = len(world.pending_agents)
+
+    results = []
+    for agent_id in agent_ids:
+        agent = world.agents[agent_id]
+        action, result = Agent.step(agent)
+        results.append((agent_id, action, result, agent.position,
+            agent.queue))
+
+    # AgentActions.settle is the only action that adds pending agents.
+    founded = [(settlement.id, settlement.population)
+        for settlement in world.pending_agents[num_pending:]]
+    return results, founded
+
+class StripStepper:
+    def __init__(self, world, workers):
+        self.world = world
+        self.workers = workers
+
+    def strip_of(self, x):
+        return x * self.workers // self.world.width
+
+    def partition(self):
+        strips = [[] for _ in range(self.workers)]
+        for agent_id in sorted(self.world.agents):
+            agent = self.world.agents[agent_id]
+            strips[self.strip_of(agent.position[0])].append(agent_id)
+        return strips
+
+    def step(self):
+        global _world
+        world = self.world
+        if not self.uses_processes():
+            world.step()
+            return
+        world._grow_settlements()
+
+        tasks = self.partition()
+        _world = world
+        try:
+            context = multiprocessing.get_context('fork')
+            with context.Pool(self.workers) as pool:
+                outcomes = pool.map(_step_strip, tasks)
+        finally:
+            _world = None
+        for results, founded in outcomes:
+            self._merge(results, founded)
+
+        world._add_pending_agents()
+        world.history.advance()
+
+    def uses_processes(self):
+        '''
+        Whether the next step runs the strips in worker processes.
+        '''
+        return (self.workers > 1 and
+            len(self.world.agents) >= MIN_STRIP_AGENTS * self.workers and
+            'fork' in multiprocessing.get_all_start_methods())
+
+    def _merge(self, results, founded):
+        world = self.world
+        for agent_id, action, result, position, queue in results:
+            agent = world.agents[agent_id]
+            agent.queue = queue
+            if position != agent.position:
+                world.move_agent(agent, *position)
+            world.history.record(agent, action, result)
+
+        for agent_id, population in founded:
+            Settlement.found(world.agents[agent_id], population=population)
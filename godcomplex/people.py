@@ -1,17 +1,18 @@
 
+from .database import Database
 
-# The People object is just a thin wrapper around the database object.
+# The People object is a thin wrapper around a row of the peoples table,
+# which is read into memory once (see database.py); its attributes are copied
+# over when it's created, so agents can look them up without a query.
 class People:
     def __init__(self, name, world):
         self.name = name
         self.db = world.get_db()
+        self.warlike_factor = self.db.peoples.warlike_factor(name)
 
     @staticmethod
     def all_peoples(db, world):
-        cursor = db.execute('SELECT name FROM peoples')
-        return [People(r[0], world) for r in cursor.fetchall()]
+        return [People(name, world) for name in Database.of(db).peoples]
 
     def get_warlike_factor(self):
-        cursor = self.db.execute(
-            'SELECT warlike_factor FROM peoples WHERE name = ?', self.name)
-        return cursor.fetchone()
+        return self.warlike_factor
@@ -2,11 +2,58 @@
 from PIL import Image
 import math
 import random
+import numpy
 from colors import color
 from .terraform import Terraform
 from .biome import Biome
 from .agent import AgentType, Settlement
 
+# Glyph and colour tables for rendering tiles. A cell shows, in order of
+# priority: its settlement, a river (moisture above RIVER_MOISTURE), the glyph
+# for its height class, or the glyph for its biome. Where there's a choice of
+# glyphs, one is picked at random.
+RIVER_MOISTURE = 5
+PEAK_GLYPHS = '▲▲^'  # height class 3 and up
+HEIGHT_GLYPHS = {
+    0: '≈',
+    2: '⌢⌒',
+}
+BIOME_GLYPHS = {
+    Biome.TEMPERATE_FOREST: '♠♣',
+    Biome.WOODLAND: '♠♣',
+    Biome.RAINFOREST: '♠',
+    Biome.GRASSLAND: ',.',
+    Biome.SAVANNAH: 'τ..',
+    Biome.DESERT: '~≈',
+    Biome.SWAMP: '"⌠',
+    Biome.TAIGA: '↑',
+}
+
+# xterm-256 colours.
+NO_BIOME_COLOR = 15
+RIVER_COLOR = 27
+TILE_COLORS = {
+    Biome.MOUNTAIN: 7,
+    Biome.TUNDRA: 14,
+    Biome.TAIGA: 34,
+    Biome.GRASSLAND: 22,
+    Biome.WOODLAND: 22,
+    Biome.SHRUBLAND: 65,
+    Biome.TEMPERATE_FOREST: 22,
+    Biome.SWAMP: 28,
+    Biome.TEMPERATE_RAINFOREST: 23,
+    Biome.RAINFOREST: 23,
+    Biome.DESERT: 226,
+    Biome.SAVANNAH: 112,
+    Biome.OCEAN: 18,
+}
+# TILE_COLORS indexed by biome, -1 standing in for no colour.
+TILE_COLOR_TABLE = numpy.full(Biome.OCEAN + 1, -1, dtype=numpy.int16)
+for biome, fg in TILE_COLORS.items():
+    TILE_COLOR_TABLE[biome] = fg
+
+_colored = {}
+
 class PrintUtil:
     @staticmethod
     def render_activity(world, x, y):
@@ -29,79 +76,102 @@ class PrintUtil:
 
     @staticmethod
     def render_tile(world, x, y):
+        rng = world.rng.get('render')
         settlement = world._get_layer_value('settlement', x, y)
         if settlement:
             return color('⌂', settlement.faction.color)
 
         moisture = world._get_layer_value('moisture', x, y) or 0
-        if moisture > 5:
+        if moisture > RIVER_MOISTURE:
             return '~'
-        height_class = Terraform.get_height_class(world.get_elevation(x, y))
 
         height_class = Terraform.get_height_class(world.get_elevation(x, y))
-        if height_class == 0:
-            return '≈'
-        elif height_class == 2:
-            return random.choice('⌢⌒')
-        elif height_class >= 3:
-            return random.choice('▲▲^')
+        if height_class >= 3:
+            return rng.choice(PEAK_GLYPHS)
+        if height_class in HEIGHT_GLYPHS:
+            return rng.choice(HEIGHT_GLYPHS[height_class])
 
         biome = world._get_layer_value('biome', x, y)
-        if biome == Biome.TEMPERATE_FOREST or biome == Biome.WOODLAND:
-            return random.choice('♠♣')
-        if biome == Biome.WOODLAND:
-            return random.choice(',.,♠♣')
-        if biome == Biome.RAINFOREST:
-            return random.choice('♠')
-        if biome == Biome.GRASSLAND:
-            return random.choice(',.')
-        if biome == Biome.SAVANNAH:
-            return random.choice('τ..')
-        if biome == Biome.DESERT:
-            return random.choice('~≈')
-        if biome == Biome.SWAMP:
-            return random.choice('"⌠')
-        if biome == Biome.TAIGA:
-            return '↑'
-
-        return '.'
+        return rng.choice(BIOME_GLYPHS.get(biome, '.'))
 
     @staticmethod
     def color_tile(world, x, y):
         biome = world._get_layer_value('biome', x, y)
         if not biome:
-            return 15
+            return NO_BIOME_COLOR
 
         moisture = world._get_layer_value('moisture', x, y) or 0
-        if moisture > 5:
-            return 27
-
-        if biome == Biome.MOUNTAIN:
-            return 7
-        if biome == Biome.TUNDRA:
-            return 14
-        if biome == Biome.TAIGA:
-            return 34
-        if biome == Biome.GRASSLAND:
-            return 22
-        if biome == Biome.WOODLAND:
-            return 22
-        if biome == Biome.SHRUBLAND:
-            return 65
-        if biome == Biome.TEMPERATE_FOREST:
-            return 22
-        if biome == Biome.SWAMP:
-            return 28
-        if biome == Biome.TEMPERATE_RAINFOREST:
-            return 23
-        if biome == Biome.RAINFOREST:
-            return 23
-        if biome == Biome.DESERT:
-            return 226
-        if biome == Biome.SAVANNAH:
-            return 112
-        if biome == Biome.OCEAN:
-            return 18
+        if moisture > RIVER_MOISTURE:
+            return RIVER_COLOR
+        return TILE_COLORS.get(biome)
+
+    @staticmethod
+    def tile_glyphs(world, rng=None):
+        '''
+        Returns render_tile's glyph for every cell (but settlements) as a
+            (height, width) array, drawing the random choices in bulk from
+            `rng` (a numpy RandomState; by default the world's 'render'
+            stream).
+        '''
+        rng = rng or world.rng.numpy('render')
+        glyphs = numpy.full((world.height, world.width), '.', dtype='<U1')
+
+        def choose(mask, options):
+            count = int(numpy.count_nonzero(mask))
+            if count:
+                glyphs[mask] = numpy.array(list(options))[
+                    rng.randint(len(options), size=count)]
+
+        # applied from the lowest priority rule to the highest.
+        if 'biome' in world.layers:
+            biome = world.get_layer('biome')
+            for value, options in BIOME_GLYPHS.items():
+                choose(biome == value, options)
+        if 'elevation' in world.layers:
+            height_class = Terraform.get_height_classes(
+                world.get_layer('elevation'))
+            choose(height_class >= 3, PEAK_GLYPHS)
+            for value, options in HEIGHT_GLYPHS.items():
+                choose(height_class == value, options)
+        if 'moisture' in world.layers:
+            choose(world.get_layer('moisture') > RIVER_MOISTURE, '~')
+        return glyphs
+
+    @staticmethod
+    def tile_colors(world):
+        '''
+        Returns color_tile for every cell as a (height, width) array, with -1
+            where it's None.
+        '''
+        if 'biome' not in world.layers:
+            return numpy.full((world.height, world.width), NO_BIOME_COLOR,
+                dtype=numpy.int16)
+        colors = TILE_COLOR_TABLE[world.get_layer('biome')]
+        if 'moisture' in world.layers:
+            colors[world.get_layer('moisture') > RIVER_MOISTURE] = RIVER_COLOR
+        return colors
+
+    @staticmethod
+    def colored(glyph, fg):
+        '''
+        color(glyph, fg), memoized; `fg` may be None or -1 for no colour.
+        '''
+        key = (glyph, fg)
+        text = _colored.get(key)
+        if text is None:
+            text = _colored[key] = color(glyph,
+                fg=None if fg is None or fg == -1 else fg)
+        return text
+
+    @staticmethod
+    def terrain_cells(world):
+        '''
+        Returns the rendered terrain (without settlements) as rows of
+            coloured glyph strings.
+        '''
+        return [[PrintUtil.colored(glyph, fg) for glyph, fg in zip(*row)]
+            for row in zip(PrintUtil.tile_glyphs(world).tolist(),
+                PrintUtil.tile_colors(world).tolist())]
 
     @staticmethod
     def print_digit_layer(world, layer_name):
@@ -111,10 +181,12 @@ class PrintUtil:
 
     @staticmethod
     def print_terrain(world):
-        print('\n'.join([
-            ''.join([color(PrintUtil.render_tile(world, x, y),
-                fg=PrintUtil.color_tile(world, x, y)) for x in range(world.width)])
-                    for y in range(world.height)]))
+        rows = PrintUtil.terrain_cells(world)
+        if 'settlement' in world.layers:
+            for y, x in zip(*numpy.nonzero(
+                world.get_layer('settlement').astype(bool))):
+                rows[y][x] = PrintUtil.render_tile(world, x, y)
+        print('\n'.join([''.join(row) for row in rows]))
 
     @staticmethod
     def print_activity(world):
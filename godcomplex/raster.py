@@ -0,0 +1,228 @@
+
+import os
+import struct
+import zlib
+import numpy
+from colors import COLORS
+from .agent import AgentType
+from .terraform import Terraform
+from .print_util import TILE_COLOR_TABLE, RIVER_COLOR, RIVER_MOISTURE, \
+    NO_BIOME_COLOR
+
+DEFAULT_STRIP_HEIGHT = 256
+GRADIENT_STEPS = 1024
+
+# Raster (PNG/BMP) export of world layers.
+# A layer is coloured through a palette with vectorized lookups, and the
+# image is produced and written in strips of rows, so that exporting a huge
+# world never needs more than one strip's worth of pixels in memory.
+# Agents and settlements can be drawn over the layer in their faction's
+# colour; they're found through the spatial index, one strip at a time.
+
+def xterm_palette():
+    '''
+    Returns the RGB values of the 256 xterm colours, as a (256, 3) array.
+    '''
+    table = numpy.zeros((256, 3), dtype=numpy.uint8)
+    table[:16] = [
+        (0, 0, 0), (128, 0, 0), (0, 128, 0), (128, 128, 0),
+        (0, 0, 128), (128, 0, 128), (0, 128, 128), (192, 192, 192),
+        (128, 128, 128), (255, 0, 0), (0, 255, 0), (255, 255, 0),
+        (0, 0, 255), (255, 0, 255), (0, 255, 255), (255, 255, 255)]
+    levels = numpy.array([0, 95, 135, 175, 215, 255])
+    cube = numpy.arange(216)
+    table[16:232] = numpy.stack([levels[cube // 36], levels[cube // 6 % 6],
+        levels[cube % 6]], axis=1)
+    table[232:] = (8 + 10 * numpy.arange(24))[:, None]
+    return table
+
+XTERM_RGB = xterm_palette()
+# faction colours are the names of the first 8 xterm colours.
+FACTION_RGB = {name: XTERM_RGB[i] for i, name in enumerate(COLORS)}
+
+class LookupPalette:
+    '''
+    Colours integer values by indexing a (N, 3) table of RGB values.
+    '''
+    def __init__(self, table):
+        self.table = numpy.asarray(table, dtype=numpy.uint8)
+
+    def colors(self, values):
+        return self.table[numpy.clip(values, 0, len(self.table) - 1)]
+
+class GradientPalette:
+    '''
+    Colours numeric values by interpolating between (value, (r, g, b))
+        stops, sorted by value. Values outside the stops get the nearest
+        end's colour.
+    '''
+    def __init__(self, stops, steps=GRADIENT_STEPS):
+        values = numpy.array([value for value, _ in stops],
+            dtype=numpy.float64)
+        rgb = numpy.array([color for _, color in stops], dtype=numpy.float64)
+        self.low, self.high = values[0], values[-1]
+        samples = numpy.linspace(self.low, self.high, steps)
+        self.table = numpy.stack([numpy.interp(samples, values, rgb[:, i])
+            for i in range(3)], axis=1).round().astype(numpy.uint8)
+
+    def colors(self, values):
+        scale = (len(self.table) - 1) / max(self.high - self.low, 1e-9)
+        index = ((numpy.asarray(values, dtype=numpy.float64) - self.low) *
+            scale).round()
+        return self.table[numpy.clip(index, 0, len(self.table) - 1)
+            .astype(numpy.intp)]
+
+# the terminal colours of PrintUtil.color_tile; biomes it has no colour for
+# (like biome 0, no biome) get its NO_BIOME_COLOR.
+BIOME_PALETTE = LookupPalette(numpy.where(
+    (TILE_COLOR_TABLE >= 0)[:, None],
+    XTERM_RGB[numpy.maximum(TILE_COLOR_TABLE, 0)],
+    XTERM_RGB[NO_BIOME_COLOR]))
+ELEVATION_PALETTE = GradientPalette([
+    (0.0, (0, 0, 60)),
+    (Terraform.WATER_THRESHOLD, (40, 90, 190)),
+    (Terraform.WATER_THRESHOLD + 0.001, (70, 140, 60)),
+    (0.75, (150, 130, 80)),
+    (0.9, (120, 110, 100)),
+    (1.0, (255, 255, 255)),
+])
+MOISTURE_PALETTE = GradientPalette([
+    (0, (230, 215, 170)),
+    (6, (20, 70, 200)),
+])
+GREYSCALE_PALETTE = GradientPalette([(0.0, (0, 0, 0)), (1.0, (255, 255, 255))])
+DEFAULT_PALETTES = {
+    'biome': BIOME_PALETTE,
+    'elevation': ELEVATION_PALETTE,
+    'moisture': MOISTURE_PALETTE,
+}
+
+class Raster:
+    @staticmethod
+    def export(world, path, layer='elevation', palette=None, overlays=(),
+            scale=1, strip_height=DEFAULT_STRIP_HEIGHT, rivers=True,
+            fmt=None):
+        '''
+        Writes `layer` of `world` as an image to `path`, in PNG or BMP format
+            (by default, going by the file extension). Each cell becomes a
+            `scale` x `scale` block of pixels.
+        `palette` defaults to the layer's entry in DEFAULT_PALETTES, or to
+            greyscale over the layer's value range. With `rivers`, the biome
+            layer shows rivers the way PrintUtil.color_tile does.
+            `overlays` may contain 'settlements' and/or 'agents'.
+        '''
+        fmt = (fmt or os.path.splitext(path)[1][1:]).lower()
+        writers = {'png': PNGWriter, 'bmp': BMPWriter}
+        if fmt not in writers:
+            raise ValueError('Unsupported raster format {}'.format(fmt))
+
+        with open(path, 'wb') as f:
+            writer = writers[fmt](f, world.width * scale,
+                world.height * scale)
+            for strip in Raster.strips(world, layer, palette, overlays, scale,
+                strip_height, rivers):
+                writer.write_rows(strip)
+            writer.close()
+
+    @staticmethod
+    def strips(world, layer, palette=None, overlays=(), scale=1,
+            strip_height=DEFAULT_STRIP_HEIGHT, rivers=True):
+        '''
+        Yields the image as (rows, width * scale, 3) uint8 RGB arrays, top to
+            bottom, each covering `strip_height` rows of cells.
+        '''
+        values = world.get_layer(layer)
+        if palette is None:
+            palette = DEFAULT_PALETTES.get(layer)
+        if palette is None:
+            low, high = float(values.min()), float(values.max())
+            palette = GradientPalette([(low, (0, 0, 0)),
+                (max(high, low + 1e-9), (255, 255, 255))])
+        show_rivers = rivers and layer == 'biome' and 'moisture' in world.layers
+
+        for top in range(0, world.height, strip_height):
+            bottom = min(top + strip_height, world.height)
+            rgb = palette.colors(values[top:bottom])
+            if show_rivers:
+                # color_tile doesn't draw rivers on cells without a biome.
+                rgb[(world.get_layer('moisture')[top:bottom] >
+                    RIVER_MOISTURE) & (values[top:bottom] != 0)] = \
+                    XTERM_RGB[RIVER_COLOR]
+            for overlay in overlays:
+                Raster._draw_overlay(world, rgb, top, overlay)
+            if scale > 1:
+                rgb = rgb.repeat(scale, axis=0).repeat(scale, axis=1)
+            yield rgb
+
+    @staticmethod
+    def _draw_overlay(world, rgb, top, overlay):
+        if overlay == 'settlements':
+            agent_type = AgentType.SETTLEMENT
+        elif overlay == 'agents':
+            agent_type = None
+        else:
+            raise ValueError('Unknown overlay {}'.format(overlay))
+        for agent in world.spatial_index.query_rect(0, top, world.width,
+            rgb.shape[0], agent_type=agent_type):
+            if overlay == 'agents' and \
+                agent.agent_type == AgentType.SETTLEMENT:
+                continue
+            x, y = world.spatial_index.position(agent)
+            color = FACTION_RGB.get(agent.faction.color if agent.faction
+                else None, XTERM_RGB[15])
+            rgb[y - top, x] = color
+
+class PNGWriter:
+    '''
+    Writes an 8-bit RGB PNG row strip by row strip: every strip is
+        compressed into the same zlib stream and flushed out as IDAT chunks.
+    '''
+    def __init__(self, f, width, height):
+        self.f = f
+        self.width = width
+        self.f.write(b'\x89PNG\r\n\x1a\n')
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2,
+            0, 0, 0))
+        self.compressor = zlib.compressobj()
+
+    def write_rows(self, rgb):
+        # every row starts with its filter type, 0 (none).
+        rows = numpy.zeros((rgb.shape[0], 1 + self.width * 3),
+            dtype=numpy.uint8)
+        rows[:, 1:] = rgb.reshape(rgb.shape[0], -1)
+        data = self.compressor.compress(rows.tobytes())
+        if data:
+            self._chunk(b'IDAT', data)
+
+    def close(self):
+        self._chunk(b'IDAT', self.compressor.flush())
+        self._chunk(b'IEND', b'')
+
+    def _chunk(self, kind, data):
+        self.f.write(struct.pack('>I', len(data)) + kind + data +
+            struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+class BMPWriter:
+    '''
+    Writes a 24-bit BMP row strip by row strip. The image is stored top-down
+        (with a negative height), so rows can be written in order.
+    '''
+    def __init__(self, f, width, height):
+        self.f = f
+        self.padding = -(width * 3) % 4
+        row_size = width * 3 + self.padding
+        image_size = row_size * height
+        f.write(struct.pack('<2sIHHI', b'BM', 54 + image_size, 0, 0, 54))
+        f.write(struct.pack('<IiiHHIIiiII', 40, width, -height, 1, 24, 0,
+            image_size, 2835, 2835, 0, 0))
+
+    def write_rows(self, rgb):
+        # BMP stores pixels as BGR.
+        bgr = rgb[:, :, ::-1].reshape(rgb.shape[0], -1)
+        if self.padding:
+            bgr = numpy.hstack([bgr, numpy.zeros((rgb.shape[0], self.padding),
+                dtype=numpy.uint8)])
+        self.f.write(numpy.ascontiguousarray(bgr).tobytes())
+
+    def close(self):
+        pass
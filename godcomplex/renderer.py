@@ -0,0 +1,151 @@
+
+import sys
+from .agent import Settlement
+from .biome import Biome
+from .print_util import PrintUtil
+
+ACTIVITY = 'activity'
+TERRAIN = 'terrain'
+OVERLAY_LAYERS = ('agent_position', 'settlement')
+TERRAIN_LAYERS = ('elevation', 'moisture', 'biome')
+
+# Incremental terminal rendering of a world.
+# The renderer keeps a frame buffer of what's currently on screen, and on each
+# render() only rewrites the cells that changed since the last one, with ANSI
+# cursor positioning. The static part of the map (terrain glyphs and colours)
+# is rendered once into a table of cell strings (see PrintUtil.terrain_cells);
+# what changes from frame to frame -- agents and settlements -- is tracked
+# through a layer listener, so finding the cells to redraw doesn't take a pass
+# over the map.
+# Anything else that writes to the terminal over the map (listings, the path
+# overlay of basic_test.py) should either go through set_overlay or call
+# invalidate() so the next frame is drawn in full.
+
+class TerminalRenderer:
+    def __init__(self, world, view=ACTIVITY, top=2, left=1, out=None):
+        self.world = world
+        self.view = view
+        # 1-based terminal row and column of the map's top-left cell.
+        self.top = top
+        self.left = left
+        self.out = out or sys.stdout
+        self.frame = None  # rows of cell strings on screen, None to redraw
+        self.overlay = {}  # (x, y) -> text drawn over the map
+        self._dirty = set()
+        self._terrain = None
+        self._terrain_versions = None
+        world.add_layer_listener(self._on_layer_change)
+
+    def close(self):
+        self.world.remove_layer_listener(self._on_layer_change)
+
+    def set_view(self, view):
+        if view != self.view:
+            self.view = view
+            self.invalidate()
+
+    def invalidate(self):
+        '''
+        Makes the next render() redraw the whole map, e.g. after something
+            else was printed over it.
+        '''
+        self.frame = None
+
+    def set_overlay(self, cells, text):
+        '''
+        Draws `text` (one cell wide) over each of `cells` until cleared.
+        '''
+        for cell in cells:
+            self.overlay[cell] = text
+            self._dirty.add(cell)
+
+    def clear_overlay(self):
+        self._dirty.update(self.overlay)
+        self.overlay = {}
+
+    def _on_layer_change(self, name, region):
+        if name not in OVERLAY_LAYERS or self.frame is None:
+            return
+        if region is None:
+            self.invalidate()
+            return
+        x, y, width, height = region
+        self._dirty.update(((x + dx) % self.world.width, y + dy)
+            for dy in range(height) for dx in range(width))
+
+    def _terrain_cells(self):
+        # the terrain table, rebuilt (along with the whole frame) whenever a
+        # terrain layer changes.
+        versions = tuple(self.world.get_layer_version(name)
+            for name in TERRAIN_LAYERS)
+        if versions != self._terrain_versions:
+            self._terrain = PrintUtil.terrain_cells(self.world)
+            self._terrain_versions = versions
+            self.invalidate()
+        return self._terrain
+
+    def cell(self, x, y):
+        '''
+        Returns the text for cell (x, y) in the current view.
+        '''
+        text = self.overlay.get((x, y))
+        if text is not None:
+            return text
+
+        world = self.world
+        if self.view == TERRAIN:
+            settlement = world._get_layer_value('settlement', x, y)
+            if settlement:
+                return PrintUtil.colored('⌂', settlement.faction.color)
+            return self._terrain[y][x]
+
+        if world._get_layer_value('biome', x, y) == Biome.OCEAN:
+            return self._terrain[y][x]
+        agents = world._get_layer_value('agent_position', x, y)
+        if not agents:
+            return ' '
+        if len(agents) > 1:
+            return '*'
+        agent = world.agents.get(next(iter(agents)))
+        if agent is None:
+            return ' '
+        return PrintUtil.colored(
+            '⌂' if isinstance(agent, Settlement) else '@',
+            agent.faction.color)
+
+    def render(self):
+        '''
+        Brings the screen up to date, and returns the number of cells written.
+        '''
+        self._terrain_cells()
+        parts = []
+        written = 0
+        if self.frame is None:
+            self._dirty = set()
+            self.frame = [[self.cell(x, y) for x in range(self.world.width)]
+                for y in range(self.world.height)]
+            for y, row in enumerate(self.frame):
+                parts.append(self._cursor(0, y) + ''.join(row) + '\033[0K')
+            written = self.world.width * self.world.height
+        else:
+            last = None
+            for x, y in sorted(self._dirty, key=lambda cell: cell[::-1]):
+                text = self.cell(x, y)
+                if self.frame[y][x] == text:
+                    continue
+                self.frame[y][x] = text
+                if last != (x - 1, y):
+                    parts.append(self._cursor(x, y))
+                parts.append(text)
+                last = (x, y)
+                written += 1
+            self._dirty = set()
+
+        # leave the cursor on the line below the map.
+        parts.append(self._cursor(0, self.world.height))
+        self.out.write(''.join(parts))
+        self.out.flush()
+        return written
+
+    def _cursor(self, x, y):
+        return '\033[{};{}H'.format(self.top + y, self.left + x)
@@ -0,0 +1,109 @@
+
+import hashlib
+import random
+import numpy
+
+# Seeded random number streams.
+# A world owns a single root seed, and every subsystem that needs randomness
+# draws from its own stream derived from it (RandomStreams.get / .numpy), so
+# that changing how much one subsystem draws doesn't shift any other.
+# Agents get a fresh counter-based stream for every step
+# (RandomStreams.for_agent), derived from the seed, the agent id and the tick.
+# Those don't depend on the order agents are stepped in, or on which process
+# steps them.
+
+def derive_seed(*parts, bits=32):
+    '''
+    Derives a `bits`-bit seed from any number of printable values.
+    '''
+    digest = hashlib.sha256(repr(parts).encode('utf-8')).digest()
+    return int.from_bytes(digest[:bits // 8], 'big')
+
+class CounterRandom:
+    '''
+    A small counter-based generator: the n-th number drawn is a hash of the
+        stream key and n. It's cheap to create, which makes it suitable for
+        throwaway per-agent, per-tick streams. It implements the subset of
+        the random.Random API used in this package.
+    '''
+    __slots__ = ('key', 'counter')
+
+    def __init__(self, *parts):
+        self.key = hashlib.sha256(repr(parts).encode('utf-8')).digest()
+        self.counter = 0
+
+    def _next(self):
+        digest = hashlib.blake2b(self.key + self.counter.to_bytes(8, 'big'),
+            digest_size=8).digest()
+        self.counter += 1
+        return int.from_bytes(digest, 'big')
+
+    def random(self):
+        return (self._next() >> 11) * (2.0 ** -53)
+
+    def _randbelow(self, n):
+        bits = n.bit_length()
+        while True:
+            r = self._next() >> (64 - bits)
+            if r < n:
+                return r
+
+    def randrange(self, start, stop=None):
+        if stop is None:
+            start, stop = 0, start
+        return start + self._randbelow(stop - start)
+
+    def randint(self, a, b):
+        return a + self._randbelow(b - a + 1)
+
+    def choice(self, seq):
+        if not seq:
+            raise IndexError('Cannot choose from an empty sequence')
+        return seq[self._randbelow(len(seq))]
+
+    def shuffle(self, x):
+        for i in reversed(range(1, len(x))):
+            j = self._randbelow(i + 1)
+            x[i], x[j] = x[j], x[i]
+
+class RandomStreams:
+    def __init__(self, seed):
+        self.seed = seed
+        self.streams = {}
+        self.numpy_streams = {}
+
+    def get(self, name):
+        '''
+        Returns the random.Random stream for subsystem `name`.
+        '''
+        stream = self.streams.get(name)
+        if stream is None:
+            stream = self.streams[name] = random.Random(
+                derive_seed(self.seed, name, bits=64))
+        return stream
+
+    def numpy(self, name):
+        '''
+        Returns the numpy RandomState stream for subsystem `name`, for drawing
+            numbers in bulk.
+        '''
+        stream = self.numpy_streams.get(name)
+        if stream is None:
+            stream = self.numpy_streams[name] = numpy.random.RandomState(
+                derive_seed(self.seed, name))
+        return stream
+
+    def fork(self):
+        '''
+        Returns a copy of these streams, each continuing from its current
+            state.
+        '''
+        streams = RandomStreams(self.seed)
+        for name, stream in self.streams.items():
+            streams.get(name).setstate(stream.getstate())
+        for name, stream in self.numpy_streams.items():
+            streams.numpy(name).set_state(stream.get_state())
+        return streams
+
+    def for_agent(self, agent_id, tick):
+        return CounterRandom(self.seed, 'agent', agent_id, tick)
@@ -0,0 +1,143 @@
+
+import heapq
+import math
+from .geometry import Geometry
+
+DEFAULT_BUCKET_SIZE = 8
+
+# A uniform-grid spatial index over agents. The map is divided into square
+# buckets, each holding the agents currently inside it, so proximity queries
+# only look at the buckets overlapping the query area. Like the world map,
+# the index wraps around horizontally.
+# The index stores the agent objects themselves, and filters on agent_type and
+# faction at query time, so agents changing type or faction need no update.
+
+class SpatialIndex:
+    def __init__(self, width, height, bucket_size=DEFAULT_BUCKET_SIZE):
+        self.width = width
+        self.height = height
+        self.bucket_size = bucket_size
+        self.buckets_x = int(math.ceil(width / bucket_size))
+        self.buckets_y = int(math.ceil(height / bucket_size))
+        self.buckets = {}
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.positions)
+
+    def _bucket(self, x, y):
+        return (x // self.bucket_size, y // self.bucket_size)
+
+    def insert(self, agent, x, y):
+        '''
+        Adds `agent` at (x, y), replacing any agent already indexed under the
+            same id (e.g. a settler that has become a settlement).
+        '''
+        self.remove(agent)
+        self.buckets.setdefault(self._bucket(x, y), {})[agent.id] = agent
+        self.positions[agent.id] = (x, y)
+
+    def remove(self, agent):
+        position = self.positions.pop(agent.id, None)
+        if position is None:
+            return
+        bucket = self._bucket(*position)
+        del self.buckets[bucket][agent.id]
+        if not self.buckets[bucket]:
+            del self.buckets[bucket]
+
+    def move(self, agent, x, y):
+        position = self.positions.get(agent.id)
+        if position is not None and \
+            self._bucket(*position) == self._bucket(x, y):
+            self.buckets[self._bucket(x, y)][agent.id] = agent
+            self.positions[agent.id] = (x, y)
+        else:
+            self.insert(agent, x, y)
+
+    def position(self, agent):
+        return self.positions.get(agent.id)
+
+    def _matches(self, agent, agent_type, faction):
+        return ((agent_type is None or agent.agent_type == agent_type) and
+            (faction is None or agent.faction is faction))
+
+    def _bucket_agents(self, bx, by, agent_type, faction):
+        for agent_id, agent in self.buckets.get((bx, by), {}).items():
+            if self._matches(agent, agent_type, faction):
+                yield agent, self.positions[agent_id]
+
+    def query_rect(self, x, y, width, height, agent_type=None, faction=None):
+        '''
+        Returns the agents in the `width` x `height` rectangle with top-left
+            corner (x, y). The rectangle wraps around horizontally and is
+            clipped at the top and bottom edges.
+        '''
+        top = max(y, 0)
+        bottom = min(y + height, self.height) - 1
+        if bottom < top or width <= 0:
+            return []
+        width = min(width, self.width)
+        x = x % self.width
+
+        # the rectangle as at most two non-wrapping column ranges.
+        spans = [(x, min(x + width, self.width) - 1)]
+        if x + width > self.width:
+            spans.append((0, x + width - self.width - 1))
+
+        found = []
+        size = self.bucket_size
+        for left, right in spans:
+            for bx in range(left // size, right // size + 1):
+                for by in range(top // size, bottom // size + 1):
+                    for agent, (ax, ay) in self._bucket_agents(bx, by,
+                        agent_type, faction):
+                        if left <= ax <= right and top <= ay <= bottom:
+                            found.append(agent)
+        return found
+
+    def query_radius(self, x, y, radius, agent_type=None, faction=None):
+        '''
+        Returns the agents within (Euclidean, x-wrapping) `radius` of (x, y).
+        '''
+        r = int(math.floor(radius))
+        return [agent for agent in self.query_rect(x - r, y - r,
+                2 * r + 1, 2 * r + 1, agent_type, faction)
+            if Geometry.wrapped_distance_2d((x, y),
+                self.positions[agent.id], self.width) <= radius]
+
+    def nearest(self, x, y, k=1, agent_type=None, faction=None):
+        '''
+        Returns up to `k` (distance, agent) pairs closest to (x, y), nearest
+            first. Buckets are searched in rings outward from (x, y) until no
+            unsearched bucket can hold anything closer.
+        '''
+        bx, by = self._bucket(x, y)
+        size = self.bucket_size
+        max_ring = max(self.buckets_x // 2 + 1, self.buckets_y)
+        seen = set()
+        candidates = []
+        for ring in range(max_ring + 1):
+            for dx in range(-ring, ring + 1):
+                for dy in range(-ring, ring + 1):
+                    if max(abs(dx), abs(dy)) != ring:
+                        continue
+                    bucket = ((bx + dx) % self.buckets_x, by + dy)
+                    if bucket in seen or not 0 <= bucket[1] < self.buckets_y:
+                        continue
+                    seen.add(bucket)
+                    for agent, position in self._bucket_agents(*bucket,
+                        agent_type, faction):
+                        distance = Geometry.wrapped_distance_2d((x, y),
+                            position, self.width)
+                        candidates.append((distance, agent.id, agent))
+
+            # anything in the next ring is more than (ring - 1) buckets away.
+            # (the bucket at the x seam can be narrower, hence the slack.)
+            if len(candidates) >= k:
+                kth = heapq.nsmallest(k, candidates)[-1][0]
+                if kth <= (ring - 1) * size:
+                    break
+
+        return [(distance, agent) for distance, _, agent
+            in heapq.nsmallest(k, candidates)]
@@ -0,0 +1,135 @@
+
+import asyncio
+import collections
+import threading
+
+# Push-based event subscriptions (see History.subscribe).
+# A subscription either calls a callback synchronously from History.record, or
+# buffers matching events in a bounded queue that's read with drain() or
+# `async for`. The asyncio side may run in another thread than the simulation;
+# it's woken through its loop's call_soon_threadsafe.
+# When a queue is full, the overflow policy decides what goes:
+#   DROP_OLDEST  the oldest queued event is discarded.
+#   COALESCE     an agent's queued event is replaced by its newer one, so a
+#                reader sees at most one (the latest) event per agent. If the
+#                queue is still full, the oldest event is discarded.
+# Either way, `dropped` counts the events that were lost.
+
+DROP_OLDEST = 'drop_oldest'
+COALESCE = 'coalesce'
+DEFAULT_MAX_QUEUE = 1024
+
+class EventFilter:
+    '''
+    Matches recorded events by action, the agent's faction (a Faction or
+        its name), the agent's type, and/or a region (x, y, width, height) of
+        the map that the agent is in, wrapping in x. Omitted criteria match
+        everything.
+    '''
+    def __init__(self, actions=None, factions=None, agent_types=None,
+            region=None):
+        self.actions = set(actions) if actions is not None else None
+        self.factions = set(factions) if factions is not None else None
+        self.agent_types = (set(agent_types) if agent_types is not None
+            else None)
+        self.region = region
+
+    def matches(self, agent, action):
+        if self.actions is not None and action not in self.actions:
+            return False
+        if self.agent_types is not None and \
+            agent.agent_type not in self.agent_types:
+            return False
+        if self.factions is not None and agent.faction not in self.factions \
+            and getattr(agent.faction, 'name', None) not in self.factions:
+            return False
+        if self.region is not None:
+            if not agent.position:
+                return False
+            x, y = agent.position
+            rx, ry, rwidth, rheight = self.region
+            if not ((x - rx) % agent.world.width < rwidth and
+                ry <= y < ry + rheight):
+                return False
+        return True
+
+class Subscription:
+    def __init__(self, history, event_filter, callback=None,
+            max_queue=DEFAULT_MAX_QUEUE, overflow=DROP_OLDEST):
+        if overflow not in (DROP_OLDEST, COALESCE):
+            raise ValueError('Unknown overflow policy {}'.format(overflow))
+        self.history = history
+        self.filter = event_filter
+        self.callback = callback
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.dropped = 0
+        self.closed = False
+        # queued events by key; the key is the agent id when coalescing.
+        self._queue = collections.OrderedDict()
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._loop = None
+        self._ready = None
+
+    def matches(self, agent, action):
+        return self.filter.matches(agent, action)
+
+    def push(self, event):
+        if self.callback is not None:
+            self.callback(event)
+            return
+
+        with self._lock:
+            if self.overflow == COALESCE:
+                key = event.agent_id
+                if self._queue.pop(key, None) is not None:
+                    self.dropped += 1
+            else:
+                key = self._seq
+                self._seq += 1
+            self._queue[key] = event
+            if len(self._queue) > self.max_queue:
+                self._queue.popitem(last=False)
+                self.dropped += 1
+        self._wake()
+
+    def drain(self):
+        '''
+        Returns and removes every queued event, oldest first.
+        '''
+        with self._lock:
+            events = list(self._queue.values())
+            self._queue.clear()
+        return events
+
+    def close(self):
+        self.history.unsubscribe(self)
+        self.closed = True
+        self._wake()
+
+    def _wake(self):
+        # the loop and its event are published together, under the lock, by
+        # the first __anext__.
+        with self._lock:
+            loop, ready = self._loop, self._ready
+        if loop is not None:
+            loop.call_soon_threadsafe(ready.set)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._loop is None:
+            ready = asyncio.Event()
+            with self._lock:
+                self._ready = ready
+                self._loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                if self._queue:
+                    return self._queue.popitem(last=False)[1]
+                self._ready.clear()
+            if self.closed:
+                raise StopAsyncIteration
+            await self._ready.wait()
@@ -1,5 +1,7 @@
 
 import random
+import multiprocessing
+import numpy
 from .noise_util import NoiseUtil
 import math
 
@@ -7,6 +9,8 @@ import math
 # A height is a float in the range of [0.0, 1.0], where
 # anything below WATER_THRESHOLD is considered water.
 
+SIMPLEX_BAND_HEIGHT = 64
+
 class Terraform:
     WATER_THRESHOLD = 0.53
 
@@ -18,18 +22,72 @@ class Terraform:
             return int(math.ceil((h - Terraform.WATER_THRESHOLD) / 0.15))
 
     @staticmethod
-    def simplex(width, height):
-        base = random.randint(0, 10000)
-        x0 = random.randint(0, 100000)
-        y0 = random.randint(0, 100000)
+    def get_height_classes(elevation):
+        '''
+        get_height_class for a whole array of elevations.
+        '''
+        elevation = numpy.asarray(elevation, dtype=numpy.float64)
+        return numpy.where(elevation <= Terraform.WATER_THRESHOLD, 0,
+            numpy.ceil((elevation - Terraform.WATER_THRESHOLD) / 0.15)) \
+            .astype(numpy.int64)
+
+    @staticmethod
+    def simplex(width, height, processes=None, band_height=SIMPLEX_BAND_HEIGHT,
+        rng=random):
+        '''
+        Generates a (height, width) heightmap array that wraps around
+            horizontally, by sampling 4D simplex noise along a cylinder.
+        The cylinder coordinates are computed once per column, and rows are
+            evaluated in bands of `band_height`. If `processes` is greater than
+            one, the bands are spread across a process pool of that size.
+            The output for a given `rng` state doesn't depend on either.
+        '''
+        return Terraform.simplex_region(width, height,
+            Terraform.simplex_seeds(rng), 0, 0, width, height,
+            processes=processes, band_height=band_height)
+
+    @staticmethod
+    def simplex_seeds(rng=random):
+        '''
+        Draws the random offsets a simplex heightmap is generated from.
+        '''
+        base = rng.randint(0, 10000)
+        x0 = rng.randint(0, 100000)
+        y0 = rng.randint(0, 100000)
+        return (base, x0, y0)
+
+    @staticmethod
+    def simplex_region(width, height, seeds, x, y, region_width,
+        region_height, processes=None, band_height=SIMPLEX_BAND_HEIGHT):
+        '''
+        Generates the `region_width` x `region_height` rectangle with top-left
+            corner (x, y) of the (height, width) simplex heightmap for `seeds`
+            (see simplex_seeds), without generating the rest of it. The
+            rectangle wraps around horizontally.
+        '''
+        _, x0, y0 = seeds
 
         hyp_x = width / (2 * math.pi)
         hyp_y = height / (2 * math.pi)
 
-        return [[NoiseUtil.make_noise4(
-            x0 + (math.cos((x / width) * (2 * math.pi)) * hyp_x), y0 + y,
-            x0 + (math.sin((x / width) * (2 * math.pi)) * hyp_x), y0 + y) for x in range(width)]
-                for y in range(height)]
+        columns = [(x + i) % width for i in range(region_width)]
+        xs = [x0 + (math.cos((column / width) * (2 * math.pi)) * hyp_x)
+            for column in columns]
+        zs = [x0 + (math.sin((column / width) * (2 * math.pi)) * hyp_x)
+            for column in columns]
+        bottom = y + region_height
+        bands = [(xs, zs, [y0 + row for row in range(top, min(top + band_height, bottom))])
+            for top in range(y, bottom, band_height)]
+
+        if processes and processes > 1 and len(bands) > 1:
+            with multiprocessing.Pool(processes) as pool:
+                results = pool.starmap(NoiseUtil.make_noise4_band, bands)
+        else:
+            results = [NoiseUtil.make_noise4_band(*band) for band in bands]
+
+        if not results:
+            return numpy.empty((0, region_width))
+        return numpy.concatenate(results)
 
     def flat(width, height):
         return [[0.6 for x in range(width)]
@@ -0,0 +1,122 @@
+
+import array
+import functools
+import numpy
+
+# (dx, dy) neighbour offsets, in World.get_neighbors order.
+OFFSETS = ((-1, 0), (0, -1), (0, 1), (1, 0))
+DIAGONAL_OFFSETS = ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1),
+    (1, 0), (1, 1))
+# grids with more cells than this don't get adjacency tables for neighbors
+# (they'd take upwards of 64MB); their neighbours are worked out one cell at a
+# time instead.
+MAX_TABLE_CELLS = 1 << 22
+
+# Neighbour topology of the world grid, over flat cell indices
+# (y * width + x). The grid is a cylinder: it wraps around horizontally but
+# not vertically, and a cell is never its own neighbour. Without `wrap`, it's
+# a plain rectangle instead (e.g. a window onto part of the map).
+# Adjacency is stored CSR-style: the neighbours of cell i are
+# indices[indptr[i]:indptr[i + 1]], in the same order as World.get_neighbors
+# lists them. Interior cells have 4 (or 8) neighbours; cells on the top and
+# bottom rows have fewer.
+# neighbors_of finds the neighbours of an array of cells at once, for
+# vectorized graph algorithms (see DistanceField); neighbors looks up a single
+# cell's, for the search loops that expand one cell at a time.
+
+class Topology:
+    def __init__(self, width, height, diagonals=False, wrap=True):
+        self.width = width
+        self.height = height
+        self.diagonals = diagonals
+        self.wrap = wrap
+        self._offsets = DIAGONAL_OFFSETS if diagonals else OFFSETS
+        offsets = numpy.array(self._offsets)
+        self._dx = offsets[:, 0]
+        self._dy = offsets[:, 1]
+        self._indptr = None
+        self._indices = None
+
+    @staticmethod
+    @functools.lru_cache(maxsize=16)
+    def of(width, height, diagonals=False, wrap=True):
+        '''
+        Returns the (shared) Topology of a width x height grid.
+        '''
+        return Topology(width, height, diagonals, wrap)
+
+    def neighbors_of(self, cells):
+        '''
+        Returns the neighbours of every cell in `cells` (a sequence of flat
+            indices) as a pair of arrays: the neighbours, grouped by cell in
+            the order given, and the cell each one is a neighbour of.
+        '''
+        cells = numpy.asarray(cells, dtype=numpy.int64).ravel()
+        x = cells % self.width
+        y = cells // self.width
+        nx = x[:, None] + self._dx
+        ny = y[:, None] + self._dy
+        valid = (ny >= 0) & (ny < self.height)
+        if self.wrap:
+            nx %= self.width
+        else:
+            valid &= (nx >= 0) & (nx < self.width)
+        valid &= (nx != x[:, None]) | (ny != y[:, None])
+        return ((ny * self.width + nx)[valid],
+            numpy.broadcast_to(cells[:, None], valid.shape)[valid])
+
+    @property
+    def indptr(self):
+        self._build()
+        return numpy.frombuffer(self._indptr, dtype=numpy.int64)
+
+    @property
+    def indices(self):
+        self._build()
+        return numpy.frombuffer(self._indices, dtype=numpy.int32)
+
+    def neighbors(self, index):
+        '''
+        Returns the neighbours of the cell with flat index `index`, as a
+            sequence of ints.
+        '''
+        if self._indptr is None:
+            if not self.fits():
+                return self._compute_neighbors(index)
+            self._build()
+        indptr = self._indptr
+        return self._indices[indptr[index]:indptr[index + 1]]
+
+    def fits(self):
+        '''
+        Whether the grid is small enough for neighbors to use adjacency
+            tables.
+        '''
+        return self.width * self.height <= MAX_TABLE_CELLS
+
+    def _compute_neighbors(self, index):
+        width = self.width
+        y, x = divmod(index, width)
+        neighbors = []
+        for dx, dy in self._offsets:
+            nx, ny = x + dx, y + dy
+            if self.wrap:
+                nx %= width
+            elif not 0 <= nx < width:
+                continue
+            if 0 <= ny < self.height and (nx != x or ny != y):
+                neighbors.append(ny * width + nx)
+        return neighbors
+
+    def _build(self):
+        if self._indptr is not None:
+            return
+        size = self.width * self.height
+        neighbors, owners = self.neighbors_of(numpy.arange(size))
+        indptr = numpy.zeros(size + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(owners, minlength=size), out=indptr[1:])
+        # array slices are much cheaper to take and iterate over than numpy
+        # ones, one cell at a time.
+        self._indices = array.array('i', neighbors.astype(numpy.int32)
+            .tobytes())
+        self._indptr = array.array('q', indptr.tobytes())
@@ -1,35 +1,66 @@
 
 import itertools
+import os
 import random
 import math
+import numpy
 from .noise_util import NoiseUtil
 from .print_util import PrintUtil
 from .terraform import Terraform
-from .directions import Directions
 from .biome import Biome
 from .geometry import Geometry
+from .distance import DistanceField
+from .hydrology import Hydrology
 from .layer import LayerCollection
-from .agent import AgentType, AgentActions, Agent
+from .chunks import ChunkStore, DEFAULT_CHUNK_SIZE, DEFAULT_MEMORY_BUDGET
+from .agent import AgentType, AgentActions, Agent, Settlement
 from .people import People
+from .database import Database
 from .faction import Faction
+from colors import COLORS
 from .history import History
+from .spatial import SpatialIndex
+from .parallel import StripStepper
+from .rng import RandomStreams
+from .topology import Topology
+from .cell_index import CellPredicate, CellIndex, PASSABLE
 
 MAX_NUM_ATTEMPTS = 1000
 MOISTURE_FACTOR = 0.95
 MOISTURE_CLASS = 0.16
+# drainage area, in cells, from which on a cell is river.
+RIVER_ACCUMULATION = 20
+# how far around a chunk init_lazy looks for rivers.
+MOISTURE_MARGIN = 32
 
 class World(LayerCollection):
-    def __init__(self, width=300, height=60, db=None):
+    def __init__(self, width=300, height=60, db=None, seed=None):
         super().__init__(width, height)
-        self.db = db
+        # a Database, or a connection or path to make one of.
+        self.db = Database.of(db)
+        # root seed for anything that needs to be reproducible.
+        self.seed = (seed if seed is not None
+            else int.from_bytes(os.urandom(4), 'big'))
+        # per-subsystem random streams derived from the seed.
+        self.rng = RandomStreams(self.seed)
         self.agents = {}
+        self._last_agent_id = 0
         self.factions = {}
         self.pending_agents = []  # pending queue, emptied at the end of every step
         self.history = History()
+        # all placed agents and settlements, for proximity queries.
+        self.spatial_index = SpatialIndex(width, height)
+        # predicate key => CellIndex, for random_cell.
+        self._cell_indices = {}
+        self.add_layer_listener(self._update_cell_indices)
 
     def get_agent(self, agent_id):
         return self.agents[agent_id]
 
+    def new_agent_id(self):
+        self._last_agent_id += 1
+        return self._last_agent_id
+
     def add_agent(self, agent):
         self.agents[agent.id] = agent
 
@@ -45,26 +76,56 @@ class World(LayerCollection):
     def get_latitude(self, x=0, y=0):
         return 90 * (abs(y - (self.height / 2)) / (self.height / 2))
 
-    def random_cell(self, condition=lambda c: True):
-        h = 0
+    def random_cell(self, condition=None, rng=None):
+        '''
+        Returns a random (x, y) cell satisfying `condition`. A CellPredicate
+            (see cell_index.py) is sampled from an index of the cells matching
+            it (unless it reads chunked layers); any other callable taking
+            (x, y) is tried on random cells until it holds. Raises
+            RuntimeError when no cell is found.
+        '''
+        rng = rng or self.rng.get('cells')
+        if isinstance(condition, CellPredicate) and \
+            any(self.is_chunked(name) for name in condition.layers):
+            predicate = condition
+            condition = lambda coord: predicate.test(self, *coord)
+        elif isinstance(condition, CellPredicate):
+            coord = self.cell_index(condition).sample(self, rng)
+            if coord is None:
+                raise RuntimeError(
+                    'No cell matches condition={}'.format(condition))
+            return coord
+
         num_attempts = 0
         while True:
             if num_attempts >= MAX_NUM_ATTEMPTS:
                 raise RuntimeError(
                     'Ran out of tries to get random cell with condition={}'.format(condition))
-            coord = (random.randint(0, self.width - 1),
-                random.randint(0, self.height - 1))
-            if condition(coord):
+            coord = (rng.randint(0, self.width - 1),
+                rng.randint(0, self.height - 1))
+            if condition is None or condition(coord):
                 return coord
             num_attempts += 1
 
+    def cell_index(self, predicate):
+        '''
+        Returns the CellIndex of the cells matching `predicate`, creating it
+            the first time it's asked for.
+        '''
+        index = self._cell_indices.get(predicate.key)
+        if index is None:
+            index = self._cell_indices[predicate.key] = CellIndex(predicate,
+                self.width, self.height)
+        return index
+
+    def _update_cell_indices(self, name, region):
+        for index in self._cell_indices.values():
+            index.on_layer_change(name, region)
+
     def get_neighbors(self, x, y, diagonals=False):
-        adjacent_x = [(x - 1) % self.width, x, (x + 1) % self.width]
-        adjacent_y = [yi for yi in [y - 1, y, y + 1]
-            if yi >= 0 and yi < self.height]
-        return [coord for coord in itertools.product(adjacent_x, adjacent_y)
-            if coord != (x, y) and
-            (diagonals or (coord[0] == x or coord[1] == y))]
+        width = self.width
+        return [(i % width, i // width) for i in
+            Topology.of(width, self.height, diagonals).neighbors(y * width + x)]
 
     def get_neighbor(self, x, y, direction):
         dx, dy = direction
@@ -74,68 +135,147 @@ class World(LayerCollection):
             return (xi, yi)
         return None
 
-    def init_terrain(self):
+    def init_terrain(self, processes=None):
+        # with `processes` > 1, the noise is sampled in that many processes
+        # (see Terraform.simplex); the terrain is the same either way.
         self._add_layer('elevation',
-            full_layer=Terraform.simplex(self.width, self.height))
+            full_layer=Terraform.simplex(self.width, self.height,
+                processes=processes, rng=self.rng.get('terrain')),
+            dtype=numpy.float32)
         return self
 
     def init_moisture(self):
-        self._add_layer('moisture')
+        self._add_layer('moisture', defaultval=0, dtype=numpy.uint8)
         self.init_rivers()
+        World._spread_moisture(self._own_layer('moisture'),
+            self.get_layer('elevation').astype(numpy.float64) >
+            Terraform.WATER_THRESHOLD)
+        self._touch_layer('moisture')
+        return self
 
+    @staticmethod
+    def _spread_moisture(moisture, land, wrap=True):
         # assign moisture values based on distance from moisture (i.e. river
         # cells). the moisture value exponentially decays as distance increases.
-        # cells are traversed using BFS from river tiles to ensure that we visit
-        # higher-moisture tiles first.
-        q = [(cell, cell) for cell in self._all_cells()
-            if self.get_moisture(*cell)]
-        visited = set()
-        while q:
-            cell, src = q.pop(0)
-            if (cell in visited or
-                not Terraform.get_height_class(self.get_elevation(*cell))):
-                continue
-            visited.add(cell)
-            dist = Geometry.distance_2d(cell, src)
-            self.set_moisture(*cell, val=max(1, int((MOISTURE_FACTOR ** dist) / MOISTURE_CLASS)))
-            for neighbor in self.get_neighbors(*cell):
-                q.append((neighbor, src))
-        return self
-
-    # generates rivers using the droplet algorithm.
+        # every land cell takes its moisture from the river cell that the
+        # multi-source BFS reaches it from first. without `wrap`, moisture
+        # doesn't spread across the left and right edges.
+        height, width = moisture.shape
+        # sources are seeded in _all_cells (column-major) order.
+        xs, ys = numpy.nonzero(moisture.T)
+        steps, nearest = DistanceField.nearest_source(width, height,
+            ys * width + xs, passable=land, wrap=wrap)
+
+        reached = steps >= 0
+        cell_y, cell_x = numpy.nonzero(reached)
+        src_y, src_x = numpy.divmod(nearest[reached], width)
+        dx = numpy.abs(cell_x - src_x)
+        if wrap:
+            dx = numpy.minimum(dx, width - dx)
+        dy = cell_y - src_y
+
+        # squared distances are small integers, so the decay is evaluated once
+        # per distinct distance.
+        squared, inverse = numpy.unique(dx * dx + dy * dy, return_inverse=True)
+        classes = numpy.array([
+            max(1, int((MOISTURE_FACTOR ** math.sqrt(d)) / MOISTURE_CLASS))
+            for d in squared.tolist()], dtype=moisture.dtype)
+        moisture[cell_y, cell_x] = classes[inverse.ravel()]
+
+    # generates rivers from the drainage of the terrain: every land cell that
+    # at least RIVER_ACCUMULATION cells drain through is river. the drainage
+    # itself is kept in the flow_direction, flow_accumulation and watershed
+    # layers (see Hydrology).
     def init_rivers(self):
-        max_num_rivers = (self.width * self.height) // 700
-
-        for i in range(max_num_rivers):
-            source = self.random_cell(
-                condition=lambda coord: self.get_elevation(*coord) >= 0.8)
-            curpos = source
-            curdir = Directions.random()
-            curelev = self.get_elevation(*source)
-            while curpos and self.get_elevation(*curpos) > Terraform.WATER_THRESHOLD:
-                self.set_moisture(*curpos, val=1.0)
-
-                next_cell = self.get_neighbor(*curpos, direction=curdir)
-                if not next_cell or self.get_elevation(*next_cell) > self.get_elevation(*curpos):
-                    directions = [d for d in Directions.all()
-                        if self.get_neighbor(*curpos, direction=d) and not self.get_moisture(*self.get_neighbor(*curpos, direction=d))]
-                    if not directions:
-                        break
-                    curdir = random.choice(directions)
-                    next_cell = self.get_neighbor(*curpos, direction=curdir)
-
-                curpos = next_cell
+        drainage = Hydrology.drain(self.get_layer('elevation'),
+            Terraform.WATER_THRESHOLD)
+        land = (self.get_layer('elevation').astype(numpy.float64) >
+            Terraform.WATER_THRESHOLD)
+        river = land & (drainage.accumulation >= RIVER_ACCUMULATION)
+
+        self._add_layer('flow_direction', full_layer=drainage.direction,
+            dtype=numpy.uint8)
+        self._add_layer('flow_accumulation', full_layer=drainage.accumulation,
+            dtype=numpy.int32)
+        self._add_layer('watershed', full_layer=drainage.watershed,
+            dtype=numpy.int32)
+        self._add_layer('river', full_layer=river, dtype=numpy.bool_)
+        if 'moisture' not in self.layers:
+            self._add_layer('moisture', defaultval=0, dtype=numpy.uint8)
+        self.set_layer('moisture',
+            numpy.where(river, 1, self.get_layer('moisture')))
         return self
 
     def init_biomes(self):
         self._add_layer('biome',
-            full_layer=[[Biome.determine_biome(
-                latitude=self.get_latitude(y=y),
-                elevation=self.get_elevation(x, y),
-                moisture=self.get_moisture(x, y)
-            ) for x in range(self.width)] for y in range(self.height)])
+            full_layer=self._biome_region(0, 0, self.width, self.height),
+            # Biome.OCEAN doesn't fit in a uint8.
+            dtype=numpy.uint16)
         return self
 
+    def _biome_region(self, x, y, width, height):
+        latitude = numpy.array([self.get_latitude(y=row)
+            for row in range(y, y + height)]).reshape(-1, 1)
+        return Biome.determine_biomes(
+            latitude=latitude,
+            elevation=self.get_region('elevation', x, y, width, height),
+            moisture=self.get_region('moisture', x, y, width, height))
+
+    def init_lazy(self, chunk_size=DEFAULT_CHUNK_SIZE,
+            memory_budget=DEFAULT_MEMORY_BUDGET, directory=None):
+        '''
+        Like init_all, for maps too large to generate up front: terrain,
+            moisture, biomes and the agent layers are chunked (see chunks.py),
+            and each chunk is only generated when one of its cells is first
+            used. At most `memory_budget` bytes of chunks are kept in memory;
+            evicted chunks that were written to are saved in `directory`.
+        The terrain is the same as init_terrain's. Rivers and moisture are
+            worked out for each chunk and a margin around it, so they only
+            approximate init_moisture's; and there are no drainage layers.
+        '''
+        self.chunk_store = ChunkStore(memory_budget, directory)
+        seeds = Terraform.simplex_seeds(self.rng.get('terrain'))
+        self._add_chunked_layer('elevation',
+            lambda x, y, width, height: Terraform.simplex_region(self.width,
+                self.height, seeds, x, y, width, height),
+            numpy.float32, chunk_size)
+        self._add_chunked_layer('moisture', self._moisture_region,
+            numpy.uint8, chunk_size)
+        self._add_chunked_layer('biome', self._biome_region, numpy.uint16,
+            chunk_size)
+        self._add_chunked_layer('agent_position',
+            lambda x, y, width, height: [[set() for _ in range(width)]
+                for _ in range(height)],
+            object, chunk_size)
+        self._add_chunked_layer('settlement',
+            lambda x, y, width, height: None, object, chunk_size)
+        return self._add_peoples()
+
+    def _moisture_region(self, x, y, width, height):
+        # rivers and moisture for a rectangle of the map, worked out over it
+        # and a margin of MOISTURE_MARGIN cells around it. water drains out
+        # of the margin's edges, and rivers further away don't count.
+        top = max(y - MOISTURE_MARGIN, 0)
+        bottom = min(y + height + MOISTURE_MARGIN, self.height)
+        wrap = width + 2 * MOISTURE_MARGIN >= self.width
+        left = 0 if wrap else x - MOISTURE_MARGIN
+        window_width = self.width if wrap else width + 2 * MOISTURE_MARGIN
+        elevation = self.get_region('elevation', left, top, window_width,
+            bottom - top)
+
+        outlets = numpy.zeros(elevation.shape, dtype=bool)
+        outlets[0] = top > 0
+        outlets[-1] = bottom < self.height
+        if not wrap:
+            outlets[:, 0] = outlets[:, -1] = True
+        drainage = Hydrology.drain(elevation, Terraform.WATER_THRESHOLD,
+            wrap=wrap, outlets=outlets)
+        land = elevation.astype(numpy.float64) > Terraform.WATER_THRESHOLD
+        moisture = (land & (drainage.accumulation >= RIVER_ACCUMULATION)) \
+            .astype(numpy.uint8)
+        World._spread_moisture(moisture, land, wrap)
+        return moisture[y - top:y - top + height, x - left:x - left + width]
+
     def init_resources(self):
         pass
 
@@ -146,27 +286,37 @@ class World(LayerCollection):
 
         self.mutate_agent_position(x, y, fn=lambda value: value.add(agent.id))
         agent.position = (x, y)
+        self.spatial_index.move(agent, x, y)
+
+    def add_settlement(self, settlement):
+        # the settlement takes over its settler's id, and so its index entry.
+        self.set_settlement(*settlement.position, val=settlement)
+        self.spatial_index.insert(settlement, *settlement.position)
 
     def place_agent(self, agent):
-        agent_position = self.random_cell(
-            condition=lambda coord: Biome.is_passable(self.get_biome(*coord)))
+        agent_position = self.random_cell(condition=PASSABLE)
         self.move_agent(agent, *agent_position)
 
     def place_structure(self):
         pass
 
     def init_peoples(self):
-        # The agent_positions layer consists of a set of uuids representing
+        # The agent_positions layer consists of a set of ids representing
         # the agents on a cell.
         self._add_layer('agent_position',
             full_layer=[[set() for x in range(self.width)]
-                for y in range(self.height)])
-        self._add_layer('settlement', defaultval=None)
+                for y in range(self.height)],
+            dtype=object)
+        self._add_layer('settlement', defaultval=None, dtype=object)
+        return self._add_peoples()
 
+    def _add_peoples(self):
         # return the "Eden agent" (i.e. first settler) for each different
         # people.
-        for people in People.all_peoples(self.db, self):
-            faction = Faction(people=people)
+        colors = list(COLORS)
+        self.rng.get('factions').shuffle(colors)
+        for i, people in enumerate(People.all_peoples(self.db, self)):
+            faction = Faction(people=people, color=colors[i % len(colors)])
             self.add_faction(faction)
             agent = Agent(world=self,
                 faction=faction,
@@ -183,12 +333,101 @@ class World(LayerCollection):
         self.init_biomes()
         self.init_peoples()
 
+    def fork(self, seed=None):
+        '''
+        Returns an independent copy of this world, to continue the simulation
+            from here in another direction. Layers are shared copy-on-write
+            (see layer.py), and the history's spilled events are copied
+            lazily; agents and factions are copied up front, at a cost
+            proportional to their number rather than to the map size.
+            The fork's random streams continue from this world's, so it plays
+            out the same way until something changes; pass a `seed` to
+            reseed them instead.
+        '''
+        fork = type(self).__new__(type(self))
+        LayerCollection.__init__(fork, self.width, self.height)
+        fork.db = self.db
+        fork.seed = self.seed if seed is None else seed
+        fork.rng = self.rng.fork() if seed is None else RandomStreams(seed)
+        fork._last_agent_id = self._last_agent_id
+        fork.history = self.history.fork()
+        fork.spatial_index = SpatialIndex(self.width, self.height)
+        # copied rather than rebuilt, so that the fork samples the same cells.
+        fork._cell_indices = {key: index.fork()
+            for key, index in self._cell_indices.items()}
+
+        fork.factions = {name: faction.fork()
+            for name, faction in self.factions.items()}
+        # parent agent object -> its copy, by id() since ids are reused.
+        copies = {}
+        for agent in itertools.chain(self.agents.values(),
+            self.pending_agents):
+            copies[id(agent)] = agent.fork(fork,
+                agent.faction and fork.factions[agent.faction.name])
+        for agent in itertools.chain(self.agents.values(),
+            self.pending_agents):
+            agent_copy = copies[id(agent)]
+            if agent.origin is not None:
+                agent_copy.origin = copies.get(id(agent.origin), agent.origin)
+            if isinstance(agent, Settlement):
+                agent_copy.faction.add_settlement(agent_copy)
+        fork.agents = {agent_id: copies[id(agent)]
+            for agent_id, agent in self.agents.items()}
+        fork.pending_agents = [copies[id(agent)]
+            for agent in self.pending_agents]
+        # pending settlements replace their settler in the index.
+        for agent in itertools.chain(fork.agents.values(),
+            fork.pending_agents):
+            if agent.position:
+                fork.spatial_index.insert(agent, *agent.position)
+
+        if 'settlement' in self.layers:
+            # build it if this world is itself a fork that hasn't yet, so
+            # that it's among the layers shared below.
+            self.layers['settlement']
+        self._share_layers(fork)
+        if 'settlement' in self.layers:
+            # the settlement layer holds this world's settlements, so the
+            # fork builds its own from a snapshot once it's first needed.
+            snapshot = dict.pop(fork.layers, 'settlement')
+            fork._defer_layer('settlement',
+                lambda: Settlement.remap_layer(snapshot, copies))
+        fork.layer_versions = dict(self.layer_versions)
+        # only now: deferring the settlement layer above isn't a change to it,
+        # and would have marked the indices depending on it stale.
+        fork.add_layer_listener(fork._update_cell_indices)
+        return fork
+
     def step(self):
+        self._grow_settlements()
+
         for _, agent in self.agents.items():
-            self.history.record(agent, *agent.step())
+            self.history.record(agent, *Agent.step(agent))
 
+        self._add_pending_agents()
+        self.history.advance()
+
+    def step_parallel(self, workers):
+        '''
+        Runs one step with the map split into `workers` longitudinal strips,
+            each stepped in its own process -- once there are enough agents
+            to make that worthwhile; until then, this is just step() (see
+            parallel.py). The outcome is deterministic for a given world seed
+            and number of workers.
+        '''
+        StripStepper(self, workers).step()
+
+    def _grow_settlements(self):
+        # settlements grow in one batch up front, so they're stepped as plain
+        # agents afterwards rather than through Settlement.step.
+        settlements = [agent for agent in self.agents.values()
+            if isinstance(agent, Settlement)]
+        for settlement in Settlement.grow_all(settlements,
+            rng=self.rng.numpy('economy')):
+            settlement.spawn_settler()
+
+    def _add_pending_agents(self):
         for agent in self.pending_agents:
             self.add_agent(agent)
             self.history.record(agent, AgentActions.spawn)
-
-        self.history.advance()
+        self.pending_agents = []
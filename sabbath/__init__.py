@@ -0,0 +1,3 @@
+
+from .server import SabbathServer
+from .client import SabbathClient
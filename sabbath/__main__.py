@@ -0,0 +1,40 @@
+
+# Serves a freshly generated world and steps it every --interval seconds:
+#
+#   python -m sabbath --port 8080 --seed 1234
+
+import argparse
+import asyncio
+import sqlite3
+from godcomplex import World
+from .server import SabbathServer
+from .tiles import DEFAULT_TILE_SIZE
+
+async def main(args):
+    world = World(width=args.width, height=args.height, seed=args.seed,
+        db=sqlite3.connect('file:{}?mode=ro'.format(args.db), uri=True))
+    world.init_all()
+
+    server = await SabbathServer(world, host=args.host, port=args.port,
+        tile_size=args.tile_size).start()
+    print('Serving world {} on http://{}:{}/'.format(world.seed,
+        server.host, server.port))
+    try:
+        await server.run(ticks=args.ticks, interval=args.interval)
+    finally:
+        await server.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a world over HTTP.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--db', default='worldgen.db')
+    parser.add_argument('--width', type=int, default=300)
+    parser.add_argument('--height', type=int, default=60)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--tile-size', type=int, default=DEFAULT_TILE_SIZE)
+    parser.add_argument('--interval', type=float, default=1.0,
+        help='seconds between ticks')
+    parser.add_argument('--ticks', type=int,
+        help='number of ticks to run (default: forever)')
+    asyncio.run(main(parser.parse_args()))
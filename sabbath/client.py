@@ -0,0 +1,88 @@
+
+import asyncio
+import json
+from . import websocket
+
+# A small asyncio client for a sabbath server, e.g. for scripting against a
+# local one or checking its responses.
+
+class SabbathClient:
+    def __init__(self, host='127.0.0.1', port=8080):
+        self.host = host
+        self.port = port
+
+    async def get(self, path, headers=None):
+        '''
+        Sends GET `path` on a fresh connection and returns (status, headers,
+            body). Header names are lowercased.
+        '''
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            request_headers = {'Host': '{}:{}'.format(self.host, self.port),
+                'Connection': 'close'}
+            request_headers.update(headers or {})
+            writer.write(('GET {} HTTP/1.1\r\n'.format(path) + ''.join(
+                '{}: {}\r\n'.format(name, value)
+                for name, value in request_headers.items()) + '\r\n')
+                .encode('latin-1'))
+            await writer.drain()
+
+            status, response_headers = await self._read_head(reader)
+            length = int(response_headers.get('content-length', 0))
+            body = await reader.readexactly(length) if length else b''
+            return status, response_headers, body
+        finally:
+            writer.close()
+
+    async def get_json(self, path, headers=None):
+        status, response_headers, body = await self.get(path, headers)
+        return status, response_headers, json.loads(body) if body else None
+
+    async def ticks(self):
+        '''
+        Connects to the server's WebSocket stream and yields every per-tick
+            message, decoded.
+        '''
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            key = websocket.new_key()
+            writer.write(('GET /ws HTTP/1.1\r\n'
+                'Host: {}:{}\r\n'
+                'Upgrade: websocket\r\n'
+                'Connection: Upgrade\r\n'
+                'Sec-WebSocket-Key: {}\r\n'
+                'Sec-WebSocket-Version: 13\r\n\r\n'.format(
+                    self.host, self.port, key)).encode('latin-1'))
+            await writer.drain()
+            status, headers = await self._read_head(reader)
+            if status != 101 or headers.get('sec-websocket-accept') != \
+                websocket.accept_key(key):
+                raise websocket.WebSocketError(
+                    'Handshake failed with status {}'.format(status))
+
+            while True:
+                opcode, payload = await websocket.read_frame(reader,
+                    max_size=None)
+                if opcode == websocket.OP_CLOSE:
+                    return
+                if opcode == websocket.OP_PING:
+                    writer.write(websocket.encode_frame(websocket.OP_PONG,
+                        payload, mask=True))
+                elif opcode == websocket.OP_TEXT:
+                    yield json.loads(payload)
+        finally:
+            if not writer.is_closing():
+                writer.write(websocket.encode_frame(websocket.OP_CLOSE, b'',
+                    mask=True))
+            writer.close()
+
+    async def _read_head(self, reader):
+        head = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1')
+        lines = head.split('\r\n')
+        status = int(lines[0].split(' ')[1])
+        headers = {}
+        for line in lines[1:]:
+            if line:
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+        return status, headers
@@ -0,0 +1,78 @@
+
+import asyncio
+import urllib.parse
+
+# A minimal HTTP/1.1 request reader and response writer, enough for sabbath's
+# GET-only API over keep-alive connections.
+
+REASONS = {
+    200: 'OK',
+    101: 'Switching Protocols',
+    304: 'Not Modified',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+}
+
+class HTTPError(Exception):
+    def __init__(self, status, message=''):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+class Request:
+    def __init__(self, method, target, version, headers):
+        self.method = method
+        self.version = version
+        self.headers = headers
+        parsed = urllib.parse.urlsplit(target)
+        self.path = urllib.parse.unquote(parsed.path)
+        self.query = {key: values[-1] for key, values
+            in urllib.parse.parse_qs(parsed.query).items()}
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+    def __repr__(self):
+        return '<Request {} {}>'.format(self.method, self.path)
+
+async def read_request(reader):
+    '''
+    Reads the next request off a connection, or returns None at EOF.
+        Request bodies aren't supported.
+    '''
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError:
+        return None
+    except asyncio.LimitOverrunError:
+        raise HTTPError(400, 'Request head too large')
+
+    lines = head.decode('latin-1').split('\r\n')
+    try:
+        method, target, version = lines[0].split(' ')
+    except ValueError:
+        raise HTTPError(400, 'Malformed request line')
+    headers = {}
+    for line in lines[1:]:
+        if line:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+    return Request(method, target, version, headers)
+
+def response(status, body=b'', headers=None, content_type='application/json'):
+    '''
+    Encodes a response with the given status, body and extra headers.
+    '''
+    headers = dict(headers or {})
+    if status not in (101, 304):
+        headers.setdefault('Content-Type', content_type)
+        headers['Content-Length'] = str(len(body))
+    head = 'HTTP/1.1 {} {}\r\n'.format(status, REASONS.get(status, '')) + \
+        ''.join('{}: {}\r\n'.format(name, value)
+            for name, value in headers.items()) + '\r\n'
+    return head.encode('latin-1') + (body if status != 304 else b'')
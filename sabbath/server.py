@@ -0,0 +1,366 @@
+
+import asyncio
+import concurrent.futures
+import json
+import threading
+import numpy
+from .http import HTTPError, read_request, response
+from .tiles import TileCache, DEFAULT_TILE_SIZE
+from . import websocket
+
+# An asyncio HTTP/WebSocket server for one World.
+#
+#   GET /world                          size, seed, tick and layers
+#   GET /layers/<name>/tiles/<tx>/<ty>  one tile of a layer, as JSON (or as
+#                                       raw bytes with ?format=raw, for
+#                                       numeric layers)
+#   GET /layers/<name>/region?x=&y=&width=&height=
+#                                       any rectangle, wrapping in x
+#   GET /ws                             WebSocket stream of per-tick changes
+#
+# Responses carry ETags and honour If-None-Match. Encoded tiles are cached
+# (see tiles.py) until a write touches them.
+#
+# The world is stepped on a dedicated simulation thread (see run/step), while
+# the event loop serves requests; world_lock keeps readers from seeing a
+# half-stepped world. Whatever a tick changed -- the layer regions written,
+# reported by a layer listener, and the history events, from a history
+# subscription -- is collected on the simulation thread, then encoded once in
+# a worker thread and broadcast to every WebSocket client. Each client has a
+# bounded queue of pending messages; one that falls behind loses its oldest
+# messages (counted in its `dropped`).
+
+DEFAULT_CLIENT_QUEUE_SIZE = 64
+EVENT_QUEUE_SIZE = 1 << 16
+MAX_REGION_CELLS = 1 << 18
+# how long a closing WebSocket connection gets to flush its queue.
+CLOSE_TIMEOUT = 5.0
+
+def encode_value(name, value):
+    if name == 'settlement':
+        return value and {
+            'id': value.id,
+            'faction': value.faction.name,
+            'population': value.population,
+        }
+    if name == 'agent_position':
+        return sorted(value)
+    return value if value is None else str(value)
+
+def encode_values(name, values):
+    '''
+    Returns a 2D array of layer values as nested lists of JSON values.
+    '''
+    if values.dtype != object:
+        return values.tolist()
+    return [[encode_value(name, value) for value in row] for row in values]
+
+class Client:
+    def __init__(self, writer, queue_size):
+        self.writer = writer
+        self.queue = asyncio.Queue(queue_size)
+        self.dropped = 0
+
+    def send(self, frame):
+        if self.queue.full():
+            self.queue.get_nowait()
+            # the dropped frame counts as done, or queue.join() never returns.
+            self.queue.task_done()
+            self.dropped += 1
+        self.queue.put_nowait(frame)
+
+class SabbathServer:
+    def __init__(self, world, host='127.0.0.1', port=0,
+            tile_size=DEFAULT_TILE_SIZE,
+            client_queue_size=DEFAULT_CLIENT_QUEUE_SIZE):
+        self.world = world
+        self.host = host
+        self.port = port
+        self.client_queue_size = client_queue_size
+        self.world_lock = threading.RLock()
+        self.tiles = TileCache(world, tile_size)
+        self.clients = set()
+        self.server = None
+        self._connections = set()
+
+        # what changed since the last tick was published: layer name -> set
+        # of regions, or None if the whole layer may have.
+        self._changes = {}
+        self._changes_lock = threading.Lock()
+        world.add_layer_listener(self._record_change)
+        self._events = world.history.subscribe(max_queue=EVENT_QUEUE_SIZE)
+        self._simulation = concurrent.futures.ThreadPoolExecutor(1,
+            thread_name_prefix='sabbath-simulation')
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle,
+            self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        for client in list(self.clients):
+            client.writer.close()
+        if self._connections:
+            await asyncio.wait(self._connections, timeout=CLOSE_TIMEOUT)
+        self._events.close()
+        self.tiles.close()
+        self.world.remove_layer_listener(self._record_change)
+        self._simulation.shutdown()
+
+    async def run(self, ticks=None, interval=1.0):
+        '''
+        Steps the world `ticks` times (forever if None), `interval` seconds
+            apart, publishing the changes of every tick.
+        '''
+        while ticks is None or ticks > 0:
+            await self.step()
+            if ticks is not None:
+                ticks -= 1
+            await asyncio.sleep(interval)
+
+    async def step(self):
+        loop = asyncio.get_running_loop()
+        tick, changes, events = await loop.run_in_executor(self._simulation,
+            self._step)
+        frame = await loop.run_in_executor(None, self._encode_tick,
+            tick, changes, events)
+        for client in list(self.clients):
+            client.send(frame)
+
+    def _step(self):
+        # runs on the simulation thread.
+        with self.world_lock:
+            self.world.step()
+            tick = self.world.history.current_timestamp
+        with self._changes_lock:
+            changes, self._changes = self._changes, {}
+        return tick, changes, self._events.drain()
+
+    def _record_change(self, name, region):
+        with self._changes_lock:
+            if region is None:
+                self._changes[name] = None
+            elif self._changes.get(name, ()) is not None:
+                self._changes.setdefault(name, set()).add(region)
+
+    def _encode_tick(self, tick, changes, events):
+        message = {
+            'type': 'tick',
+            'tick': tick,
+            'changes': {name: 'all' if regions is None
+                else sorted(regions) for name, regions in changes.items()},
+            'events': [{
+                'timestamp': event.timestamp,
+                'agent': event.agent_id,
+                'action': getattr(event.action, '__name__', str(event.action)),
+                'result': event.result,
+            } for event in events],
+            'dropped_events': self._events.dropped,
+        }
+        return websocket.encode_frame(websocket.OP_TEXT,
+            json.dumps(message).encode('utf-8'))
+
+    async def _handle(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                    if request is None:
+                        break
+                    if request.headers.get('upgrade', '').lower() == \
+                        'websocket':
+                        await self._serve_websocket(request, reader, writer)
+                        break
+                    status, body, headers = await self._dispatch(request)
+                except HTTPError as e:
+                    writer.write(self._error(e.status, e.message))
+                    await writer.drain()
+                    break
+                headers['Cache-Control'] = 'no-cache'
+                if not request.keep_alive:
+                    headers['Connection'] = 'close'
+                writer.write(response(status, body, headers,
+                    headers.pop('Content-Type', 'application/json')))
+                await writer.drain()
+                if not request.keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            self._connections.discard(task)
+
+    def _error(self, status, message):
+        return response(status, json.dumps({'error': message}).encode('utf-8'),
+            {'Connection': 'close'})
+
+    async def _dispatch(self, request):
+        if request.method != 'GET':
+            raise HTTPError(405, 'Only GET is supported')
+        parts = [part for part in request.path.split('/') if part]
+        if parts in ([], ['world']):
+            return await self._get_world(request)
+        if len(parts) >= 3 and parts[0] == 'layers':
+            name = parts[1]
+            if name not in self.world.layers:
+                raise HTTPError(404, 'No layer {}'.format(name))
+            if parts[2] == 'tiles' and len(parts) == 5:
+                try:
+                    tx, ty = int(parts[3]), int(parts[4])
+                except ValueError:
+                    raise HTTPError(400, 'Tile coordinates must be integers')
+                return await self._get_tile(request, name, tx, ty)
+            if parts[2] == 'region' and len(parts) == 3:
+                return await self._get_region(request, name)
+        raise HTTPError(404, 'No such resource {}'.format(request.path))
+
+    def _conditional(self, request, etag, build):
+        # returns a 304 if the client has `etag` already, otherwise 200 with
+        # the body `build` returns.
+        if request.headers.get('if-none-match') == etag:
+            return 304, b'', {'ETag': etag}
+        return 200, build(), {'ETag': etag}
+
+    async def _get_world(self, request):
+        def build():
+            with self.world_lock:
+                names = sorted(set(dict.keys(self.world.layers)) |
+                    set(getattr(self.world.layers, 'deferred', ())))
+                return json.dumps({
+                    'width': self.world.width,
+                    'height': self.world.height,
+                    'seed': self.world.seed,
+                    'tick': self.world.history.current_timestamp,
+                    'tile_size': self.tiles.tile_size,
+                    'layers': {name: {
+                        'dtype': str(self.world.layers[name].dtype),
+                        'version': self.world.get_layer_version(name),
+                    } for name in names},
+                }).encode('utf-8')
+        etag = '"{}-world-{}-{}"'.format(self.tiles.epoch,
+            self.world.history.current_timestamp,
+            sum(self.world.layer_versions.values()))
+        return self._conditional(request, etag, build)
+
+    async def _get_tile(self, request, name, tx, ty):
+        if not self.tiles.has_tile(tx, ty):
+            raise HTTPError(404, 'No tile ({}, {})'.format(tx, ty))
+        fmt = request.query.get('format', 'json')
+        if fmt not in ('json', 'raw'):
+            raise HTTPError(400, 'Unknown format {}'.format(fmt))
+        if fmt == 'raw' and self.world.layers[name].dtype == object:
+            raise HTTPError(400, 'Layer {} has no raw format'.format(name))
+        headers = {'Content-Type': 'application/json' if fmt == 'json'
+            else 'application/octet-stream'}
+        if fmt == 'raw':
+            x, y, width, height = self.tiles.bounds(tx, ty)
+            headers['X-Dtype'] = self.world.layers[name].dtype.str
+            headers['X-Shape'] = '{},{}'.format(height, width)
+
+        etag = self.tiles.etag(name, tx, ty, fmt)
+        if request.headers.get('if-none-match') == etag:
+            headers['ETag'] = etag
+            return 304, b'', headers
+
+        cached = self.tiles.get(name, tx, ty, fmt)
+        if cached is None:
+            cached = await asyncio.get_running_loop().run_in_executor(None,
+                self._encode_tile, name, tx, ty, fmt)
+        headers['ETag'], body = cached
+        return 200, body, headers
+
+    def _encode_tile(self, name, tx, ty, fmt):
+        # runs in a worker thread.
+        x, y, width, height = self.tiles.bounds(tx, ty)
+        with self.world_lock:
+            generation = self.tiles.generation(name, tx, ty)
+            values = self.world.get_region(name, x, y, width, height)
+            if fmt == 'raw':
+                body = numpy.ascontiguousarray(values).tobytes()
+            else:
+                body = json.dumps({
+                    'layer': name,
+                    'tile': [tx, ty],
+                    'x': x, 'y': y, 'width': width, 'height': height,
+                    'values': encode_values(name, values),
+                }).encode('utf-8')
+        return self.tiles.put(name, tx, ty, fmt, generation, body), body
+
+    async def _get_region(self, request, name):
+        try:
+            x, y, width, height = (int(request.query[key])
+                for key in ('x', 'y', 'width', 'height'))
+        except (KeyError, ValueError):
+            raise HTTPError(400, 'x, y, width and height are required')
+        if width <= 0 or height <= 0 or width * height > MAX_REGION_CELLS:
+            raise HTTPError(400, 'Region must have between 1 and {} cells'
+                .format(MAX_REGION_CELLS))
+
+        def build():
+            with self.world_lock:
+                values = self.world.get_region(name, x, y, width, height)
+                return json.dumps({
+                    'layer': name,
+                    'x': x % self.world.width, 'y': max(y, 0),
+                    'width': width, 'height': values.shape[0],
+                    'values': encode_values(name, values),
+                }).encode('utf-8')
+        etag = '"{}-{}-{}-{}-{}-{}-{}"'.format(self.tiles.epoch, name,
+            self.world.get_layer_version(name), x, y, width, height)
+        if request.headers.get('if-none-match') == etag:
+            return 304, b'', {'ETag': etag}
+        body = await asyncio.get_running_loop().run_in_executor(None, build)
+        return 200, body, {'ETag': etag}
+
+    async def _serve_websocket(self, request, reader, writer):
+        key = request.headers.get('sec-websocket-key')
+        if request.path.rstrip('/') != '/ws' or not key:
+            raise HTTPError(400, 'WebSocket connections go to /ws')
+        writer.write(response(101, headers={
+            'Upgrade': 'websocket',
+            'Connection': 'Upgrade',
+            'Sec-WebSocket-Accept': websocket.accept_key(key),
+        }))
+        await writer.drain()
+
+        client = Client(writer, self.client_queue_size)
+        self.clients.add(client)
+        sender = asyncio.ensure_future(self._send_loop(client))
+        try:
+            while True:
+                opcode, payload = await websocket.read_frame(reader)
+                if opcode == websocket.OP_CLOSE:
+                    client.send(websocket.encode_frame(websocket.OP_CLOSE,
+                        payload[:2]))
+                    break
+                if opcode == websocket.OP_PING:
+                    client.send(websocket.encode_frame(websocket.OP_PONG,
+                        payload))
+        except (websocket.WebSocketError, asyncio.IncompleteReadError,
+                ConnectionError):
+            pass
+        finally:
+            self.clients.discard(client)
+            # let the sender flush what's queued (e.g. the close frame).
+            try:
+                await asyncio.wait_for(client.queue.join(), CLOSE_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+            sender.cancel()
+
+    async def _send_loop(self, client):
+        while True:
+            frame = await client.queue.get()
+            try:
+                client.writer.write(frame)
+                await client.writer.drain()
+            except ConnectionError:
+                pass
+            finally:
+                client.queue.task_done()
@@ -0,0 +1,113 @@
+
+import os
+import threading
+
+DEFAULT_TILE_SIZE = 32
+DEFAULT_MAX_TILES = 4096
+
+# A cache of encoded layer tiles, kept up to date by listening to the world's
+# layer writes (see LayerCollection.add_layer_listener).
+# Every tile has a generation, bumped whenever a write touches it (or touches
+# the whole layer), and its ETag is derived from it, so a tile's ETag changes
+# exactly when its contents may have. Entries remember the generation they
+# were encoded at, and are only served while it's still current.
+# The simulation thread writes (and so invalidates) while HTTP handlers read,
+# so the cache has its own lock. Encoding a tile needs a consistent view of
+# the world, which is the caller's job (see SabbathServer.world_lock).
+
+class TileCache:
+    def __init__(self, world, tile_size=DEFAULT_TILE_SIZE,
+            max_tiles=DEFAULT_MAX_TILES):
+        self.world = world
+        self.tile_size = tile_size
+        self.max_tiles = max_tiles
+        self.tiles_x = -(-world.width // tile_size)
+        self.tiles_y = -(-world.height // tile_size)
+        # distinguishes the ETags of different server runs.
+        self.epoch = os.urandom(4).hex()
+        self.entries = {}  # (name, tx, ty, fmt) -> (generation, body)
+        self.tile_generations = {}  # (name, tx, ty) -> int
+        self.layer_generations = {}  # name -> int
+        self._lock = threading.Lock()
+        world.add_layer_listener(self.invalidate)
+
+    def close(self):
+        self.world.remove_layer_listener(self.invalidate)
+
+    def bounds(self, tx, ty):
+        '''
+        Returns the (x, y, width, height) of tile (`tx`, `ty`); tiles on the
+            right and bottom edges may be smaller than tile_size.
+        '''
+        x, y = tx * self.tile_size, ty * self.tile_size
+        return (x, y, min(self.tile_size, self.world.width - x),
+            min(self.tile_size, self.world.height - y))
+
+    def has_tile(self, tx, ty):
+        return 0 <= tx < self.tiles_x and 0 <= ty < self.tiles_y
+
+    def tiles_in(self, region):
+        '''
+        Returns the (tx, ty) of the tiles overlapping `region`, an
+            (x, y, width, height) rectangle that may wrap around in x.
+        '''
+        x, y, width, height = region
+        size = self.tile_size
+        rows = range(max(y, 0) // size,
+            min(-(-(y + height) // size), self.tiles_y))
+        if width >= self.world.width:
+            cols = range(self.tiles_x)
+        else:
+            cols = sorted({((x + dx) % self.world.width) // size
+                for dx in range(0, width, size)} |
+                {((x + width - 1) % self.world.width) // size})
+        return [(tx, ty) for ty in rows for tx in cols]
+
+    def invalidate(self, name, region):
+        with self._lock:
+            if region is None:
+                self.layer_generations[name] = \
+                    self.layer_generations.get(name, 0) + 1
+                for key in [key for key in self.entries if key[0] == name]:
+                    del self.entries[key]
+                return
+            for tx, ty in self.tiles_in(region):
+                key = (name, tx, ty)
+                self.tile_generations[key] = \
+                    self.tile_generations.get(key, 0) + 1
+
+    def generation(self, name, tx, ty):
+        return (self.layer_generations.get(name, 0),
+            self.tile_generations.get((name, tx, ty), 0))
+
+    def etag(self, name, tx, ty, fmt, generation=None):
+        layer_generation, tile_generation = (generation or
+            self.generation(name, tx, ty))
+        return '"{}-{}-{}-{}-{}-{}-{}"'.format(self.epoch, name, tx, ty, fmt,
+            layer_generation, tile_generation)
+
+    def get(self, name, tx, ty, fmt):
+        '''
+        Returns (etag, body) for the tile if its cached encoding is current,
+            or None.
+        '''
+        with self._lock:
+            generation = self.generation(name, tx, ty)
+            entry = self.entries.pop((name, tx, ty, fmt), None)
+            if entry is None or entry[0] != generation:
+                return None
+            # dicts keep insertion order, so re-inserting marks it most recent.
+            self.entries[(name, tx, ty, fmt)] = entry
+            return self.etag(name, tx, ty, fmt, generation), entry[1]
+
+    def put(self, name, tx, ty, fmt, generation, body):
+        '''
+        Caches `body`, the tile encoded at `generation` (read before encoding
+            it), and returns its ETag.
+        '''
+        with self._lock:
+            if generation == self.generation(name, tx, ty):
+                self.entries[(name, tx, ty, fmt)] = (generation, body)
+                while len(self.entries) > self.max_tiles:
+                    del self.entries[next(iter(self.entries))]
+        return self.etag(name, tx, ty, fmt, generation)
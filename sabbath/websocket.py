@@ -0,0 +1,78 @@
+
+import base64
+import hashlib
+import os
+import struct
+
+# The bits of RFC 6455 (WebSocket) sabbath needs: the opening handshake, and
+# reading and writing single-frame messages. Fragmented messages and
+# extensions aren't supported.
+
+GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+# the largest frame the server accepts from a client. Clients don't limit the
+# size of the server's frames: a busy tick's events can run to megabytes.
+MAX_FRAME_SIZE = 1 << 20
+
+class WebSocketError(Exception): pass
+
+def accept_key(key):
+    '''
+    Returns the Sec-WebSocket-Accept value answering Sec-WebSocket-Key `key`.
+    '''
+    digest = hashlib.sha1((key + GUID).encode('ascii')).digest()
+    return base64.b64encode(digest).decode('ascii')
+
+def new_key():
+    return base64.b64encode(os.urandom(16)).decode('ascii')
+
+def encode_frame(opcode, payload, mask=False):
+    '''
+    Encodes a final frame. Clients must mask the frames they send; servers
+        must not.
+    '''
+    length = len(payload)
+    header = bytes([0x80 | opcode])
+    mask_bit = 0x80 if mask else 0
+    if length < 126:
+        header += bytes([mask_bit | length])
+    elif length < (1 << 16):
+        header += bytes([mask_bit | 126]) + struct.pack('>H', length)
+    else:
+        header += bytes([mask_bit | 127]) + struct.pack('>Q', length)
+    if mask:
+        key = os.urandom(4)
+        return header + key + _apply_mask(payload, key)
+    return header + payload
+
+async def read_frame(reader, max_size=MAX_FRAME_SIZE):
+    '''
+    Reads one frame and returns (opcode, payload), unmasking it if needed.
+        Frames longer than `max_size` bytes (unless it's None) are refused.
+    '''
+    first, second = await reader.readexactly(2)
+    if not first & 0x80 or first & 0x0F == OP_CONTINUATION:
+        raise WebSocketError('Fragmented messages are not supported')
+    length = second & 0x7F
+    if length == 126:
+        length, = struct.unpack('>H', await reader.readexactly(2))
+    elif length == 127:
+        length, = struct.unpack('>Q', await reader.readexactly(8))
+    if max_size is not None and length > max_size:
+        raise WebSocketError('Frame of {} bytes is too large'.format(length))
+    key = await reader.readexactly(4) if second & 0x80 else None
+    payload = await reader.readexactly(length)
+    if key:
+        payload = _apply_mask(payload, key)
+    return first & 0x0F, payload
+
+def _apply_mask(payload, key):
+    # xor with the key repeated over the payload, as one big integer.
+    repeated = (key * (len(payload) // 4 + 1))[:len(payload)]
+    return (int.from_bytes(payload, 'big') ^
+        int.from_bytes(repeated, 'big')).to_bytes(len(payload), 'big')
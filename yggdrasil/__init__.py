@@ -0,0 +1,2 @@
+
+from .format import YggdrasilFile, save, load
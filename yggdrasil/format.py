@@ -0,0 +1,220 @@
+
+import json
+import mmap
+import struct
+import zlib
+import numpy
+
+# The yggdrasil file format, for persisting the layers of a LayerCollection.
+#
+#   header   MAGIC, format version, flags (reserved), width, height, and the
+#            offset and size of the index, little-endian (see HEADER).
+#   data     the layers, one after another, each starting on an ALIGNMENT
+#            byte boundary.
+#   index    UTF-8 JSON: for every layer its dtype (with byte order), shape,
+#            tile size and where its data is; plus any caller metadata.
+#
+# Every layer is cut into tiles of `tile_size` (rows, columns), in row-major
+# tile order. How tiles are stored depends on the layer's compression:
+#   none     the layer is stored as one contiguous row-major array, so it can
+#            be mapped into memory as is, and a tile is just a slice of it.
+#   zlib     each tile is compressed on its own and the index lists its offset
+#            and length. A tile that doesn't shrink is stored raw (its length
+#            is then exactly the raw tile size).
+# Either way, a single tile can be read without touching the rest of the file.
+#
+# Uncompressed layers are loaded zero-copy: the arrays handed out are backed
+# by a private (copy-on-write) mapping of the file, so loading costs nothing
+# up front, pages are read on first access, and writing to the arrays never
+# changes the file. Object layers (e.g. agent positions) can't be stored.
+
+MAGIC = b'YGGD'
+VERSION = 1
+HEADER = struct.Struct('<4sHHIIQQ')
+ALIGNMENT = 64
+DEFAULT_TILE_SIZE = (64, 64)
+COMPRESSION_NONE = 'none'
+COMPRESSION_ZLIB = 'zlib'
+
+def save(collection, path, layers=None, tile_size=DEFAULT_TILE_SIZE,
+        compress=(), level=6, meta=None):
+    '''
+    Writes the layers named in `layers` (by default, every layer that isn't
+        an object layer) of `collection` to `path`. Layers named in
+        `compress` (or all of them, if it's True) are stored as zlib
+        compressed tiles. `meta` is any JSON-serializable value to store
+        alongside, e.g. the world's seed.
+    '''
+    if layers is None:
+        layers = [name for name, layer in collection.layers.items()
+            if layer.dtype != object]
+    if compress is True:
+        compress = layers
+
+    index = {'layers': {}, 'meta': meta}
+    with open(path, 'wb') as f:
+        f.write(b'\0' * HEADER.size)
+        for name in layers:
+            layer = numpy.ascontiguousarray(collection.layers[name])
+            if layer.dtype == object:
+                raise ValueError(
+                    'Layer {} holds Python objects and cannot be saved'.format(
+                        name))
+            f.write(b'\0' * (-f.tell() % ALIGNMENT))
+            entry = {
+                'dtype': layer.dtype.str,
+                'shape': list(layer.shape),
+                'tile_size': list(tile_size),
+                'offset': f.tell(),
+            }
+            if name in compress:
+                entry['compression'] = COMPRESSION_ZLIB
+                entry['tiles'] = _write_tiles(f, layer, tile_size, level)
+            else:
+                entry['compression'] = COMPRESSION_NONE
+                f.write(memoryview(layer).cast('B'))
+            index['layers'][name] = entry
+
+        index_data = json.dumps(index, sort_keys=True).encode('utf-8')
+        index_offset = f.tell()
+        f.write(index_data)
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, 0, collection.width,
+            collection.height, index_offset, len(index_data)))
+
+def _write_tiles(f, layer, tile_size, level):
+    tiles = []
+    for rows, cols in _tile_slices(layer.shape, tile_size):
+        raw = numpy.ascontiguousarray(layer[rows, cols]).tobytes()
+        data = zlib.compress(raw, level)
+        if len(data) >= len(raw):
+            data = raw
+        tiles.append([f.tell(), len(data)])
+        f.write(data)
+    return tiles
+
+def _tile_slices(shape, tile_size):
+    height, width = shape
+    tile_height, tile_width = tile_size
+    for top in range(0, height, tile_height):
+        for left in range(0, width, tile_width):
+            yield (slice(top, min(top + tile_height, height)),
+                slice(left, min(left + tile_width, width)))
+
+def load(path, collection=None):
+    '''
+    Adds every layer stored in `path` to `collection` (by default, a new
+        LayerCollection of the stored size) and returns the collection.
+        Uncompressed layers are memory-mapped rather than read.
+    '''
+    f = YggdrasilFile(path)
+    if collection is None:
+        from godcomplex.layer import LayerCollection
+        collection = LayerCollection(f.width, f.height)
+    elif (collection.width, collection.height) != (f.width, f.height):
+        raise ValueError('{} holds a {}x{} map, expected {}x{}'.format(path,
+            f.width, f.height, collection.width, collection.height))
+
+    for name in f.layers:
+        layer = f.read_layer(name)
+        collection._add_layer(name, full_layer=layer, dtype=layer.dtype)
+    return collection
+
+class YggdrasilFile:
+    '''
+    A yggdrasil file opened for reading. Only the header and index are read
+        up front; layers and tiles are read on demand.
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            # a private mapping: arrays backed by it are writable, but writes
+            # never reach the file.
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+        magic, self.version, _, self.width, self.height, index_offset, \
+            index_size = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError('{} is not a yggdrasil file'.format(path))
+        if self.version > VERSION:
+            raise ValueError('{} uses format version {}, newer than {}'.format(
+                path, self.version, VERSION))
+        index = json.loads(
+            self._mmap[index_offset:index_offset + index_size].decode('utf-8'))
+        self.index = index['layers']
+        self.meta = index['meta']
+
+    @property
+    def layers(self):
+        return list(self.index)
+
+    def read_layer(self, name):
+        '''
+        Returns layer `name` as a (height, width) array. Uncompressed layers
+            are backed by the file mapping; compressed ones are decoded.
+        '''
+        entry = self.index[name]
+        dtype = numpy.dtype(entry['dtype'])
+        shape = tuple(entry['shape'])
+        if entry['compression'] == COMPRESSION_NONE:
+            return numpy.frombuffer(self._mmap, dtype=dtype,
+                count=shape[0] * shape[1], offset=entry['offset']) \
+                .reshape(shape)
+
+        layer = numpy.empty(shape, dtype=dtype)
+        for i, (rows, cols) in enumerate(
+            _tile_slices(shape, entry['tile_size'])):
+            layer[rows, cols] = self._decode_tile(entry, i, rows, cols)
+        return layer
+
+    def tile_grid(self, name):
+        '''
+        Returns the number of (rows, columns) of tiles layer `name` has.
+        '''
+        entry = self.index[name]
+        (height, width), (tile_height, tile_width) = \
+            entry['shape'], entry['tile_size']
+        return (-(-height // tile_height), -(-width // tile_width))
+
+    def read_tile(self, name, tile_y, tile_x):
+        '''
+        Returns tile (`tile_x`, `tile_y`) of layer `name`. Tiles on the bottom
+            and right edges may be smaller than the tile size.
+        '''
+        entry = self.index[name]
+        tiles_y, tiles_x = self.tile_grid(name)
+        if not (0 <= tile_y < tiles_y and 0 <= tile_x < tiles_x):
+            raise IndexError('Layer {} has no tile ({}, {})'.format(
+                name, tile_x, tile_y))
+        tile_height, tile_width = entry['tile_size']
+        height, width = entry['shape']
+        rows = slice(tile_y * tile_height,
+            min((tile_y + 1) * tile_height, height))
+        cols = slice(tile_x * tile_width,
+            min((tile_x + 1) * tile_width, width))
+        if entry['compression'] == COMPRESSION_NONE:
+            return self.read_layer(name)[rows, cols]
+        return self._decode_tile(entry, tile_y * tiles_x + tile_x, rows, cols)
+
+    def _decode_tile(self, entry, i, rows, cols):
+        dtype = numpy.dtype(entry['dtype'])
+        shape = (rows.stop - rows.start, cols.stop - cols.start)
+        offset, length = entry['tiles'][i]
+        data = self._mmap[offset:offset + length]
+        if length != shape[0] * shape[1] * dtype.itemsize:
+            data = zlib.decompress(data)
+        return numpy.frombuffer(data, dtype=dtype).reshape(shape)
+
+    def close(self):
+        try:
+            self._mmap.close()
+        except BufferError:
+            # arrays handed out by read_layer still point into the mapping;
+            # it's released once they're gone.
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()